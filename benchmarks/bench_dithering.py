@@ -0,0 +1,78 @@
+"""
+Dithering micro-benchmark: how long each DITHERING_ALGORITHM takes per
+megapixel at each IMAGE_COLOR_DEPTH, and how big the resulting GIFs are.
+Runs on the same photo-like test images as the stand-in upstream, already
+scaled to the output size, so only the dithering itself is timed.
+
+	python3 benchmarks/bench_dithering.py
+	python3 benchmarks/bench_dithering.py --depths 1bit --size 640x480 --runs 20
+"""
+
+# Standard library imports
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+# Third-party imports
+from PIL import Image
+
+# First-party imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from upstream import render_image
+from utils.dither_utils import DITHERING_ENGINES, reduce_depth
+from utils.palette_utils import DEPTH_PROFILES
+
+
+def parse_size(value):
+	width, _, height = value.lower().partition("x")
+	return int(width), int(height)
+
+def run(img, depth, algorithm, runs):
+	times = []
+	for _ in range(runs):
+		started = time.perf_counter()
+		output = reduce_depth(img, depth, algorithm)
+		times.append(time.perf_counter() - started)
+	gif = io.BytesIO()
+	output.save(gif, format="GIF", optimize=True)
+	megapixels = img.width * img.height / 1e6
+	return {
+		"depth": depth,
+		"algorithm": algorithm,
+		"ms_per_mpx": round(statistics.median(times) * 1000 / megapixels, 1),
+		"gif_bytes": gif.tell(),
+	}
+
+def print_table(results):
+	columns = ("depth", "algorithm", "ms_per_mpx", "gif_bytes")
+	widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+	print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+	for result in results:
+		print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Macproxy dithering benchmark")
+	parser.add_argument("--depths", nargs="+", choices=list(DEPTH_PROFILES), default=list(DEPTH_PROFILES), help="Color depths to run (default: all)")
+	parser.add_argument("--algorithms", nargs="+", choices=list(DITHERING_ENGINES), default=list(DITHERING_ENGINES), help="Dithering algorithms to run (default: all)")
+	parser.add_argument("--size", type=parse_size, default=(512, 342), help="Image size, WIDTHxHEIGHT (default: 512x342)")
+	parser.add_argument("--runs", type=int, default=10, help="Timed runs per combination")
+	parser.add_argument("--json", type=str, help="Also write the results to this file")
+	arguments = parser.parse_args()
+
+	img = Image.open(io.BytesIO(render_image(*arguments.size))).convert("RGB")
+	results = []
+	for depth in arguments.depths:
+		for algorithm in arguments.algorithms:
+			# The first run builds palettes and lookup tables, and isn't timed
+			reduce_depth(img, depth, algorithm)
+			results.append(run(img, depth, algorithm, arguments.runs))
+
+	print_table(results)
+	if arguments.json:
+		with open(arguments.json, "w", encoding="utf-8") as f:
+			json.dump({"settings": {**vars(arguments), "size": list(arguments.size)}, "results": results}, f, indent=2)
@@ -0,0 +1,259 @@
+"""
+End-to-end benchmark: starts the stand-in upstream and Macproxy (once per
+scenario), drives Macproxy with concurrent simulated clients, and reports
+throughput, latency percentiles and Macproxy's peak RSS. Needs no network.
+
+	python3 benchmarks/bench_proxy.py
+	python3 benchmarks/bench_proxy.py --scenarios macweb2 wikipedia --clients 16 --requests 2000
+	python3 benchmarks/bench_proxy.py --json before.json
+
+Compare two runs (e.g. two releases, or two config changes) on the same
+machine, since absolute numbers depend heavily on the hardware.
+"""
+
+# Standard library imports
+import argparse
+import http.client
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urljoin, urlsplit
+
+# First-party imports
+from scenarios import SCENARIOS
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMG_SRC_PATTERN = re.compile(rb"""<img[^>]+src=["']?([^"' >]+)""", re.IGNORECASE)
+MAX_IMAGES_PER_PAGE = 20
+
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+def wait_for_port(port, process, timeout=60, interval=0.1):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if process.poll() is not None:
+			raise RuntimeError(f"Process exited with status {process.returncode} before listening on port {port}")
+		try:
+			with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+				return
+		except OSError:
+			time.sleep(interval)
+	raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+def start_upstream(latency):
+	port = free_port()
+	process = subprocess.Popen(
+		[sys.executable, os.path.join(BENCHMARKS_DIR, "upstream.py"), "--port", str(port), "--latency", str(latency)],
+		stdout=subprocess.DEVNULL,
+	)
+	wait_for_port(port, process)
+	return process, f"127.0.0.1:{port}"
+
+def start_proxy(scenario, upstream_address, server, interval=0.1):
+	port = free_port()
+	process = subprocess.Popen(
+		[
+			sys.executable, os.path.join(BENCHMARKS_DIR, "run_proxy.py"),
+			"--port", str(port),
+			"--upstream", upstream_address,
+			"--server", server,
+			"--config", json.dumps(scenario.get("config", {})),
+		],
+		stdout=subprocess.PIPE,
+		text=True,
+	)
+	wait_for_port(port, process, interval=interval)
+	return process, port
+
+def stop_proxy(process):
+	"""Stop the proxy and return its peak RSS in bytes (None if unknown)."""
+	process.terminate()
+	try:
+		output, _ = process.communicate(timeout=30)
+	except subprocess.TimeoutExpired:
+		process.kill()
+		return None
+	for line in reversed(output.splitlines()):
+		if line.startswith("{"):
+			return json.loads(line).get("peak_rss_bytes")
+	return None
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return 0.0
+	# Nearest-rank
+	index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+	return sorted_values[index]
+
+
+class SimulatedClient:
+	"""
+	One browser talking to Macproxy over a persistent connection: requests a
+	page, then the images on it.
+	"""
+	def __init__(self, proxy_port, fetch_images=True):
+		self.proxy_port = proxy_port
+		self.fetch_images = fetch_images
+		self.connection = None
+
+	def request(self, method, url, form=None):
+		body = urlencode(form).encode() if form else None
+		headers = {"Host": urlsplit(url).netloc, "Accept": "*/*"}
+		if body:
+			headers["Content-Type"] = "application/x-www-form-urlencoded"
+		for attempt in range(2):
+			if self.connection is None:
+				self.connection = http.client.HTTPConnection("127.0.0.1", self.proxy_port, timeout=60)
+			try:
+				self.connection.request(method, url, body=body, headers=headers)
+				response = self.connection.getresponse()
+				data = response.read()
+				if response.will_close:
+					self.close()
+				return response.status, response.getheader("Content-Type", ""), data
+			except (http.client.HTTPException, OSError):
+				# The proxy closed a kept-alive connection; reconnect once
+				self.close()
+				if attempt:
+					raise
+
+	def close(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+	def load_page(self, url, record):
+		"""Fetch url and (for HTML) its images, calling record(latency, status) for each request."""
+		started = time.perf_counter()
+		status, content_type, body = self.request("GET", url)
+		record(time.perf_counter() - started, status)
+		if not self.fetch_images or not content_type.startswith("text/html"):
+			return
+		for src in IMG_SRC_PATTERN.findall(body)[:MAX_IMAGES_PER_PAGE]:
+			image_url = urljoin(url, src.decode("utf-8", errors="replace"))
+			if not image_url.startswith("http://"):
+				continue
+			started = time.perf_counter()
+			status, _, _ = self.request("GET", image_url)
+			record(time.perf_counter() - started, status)
+
+
+def run_load(proxy_port, urls, clients, total_requests, warmup_requests, fetch_images):
+	latencies = []
+	errors = [0]
+	lock = threading.Lock()
+	remaining = [warmup_requests + total_requests]
+
+	def record(latency, status):
+		with lock:
+			remaining[0] -= 1
+			if remaining[0] >= total_requests:
+				return  # Still warming up
+			latencies.append(latency)
+			if status >= 500:
+				errors[0] += 1
+
+	def worker(index):
+		client = SimulatedClient(proxy_port, fetch_images)
+		position = index
+		try:
+			while True:
+				with lock:
+					if remaining[0] <= 0:
+						return
+				try:
+					client.load_page(urls[position % len(urls)], record)
+				except (http.client.HTTPException, OSError):
+					with lock:
+						remaining[0] -= 1
+						errors[0] += 1
+				position += 1
+		finally:
+			client.close()
+
+	threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+	started = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.perf_counter() - started
+	return latencies, errors[0], elapsed
+
+def run_scenario(name, scenario, upstream_address, arguments):
+	process, port = start_proxy(scenario, upstream_address, arguments.server)
+	try:
+		setup_client = SimulatedClient(port, fetch_images=False)
+		for method, url, form in scenario.get("setup", []):
+			setup_client.request(method, url, form)
+		setup_client.close()
+		latencies, errors, elapsed = run_load(
+			port,
+			scenario["urls"],
+			arguments.clients,
+			arguments.requests,
+			arguments.warmup,
+			not arguments.no_images,
+		)
+	finally:
+		peak_rss = stop_proxy(process)
+
+	latencies.sort()
+	return {
+		"scenario": name,
+		"requests": len(latencies),
+		"errors": errors,
+		"seconds": round(elapsed, 3),
+		"throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+		"p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+		"p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+		"p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+		"peak_rss_mb": round(peak_rss / (1024 * 1024), 1) if peak_rss else None,
+	}
+
+def print_table(results):
+	columns = ("scenario", "requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb")
+	widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+	print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+	for result in results:
+		print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Macproxy end-to-end benchmark")
+	parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS), help="Scenarios to run (default: all)")
+	parser.add_argument("--clients", type=int, default=8, help="Concurrent simulated clients")
+	parser.add_argument("--requests", type=int, default=500, help="Measured requests per scenario")
+	parser.add_argument("--warmup", type=int, default=50, help="Requests per scenario before measuring starts")
+	parser.add_argument("--server", type=str, choices=["development", "production"], default="production", help="Server Macproxy runs with")
+	parser.add_argument("--latency", type=float, default=0.0, help="Simulated upstream latency per request, in seconds")
+	parser.add_argument("--no-images", action="store_true", help="Don't fetch the images on each page")
+	parser.add_argument("--json", type=str, help="Also write the results to this file")
+	arguments = parser.parse_args()
+
+	upstream, upstream_address = start_upstream(arguments.latency)
+	results = []
+	try:
+		for name in arguments.scenarios:
+			print(f"Running {name}...", file=sys.stderr, flush=True)
+			results.append(run_scenario(name, SCENARIOS[name], upstream_address, arguments))
+	finally:
+		upstream.terminate()
+		upstream.wait()
+
+	print_table(results)
+	if arguments.json:
+		with open(arguments.json, "w", encoding="utf-8") as f:
+			json.dump({"settings": vars(arguments), "results": results}, f, indent=2)
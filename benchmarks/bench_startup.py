@@ -0,0 +1,109 @@
+"""
+Startup benchmark: how long Macproxy takes from launch until it accepts
+connections, and how long the first requests after that take (they pay for
+whatever was left to import). Runs each mode several times against the
+stand-in upstream and reports medians. Needs no network.
+
+	python3 benchmarks/bench_startup.py
+	python3 benchmarks/bench_startup.py --runs 10 --extensions hackaday wikipedia
+
+"lazy" imports each extension on its first request (the default), "eager"
+imports every enabled extension at startup (LAZY_EXTENSIONS = False).
+"""
+
+# Standard library imports
+import argparse
+import json
+import statistics
+import sys
+import time
+
+# First-party imports
+from bench_proxy import SimulatedClient, start_upstream, start_proxy, stop_proxy
+from scenarios import SCENARIOS
+
+
+MODES = {
+	"lazy": {"LAZY_EXTENSIONS": True},
+	"eager": {"LAZY_EXTENSIONS": False},
+}
+
+# Page requested first after startup, before one page per enabled extension
+FIRST_URL = "http://news.example/"
+
+
+def extension_urls():
+	"""The first URL of each extension's scenario in scenarios.py, by extension name."""
+	urls = {}
+	for scenario in SCENARIOS.values():
+		names = scenario.get("config", {}).get("ENABLED_EXTENSIONS", [])
+		if len(names) == 1:
+			urls.setdefault(names[0], scenario["urls"][0])
+	return urls
+
+EXTENSION_URLS = extension_urls()
+
+def run_once(mode, extensions, upstream_address, server):
+	config = {**MODES[mode], "ENABLED_EXTENSIONS": extensions}
+	started = time.perf_counter()
+	process, port = start_proxy({"config": config}, upstream_address, server, interval=0.01)
+	ready = time.perf_counter() - started
+	try:
+		client = SimulatedClient(port, fetch_images=False)
+		started = time.perf_counter()
+		client.request("GET", FIRST_URL)
+		first_page = time.perf_counter() - started
+		started = time.perf_counter()
+		for url in (EXTENSION_URLS[name] for name in extensions if name in EXTENSION_URLS):
+			client.request("GET", url)
+		first_extensions = time.perf_counter() - started
+		client.close()
+	finally:
+		peak_rss = stop_proxy(process)
+	return ready, first_page, first_extensions, peak_rss
+
+def run_mode(mode, extensions, upstream_address, arguments):
+	runs = [run_once(mode, extensions, upstream_address, arguments.server) for _ in range(arguments.runs)]
+	ready, first_page, first_extensions, peak_rss = zip(*runs)
+	peak_rss = [rss for rss in peak_rss if rss]
+	return {
+		"mode": mode,
+		"runs": len(runs),
+		"ready_ms": round(statistics.median(ready) * 1000, 1),
+		"first_page_ms": round(statistics.median(first_page) * 1000, 1),
+		"first_extension_pages_ms": round(statistics.median(first_extensions) * 1000, 1),
+		"peak_rss_mb": round(statistics.median(peak_rss) / (1024 * 1024), 1) if peak_rss else None,
+	}
+
+def print_table(results):
+	columns = ("mode", "runs", "ready_ms", "first_page_ms", "first_extension_pages_ms", "peak_rss_mb")
+	widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+	print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+	for result in results:
+		print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Macproxy startup benchmark")
+	parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=list(MODES), help="Modes to run (default: all)")
+	parser.add_argument("--runs", type=int, default=5, help="Startups per mode")
+	parser.add_argument("--extensions", nargs="+", help="Extensions to enable (default: every extension with a scenario in scenarios.py)")
+	parser.add_argument("--server", type=str, choices=["development", "production"], default="production", help="Server Macproxy runs with")
+	parser.add_argument("--json", type=str, help="Also write the results to this file")
+	arguments = parser.parse_args()
+
+	extensions = arguments.extensions or sorted(EXTENSION_URLS)
+	upstream, upstream_address = start_upstream(0.0)
+	results = []
+	try:
+		for mode in arguments.modes:
+			print(f"Running {mode}...", file=sys.stderr, flush=True)
+			results.append(run_mode(mode, extensions, upstream_address, arguments))
+	finally:
+		upstream.terminate()
+		upstream.wait()
+
+	print_table(results)
+	if arguments.json:
+		with open(arguments.json, "w", encoding="utf-8") as f:
+			json.dump({"settings": vars(arguments), "extensions": extensions, "results": results}, f, indent=2)
@@ -0,0 +1,133 @@
+"""
+Run proxy.py for a benchmark: with a config built from config.py.example
+plus the scenario's settings (instead of your config.py), and with every
+upstream request the proxy or its extensions make sent to the stand-in
+upstream instead of the internet.
+
+Converted images go to a temporary directory, removed on exit, so runs
+neither use nor clear the image cache in utils/cached_images.
+
+Started by bench_proxy.py; on SIGTERM it prints its peak RSS as JSON.
+"""
+
+# Standard library imports
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import types
+from urllib.parse import urlsplit, urlunsplit
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings every benchmark run uses on top of config.py.example
+BENCHMARK_SETTINGS = {
+	"LOG_LEVEL": "WARNING",
+	"ACCESS_LOG": False,
+	# Keep the response cache in memory, so runs don't share (or leave behind) a disk cache
+	"RESPONSE_CACHE_DISK_BYTES": 0,
+	"ZIP_CODE": "24060",
+	"KAGI_SESSION_TOKEN": "benchmark",
+}
+
+
+def build_config(overrides):
+	"""A `config` module made from config.py.example and the given overrides."""
+	config = types.ModuleType("config")
+	config.__file__ = os.path.join(ROOT_DIR, "config.py.example")
+	with open(config.__file__, encoding="utf-8") as f:
+		exec(compile(f.read(), config.__file__, "exec"), config.__dict__)
+	for key, value in {**BENCHMARK_SETTINGS, **overrides}.items():
+		setattr(config, key, value)
+	return config
+
+def use_temporary_image_cache(config):
+	"""Point the image cache at a new temporary directory, before proxy.py prepares it; returns the directory."""
+	# First-party imports
+	from utils import image_utils
+	from utils.cache_utils import DiskLRU
+
+	cache_dir = tempfile.mkdtemp(prefix="macproxy-bench-images-")
+	image_utils.CACHE_DIR = cache_dir
+	image_utils.CACHE_MANIFEST_PATH = os.path.join(cache_dir, "manifest.json")
+	image_utils.image_cache = DiskLRU(
+		cache_dir,
+		max_bytes=getattr(config, 'IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+		max_files=getattr(config, 'IMAGE_CACHE_MAX_FILES', 50000),
+		interval=getattr(config, 'IMAGE_CACHE_JANITOR_INTERVAL', 60),
+	)
+	return cache_dir
+
+def peak_rss_bytes():
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Kilobytes on Linux, bytes on macOS
+	return peak if sys.platform == "darwin" else peak * 1024
+
+def route_to_stand_in(session, address):
+	"""Send every request made through session to the stand-in upstream."""
+	# Third-party imports
+	from requests.adapters import HTTPAdapter
+
+	class StandInAdapter(HTTPAdapter):
+		def send(self, request, **kwargs):
+			original_url = request.url
+			parts = urlsplit(original_url)
+			request.headers["Host"] = parts.netloc
+			request.url = urlunsplit(("http", address, parts.path or "/", parts.query, ""))
+			response = super().send(request, **kwargs)
+			# Redirects are resolved against the URL the caller asked for
+			response.url = original_url
+			return response
+
+	adapter = StandInAdapter(pool_connections=32, pool_maxsize=64)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run Macproxy against the stand-in upstream")
+	parser.add_argument("--port", type=int, required=True, help="Port Macproxy listens on")
+	parser.add_argument("--upstream", type=str, required=True, help="host:port of the stand-in upstream")
+	parser.add_argument("--server", type=str, choices=["development", "production"], default="production")
+	parser.add_argument("--config", type=str, default="{}", help="JSON object of config.py settings to override")
+	arguments = parser.parse_args()
+
+	os.chdir(ROOT_DIR)
+	sys.path.insert(0, ROOT_DIR)
+	config = sys.modules["config"] = build_config(json.loads(arguments.config))
+
+	# First-party imports (after the benchmark config is in place)
+	from utils.http_utils import session
+	route_to_stand_in(session, arguments.upstream)
+	image_cache_dir = use_temporary_image_cache(config)
+	import proxy
+
+	def report_and_exit(signum, frame):
+		print(json.dumps({"peak_rss_bytes": peak_rss_bytes()}), flush=True)
+		shutil.rmtree(image_cache_dir, ignore_errors=True)
+		os._exit(0)
+
+	signal.signal(signal.SIGTERM, report_and_exit)
+
+	proxy.app.config['MACPROXY_HOST_AND_PORT'] = f"127.0.0.1:{arguments.port}"
+	if arguments.server == "production":
+		from utils.server_utils import run_production_server
+		run_production_server(
+			proxy.app,
+			"127.0.0.1",
+			arguments.port,
+			workers=config.SERVER_WORKERS,
+			backlog=config.SERVER_BACKLOG,
+			queue_size=config.SERVER_QUEUE_SIZE,
+			keep_alive_timeout=config.KEEP_ALIVE_TIMEOUT,
+			max_keep_alive_requests=config.MAX_KEEP_ALIVE_REQUESTS,
+		)
+	else:
+		proxy.app.run(host="127.0.0.1", port=arguments.port, debug=False, threaded=True)
@@ -0,0 +1,103 @@
+"""
+Benchmark scenarios: which config.py settings Macproxy runs with, and which
+pages the simulated clients request. Every URL must be answerable from
+corpus/manifest.json. Images referenced by the returned pages are fetched
+too, as a browser would.
+"""
+
+# Pages of the generic (non-extension) corpus
+GENERIC_URLS = [
+	"http://news.example/",
+	"http://news.example/2024/05/classic-macs-return.html",
+	"http://wiki.example/wiki/Macintosh_Plus",
+	"http://blog.example/",
+	"http://blog.example/css/site.css",
+	"http://blog.example/posts/restoring-an-se30.html",
+]
+
+SCENARIOS = {
+	# Presets
+	"macweb2": {
+		"config": {"PRESET": "macweb2"},
+		"urls": GENERIC_URLS,
+	},
+	"wii_internet_channel": {
+		"config": {"PRESET": "wii_internet_channel"},
+		"urls": GENERIC_URLS,
+	},
+
+	# Extensions that reach the stand-in upstream through the shared session
+	"hackaday": {
+		"config": {"ENABLED_EXTENSIONS": ["hackaday"]},
+		"urls": [
+			"http://hackaday.com/",
+			"http://hackaday.com/2024/05/01/a-classic-mac-on-the-modern-web/",
+		],
+	},
+	"hacksburg": {
+		"config": {"ENABLED_EXTENSIONS": ["hacksburg"]},
+		"urls": [
+			"http://hacksburg.org/",
+			"http://hacksburg.org/about",
+		],
+	},
+	"hunterirving": {
+		"config": {"ENABLED_EXTENSIONS": ["hunterirving"]},
+		"urls": [
+			"http://hunterirving.com/gobbler",
+		],
+	},
+	"npr": {
+		"config": {"ENABLED_EXTENSIONS": ["npr"]},
+		"urls": [
+			"http://npr.org/",
+			"http://npr.org/nx-s1-5000001",
+		],
+	},
+	"reddit": {
+		"config": {"ENABLED_EXTENSIONS": ["reddit"]},
+		"urls": [
+			"http://reddit.com/r/VintageApple/",
+			"http://reddit.com/r/VintageApple/comments/1abcde/my_se30_is_online_again/",
+		],
+	},
+	"waybackmachine": {
+		"config": {"ENABLED_EXTENSIONS": ["waybackmachine"]},
+		# Turn on the override once, so every following request goes through the archive
+		"setup": [("POST", "http://web.archive.org/", {"action": "enable"})],
+		"urls": [
+			"http://www.apple.com/",
+		],
+	},
+	"weather": {
+		"config": {"ENABLED_EXTENSIONS": ["weather"]},
+		"urls": [
+			"http://weather.gov/",
+			"http://weather.gov/24060",
+		],
+	},
+	"wiby": {
+		"config": {"ENABLED_EXTENSIONS": ["wiby"]},
+		"urls": [
+			"http://wiby.me/",
+			"http://wiby.me/?q=macintosh",
+		],
+	},
+	"wikipedia": {
+		"config": {"ENABLED_EXTENSIONS": ["wikipedia"]},
+		"urls": [
+			"http://wikipedia.org/",
+			"http://en.wikipedia.org/wiki/Macintosh_Plus",
+		],
+	},
+	"override": {
+		"config": {"ENABLED_EXTENSIONS": ["override"]},
+		"urls": [
+			"http://override.test/",
+		],
+	},
+}
+
+# Extensions left out: they need a live account or a vendor API that a stand-in
+# upstream can't answer for (chatgpt, claude, gemini, mistral, websimulator, kagi),
+# or serve local video files (notyoutube).
@@ -0,0 +1,167 @@
+"""
+Stand-in upstream for the benchmarks: serves the recorded corpus in
+benchmarks/corpus for whatever host a request is addressed to (the Host
+header), so the proxy and its extensions can be driven with no network.
+
+Run it on its own to browse the corpus through a running Macproxy:
+	python3 benchmarks/upstream.py --port 8081
+"""
+
+# Standard library imports
+import argparse
+import io
+import json
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Third-party imports
+from PIL import Image
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+MANIFEST_PATH = os.path.join(CORPUS_DIR, "manifest.json")
+
+IMAGE_CONTENT_TYPES = {
+	"JPEG": "image/jpeg",
+	"PNG": "image/png",
+	"GIF": "image/gif",
+	"WEBP": "image/webp",
+}
+
+NOT_FOUND_BODY = b"<html><head><title>Not Found</title></head><body><h1>Not Found</h1></body></html>"
+
+
+def load_manifest(path=MANIFEST_PATH):
+	with open(path, encoding="utf-8") as f:
+		return json.load(f)["responses"]
+
+def entry_key(url):
+	"""(host, path?query) for a corpus URL; the scheme is ignored."""
+	parts = urlsplit(url)
+	path = parts.path or "/"
+	return parts.netloc.lower(), f"{path}?{parts.query}" if parts.query else path
+
+def render_image(width, height, image_format="JPEG", mode="RGB"):
+	"""
+	A deterministic, photo-like test image: smooth gradients plus noise, so
+	it compresses and dithers roughly like a real photograph would.
+	"""
+	red = Image.linear_gradient("L").resize((width, height))
+	green = Image.radial_gradient("L").resize((width, height))
+	blue = Image.effect_noise((width, height), 48)
+	img = Image.merge("RGB", (red, green, blue))
+	if mode == "RGBA":
+		img.putalpha(Image.radial_gradient("L").resize((width, height)).point(lambda v: 255 - v))
+	elif mode == "P":
+		img = img.convert("P", palette=Image.Palette.ADAPTIVE, colors=64)
+	output = io.BytesIO()
+	img.save(output, format=image_format, quality=85)
+	return output.getvalue()
+
+
+class Corpus:
+	"""The manifest's responses, loaded into memory and indexed by host and path."""
+	def __init__(self, manifest=None, corpus_dir=CORPUS_DIR):
+		self.exact = {}
+		self.prefixes = []
+		for entry in manifest if manifest is not None else load_manifest():
+			response = self._build(entry, corpus_dir)
+			host, path = entry_key(entry["url"])
+			if entry.get("prefix"):
+				self.prefixes.append((host, path, response))
+			else:
+				self.exact[(host, path)] = response
+		# Longest prefix first
+		self.prefixes.sort(key=lambda item: len(item[1]), reverse=True)
+
+	@staticmethod
+	def _build(entry, corpus_dir):
+		headers = dict(entry.get("headers", {}))
+		if "image" in entry:
+			spec = entry["image"]
+			image_format = spec.get("format", "JPEG")
+			body = render_image(spec["width"], spec["height"], image_format, spec.get("mode", "RGB"))
+			headers.setdefault("Content-Type", IMAGE_CONTENT_TYPES[image_format])
+		elif "file" in entry:
+			with open(os.path.join(corpus_dir, entry["file"]), "rb") as f:
+				body = f.read()
+			headers.setdefault("Content-Type", entry.get("content_type", "text/html; charset=utf-8"))
+		else:
+			body = b""
+		return entry.get("status", 200), headers, body
+
+	def lookup(self, host, path):
+		host = host.lower()
+		response = self.exact.get((host, path))
+		if response is None and "?" in path:
+			response = self.exact.get((host, path.split("?", 1)[0]))
+		if response is None:
+			for prefix_host, prefix, prefix_response in self.prefixes:
+				if prefix_host == host and path.startswith(prefix):
+					return prefix_response
+		return response
+
+
+def make_handler(corpus, latency=0.0):
+	class StandInHandler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def do_GET(self):
+			self.respond(include_body=True)
+
+		def do_POST(self):
+			length = int(self.headers.get("Content-Length") or 0)
+			if length:
+				self.rfile.read(length)
+			self.respond(include_body=True)
+
+		def do_HEAD(self):
+			self.respond(include_body=False)
+
+		def respond(self, include_body):
+			if latency:
+				# Simulated network round trip, +/- 50%
+				time.sleep(latency * random.uniform(0.5, 1.5))
+			host = (self.headers.get("Host") or "").split(":")[0]
+			response = corpus.lookup(host, self.path)
+			if response is None:
+				status, headers, body = 404, {"Content-Type": "text/html"}, NOT_FOUND_BODY
+			else:
+				status, headers, body = response
+			self.send_response(status)
+			for key, value in headers.items():
+				self.send_header(key, value)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			if include_body:
+				self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	return StandInHandler
+
+def serve(host="127.0.0.1", port=0, latency=0.0, corpus=None):
+	"""Start serving the corpus in the current thread; returns the server."""
+	server = ThreadingHTTPServer((host, port), make_handler(corpus or Corpus(), latency))
+	server.daemon_threads = True
+	return server
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serve the benchmark corpus")
+	parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+	parser.add_argument("--port", type=int, default=8081, help="Port to listen on (0 picks a free one)")
+	parser.add_argument("--latency", type=float, default=0.0, help="Simulated network latency per request, in seconds")
+	arguments = parser.parse_args()
+
+	server = serve(arguments.host, arguments.port, arguments.latency)
+	# The benchmark runner reads the port from this line
+	print(f"Serving benchmark corpus on {server.server_address[0]}:{server.server_address[1]}", flush=True)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -1,15 +1,16 @@
 from flask import request, render_template_string
 from openai import OpenAI
 import config
+from utils.deadline_utils import bounded_timeout, check_deadline
+from utils.state_utils import get_client_state
 
 # Initialize the OpenAI client with your API key
 client = OpenAI(api_key=config.OPEN_AI_API_KEY)
 
 DOMAIN = "chat.com"
+REQUEST_DEADLINE = 120
 
-messages = []
-selected_model = "gpt-5.4"
-previous_model = selected_model
+DEFAULT_MODEL = "gpt-5.4"
 
 system_prompts = [
 	{"role": "system", "content": "Please provide your response in plain text using only ASCII characters. "
@@ -76,35 +77,44 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	state = get_client_state(__name__, messages=[], selected_model=DEFAULT_MODEL, previous_model=DEFAULT_MODEL)
 	output = ""
 
-	if request.method == 'POST':
-		user_input = request.form['command']
-		selected_model = request.form['model']
+	# Hold this client's lock so concurrent requests can't interleave its history
+	with state.lock:
+		if request.method == 'POST':
+			user_input = request.form['command']
+			state.selected_model = request.form['model']
 
-		# Check if the model has changed
-		if selected_model != previous_model:
-			previous_model = selected_model
-			messages = [{"role": "user", "content": user_input}]
-		else:
-			messages.append({"role": "user", "content": user_input})
+			# Check if the model has changed
+			if state.selected_model != state.previous_model:
+				state.previous_model = state.selected_model
+				state.messages = [{"role": "user", "content": user_input}]
+			else:
+				state.messages.append({"role": "user", "content": user_input})
 
-		# Prepare messages, ensuring not to exceed the most recent 10 interactions
-		messages_to_send = system_prompts + messages[-10:]
+			# Prepare messages, ensuring not to exceed the most recent 10 interactions
+			messages_to_send = system_prompts + state.messages[-10:]
 
-		# Send the messages to OpenAI and get the response
-		response = client.chat.completions.create(
-			model=selected_model,
-			messages=messages_to_send
-		)
-		response_body = response.choices[0].message.content
-		messages.append({"role": "assistant", "content": response_body})
+			# Send the messages to OpenAI and get the response, within the
+			# request's deadline (a retry would get the whole timeout again)
+			timeout = bounded_timeout(REQUEST_DEADLINE, "ChatGPT request")
+			try:
+				response = client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+					model=state.selected_model,
+					messages=messages_to_send
+				)
+			except Exception:
+				# Out of time rather than failed: answered with the timed-out page
+				check_deadline("ChatGPT request")
+				raise
+			response_body = response.choices[0].message.content
+			state.messages.append({"role": "assistant", "content": response_body})
 
-	for msg in reversed(messages[-10:]):
-		if msg['role'] == 'user':
-			output += f"<b>User:</b> {msg['content']}<br>"
-		elif msg['role'] == 'assistant':
-			output += f"<b>ChatGPT:</b> {msg['content']}<br>"
+		for msg in reversed(state.messages[-10:]):
+			if msg['role'] == 'user':
+				output += f"<b>User:</b> {msg['content']}<br>"
+			elif msg['role'] == 'assistant':
+				output += f"<b>ChatGPT:</b> {msg['content']}<br>"
 
-	return render_template_string(HTML_TEMPLATE, output=output, selected_model=selected_model)
+	return render_template_string(HTML_TEMPLATE, output=output, selected_model=state.selected_model)
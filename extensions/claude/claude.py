@@ -1,15 +1,19 @@
 from flask import request, render_template_string
 import anthropic
 import config
+import logging
+from utils.deadline_utils import DeadlineExceeded, bounded_timeout, check_deadline
+from utils.state_utils import get_client_state
+
+logger = logging.getLogger(__name__)
 
 # Initialize the Anthropic client with your API key
 client = anthropic.Anthropic(api_key=config.ANTHROPIC_API_KEY)
 
 DOMAIN = "claude.ai"
+REQUEST_DEADLINE = 120
 
-messages = []
-selected_model = "claude-opus-4-6"
-previous_model = selected_model
+DEFAULT_MODEL = "claude-opus-4-6"
 
 system_prompt = """Please provide your response in plain text using only ASCII characters. 
 Never use any special or esoteric characters that might not be supported by older systems.
@@ -69,43 +73,51 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	state = get_client_state(__name__, messages=[], selected_model=DEFAULT_MODEL, previous_model=DEFAULT_MODEL)
 	output = ""
 
-	if request.method == 'POST':
-		user_input = request.form['command']
-		selected_model = request.form['model']
-
-		# Check if the model has changed
-		if selected_model != previous_model:
-			previous_model = selected_model
-			messages = [{"role": "user", "content": user_input}]
-		else:
-			messages.append({"role": "user", "content": user_input})
-
-		# Prepare messages for the API call
-		api_messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages[-10:]]
-
-		# Send the conversation to Anthropic and get the response
-		try:
-			response = client.messages.create(
-				model=selected_model,
-				max_tokens=1000,
-				messages=api_messages,
-				system=system_prompt
-			)
-			response_body = response.content[0].text
-			messages.append({"role": "assistant", "content": response_body})
-			print(response_body)
-
-		except Exception as e:
-			response_body = f"An error occurred: {str(e)}"
-			messages.append({"role": "assistant", "content": response_body})
-
-	for msg in reversed(messages[-10:]):
-		if msg['role'] == 'user':
-			output += f"<b>User:</b> {msg['content']}<br>"
-		elif msg['role'] == 'assistant':
-			output += f"<b>Claude:</b> {msg['content']}<br>"
-
-	return render_template_string(HTML_TEMPLATE, output=output, selected_model=selected_model)
+	# Hold this client's lock so concurrent requests can't interleave its history
+	with state.lock:
+		if request.method == 'POST':
+			user_input = request.form['command']
+			state.selected_model = request.form['model']
+
+			# Check if the model has changed
+			if state.selected_model != state.previous_model:
+				state.previous_model = state.selected_model
+				state.messages = [{"role": "user", "content": user_input}]
+			else:
+				state.messages.append({"role": "user", "content": user_input})
+
+			# Prepare messages for the API call
+			api_messages = [{"role": msg["role"], "content": msg["content"]} for msg in state.messages[-10:]]
+
+			# Send the conversation to Anthropic and get the response, within
+			# the request's deadline (a retry would get the whole timeout again)
+			try:
+				timeout = bounded_timeout(REQUEST_DEADLINE, "Claude request")
+				response = client.with_options(timeout=timeout, max_retries=0).messages.create(
+					model=state.selected_model,
+					max_tokens=1000,
+					messages=api_messages,
+					system=system_prompt
+				)
+				response_body = response.content[0].text
+				state.messages.append({"role": "assistant", "content": response_body})
+				logger.debug(response_body)
+
+			except DeadlineExceeded:
+				raise
+			except Exception as e:
+				# Out of time rather than failed: answered with the timed-out page
+				check_deadline("Claude request")
+				response_body = f"An error occurred: {str(e)}"
+				state.messages.append({"role": "assistant", "content": response_body})
+
+		for msg in reversed(state.messages[-10:]):
+			if msg['role'] == 'user':
+				output += f"<b>User:</b> {msg['content']}<br>"
+			elif msg['role'] == 'assistant':
+				output += f"<b>Claude:</b> {msg['content']}<br>"
+
+	return render_template_string(HTML_TEMPLATE, output=output, selected_model=state.selected_model)
@@ -2,15 +2,16 @@ from flask import request, render_template_string
 from google import genai
 from google.genai import types
 import config
+from utils.deadline_utils import DeadlineExceeded, bounded_timeout, check_deadline
+from utils.state_utils import get_client_state
 
 # Initialize the Google API Client with your API key
 client = genai.Client(api_key=config.GEMINI_API_KEY)
 
 DOMAIN = "gemini.google.com"
+REQUEST_DEADLINE = 120
 
-messages = []
-selected_model = "gemini-3-flash-preview"
-previous_model = selected_model
+DEFAULT_MODEL = "gemini-3-flash-preview"
 
 system_prompt = """Please provide your response in plain text using only ASCII characters. 
 Never use any special or esoteric characters that might not be supported by older systems.
@@ -40,13 +41,15 @@ HTML_TEMPLATE = """
 </html>
 """
 
-def get_generation_config():
+def get_generation_config(timeout):
 	return types.GenerateContentConfig(
 		temperature=1,
 		top_p=0.95,
 		top_k=40,
 		max_output_tokens=8192,
-		system_instruction=system_prompt
+		system_instruction=system_prompt,
+		# In milliseconds
+		http_options=types.HttpOptions(timeout=int(timeout * 1000))
 	)
 
 def handle_request(req):
@@ -65,54 +68,62 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	state = get_client_state(__name__, messages=[], selected_model=DEFAULT_MODEL, previous_model=DEFAULT_MODEL)
 	output = ""
+
+	# Hold this client's lock so concurrent requests can't interleave its history
+	with state.lock:
 	
-	if request.method == 'POST':
-		user_input = request.form['command']
-		selected_model = request.form['model']
+		if request.method == 'POST':
+			user_input = request.form['command']
+			state.selected_model = request.form['model']
 
-		# Reset chat if model changes
-		if selected_model != previous_model:
-			messages = []
-			previous_model = selected_model
+			# Reset chat if model changes
+			if state.selected_model != state.previous_model:
+				state.messages = []
+				state.previous_model = state.selected_model
 		
-		try:
-			# Create content list starting with user input
-			current_message = {"text": user_input}
-			contents = [{"role": "user", "parts": [current_message]}]
+			try:
+				# Create content list starting with user input
+				current_message = {"text": user_input}
+				contents = [{"role": "user", "parts": [current_message]}]
 			
-			# Add previous messages to maintain context
-			if messages:
-				history_contents = []
-				for msg in messages:
-					history_contents.append({
-						"role": msg["role"],
-						"parts": [{"text": msg["content"]}]
-					})
-				contents = history_contents + contents
+				# Add previous messages to maintain context
+				if state.messages:
+					history_contents = []
+					for msg in state.messages:
+						history_contents.append({
+							"role": msg["role"],
+							"parts": [{"text": msg["content"]}]
+						})
+					contents = history_contents + contents
 			
-			# Generate response
-			response = client.models.generate_content(
-				model=selected_model,
-				contents=contents,
-				config=get_generation_config()
-			)
+				# Generate response, within the request's deadline
+				timeout = bounded_timeout(REQUEST_DEADLINE, "Gemini request")
+				response = client.models.generate_content(
+					model=state.selected_model,
+					contents=contents,
+					config=get_generation_config(timeout)
+				)
 			
-			# Add messages to history
-			messages.append({"role": "user", "content": user_input})
-			messages.append({"role": "model", "content": response.text})
+				# Add messages to history
+				state.messages.append({"role": "user", "content": user_input})
+				state.messages.append({"role": "model", "content": response.text})
 			
-		except Exception as e:
-			error_message = f"Error: {str(e)}"
-			messages.append({"role": "user", "content": user_input})
-			messages.append({"role": "assistant", "content": error_message})
-	
-	# Generate output HTML
-	for msg in reversed(messages[-10:]):
-		if msg['role'] == 'user':
-			output += f"<b>User:</b> {msg['content']}<br>"
-		elif msg['role'] == 'model' or msg['role'] == 'assistant':
-			output += f"<b>Assistant:</b> {msg['content']}<br>"
+			except DeadlineExceeded:
+				raise
+			except Exception as e:
+				# Out of time rather than failed: answered with the timed-out page
+				check_deadline("Gemini request")
+				error_message = f"Error: {str(e)}"
+				state.messages.append({"role": "user", "content": user_input})
+				state.messages.append({"role": "assistant", "content": error_message})
 	
-	return render_template_string(HTML_TEMPLATE, output=output, selected_model=selected_model)
+		# Generate output HTML
+		for msg in reversed(state.messages[-10:]):
+			if msg['role'] == 'user':
+				output += f"<b>User:</b> {msg['content']}<br>"
+			elif msg['role'] == 'model' or msg['role'] == 'assistant':
+				output += f"<b>Assistant:</b> {msg['content']}<br>"
+
+	return render_template_string(HTML_TEMPLATE, output=output, selected_model=state.selected_model)
@@ -1,7 +1,7 @@
 ''' WARNING ! This module is (perhaps appropriately) very hacky. Avert your gaze... '''
 
 from flask import request, redirect, render_template_string
-import requests
+from utils.http_utils import session
 from bs4 import BeautifulSoup, Comment
 from datetime import datetime
 import re
@@ -574,7 +574,7 @@ fresh hacks every day                 /___/
 def handle_get(req):
 	url = f"https://hackaday.com{req.path}"
 	try:
-		response = requests.get(url)
+		response = session.get(url)
 		processed_content = process_html(response.text, url)
 		return processed_content, response.status_code
 	except Exception as e:
@@ -591,7 +591,7 @@ def handle_request(req):
 				url += f"?{req.query_string.decode('utf-8')}"
 		
 		try:
-			response = requests.get(url)
+			response = session.get(url)
 			processed_content = process_html(response.text, url)
 			return processed_content, response.status_code
 		except Exception as e:
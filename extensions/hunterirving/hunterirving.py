@@ -1,5 +1,6 @@
 from flask import request
-import requests
+from requests import RequestException
+from utils.http_utils import session
 from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
 import mimetypes
@@ -31,7 +32,7 @@ def handle_request(req):
 	if req.host == DOMAIN:
 		url = f"https://{DOMAIN}{req.path}"
 		try:
-			response = requests.get(url)
+			response = session.get(url)
 			response.raise_for_status()  # Raise an exception for bad status codes
 			
 			# Check if the content is an image	
@@ -142,7 +143,7 @@ def handle_request(req):
 			
 			return modified_html, response.status_code
 
-		except requests.RequestException as e:
+		except RequestException as e:
 			return f"Error: {str(e)}", 500
 		except Exception as e:
 			return f"Error: {str(e)}", 500
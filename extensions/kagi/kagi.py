@@ -1,8 +1,8 @@
 from flask import render_template_string
-import requests
+from utils.http_utils import session
 from bs4 import BeautifulSoup
 import config
-from utils.image_utils import is_image_url
+from utils.image_utils import is_image_url, fetch_and_cache_image, send_cached_image
 import os
 import math
 from urllib.parse import urlencode
@@ -36,7 +36,7 @@ def handle_request(req):
 		args[key] = value
 
 	try:
-		response = requests.request(req.method, url, params=args)
+		response = session.request(req.method, url, params=args)
 		response.encoding = response.apparent_encoding
 
 		soup = BeautifulSoup(response.text, 'html.parser')
@@ -190,14 +190,14 @@ def parse_news_results(soup):
 
 def handle_image_request(req):
 	try:
-		response = requests.get(req.url, params=req.args)
+		response = session.get(req.url, params=req.args)
 		return response.content, response.status_code, response.headers
 	except Exception as e:
 		return f"Error: {str(e)}", 500
 
 	cached_url = fetch_and_cache_image(req.url)
 	if cached_url:
-		return send_from_directory(CACHE_DIR, os.path.basename(cached_url), mimetype='image/gif')
+		return send_cached_image(cached_url)
 	else:
 		return abort(404, "Image not found or could not be processed")
 
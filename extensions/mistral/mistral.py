@@ -1,15 +1,16 @@
 from flask import request, render_template_string
 from mistralai.client import Mistral
 import config
+from utils.deadline_utils import DeadlineExceeded, bounded_timeout, check_deadline
+from utils.state_utils import get_client_state
 
 # Initialize the Mistral Client with your API key
 client = Mistral(api_key=config.MISTRAL_API_KEY)
 
 DOMAIN = "chat.mistral.ai"
+REQUEST_DEADLINE = 120
 
-messages = []
-selected_model = "mistral-large-latest"
-previous_model = selected_model
+DEFAULT_MODEL = "mistral-large-latest"
 
 system_prompt = """Please provide your response in plain text using only ASCII characters. 
 Never use any special or esoteric characters that might not be supported by older systems.
@@ -63,41 +64,50 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	state = get_client_state(__name__, messages=[], selected_model=DEFAULT_MODEL, previous_model=DEFAULT_MODEL)
 	output = ""
 
-	if request.method == 'POST':
-		user_input = request.form['command']
-		selected_model = request.form['model']
-
-		# Check if the model has changed
-		if selected_model != previous_model:
-			previous_model = selected_model
-			messages = [{"role": "user", "content": user_input}]
-		else:
-			messages.append({"role": "user", "content": user_input})
-
-		# Prepare messages for the API call
-		api_messages = [{"role": msg["role"], "content": (system_prompt + msg["content"]) if msg["role"] == "user" and i < 2 else msg["content"]} for i, msg in enumerate(messages[-10:])]
-
-		# Send the conversation to Mistral La Plateforme and get the response
-		try:
-			response = client.chat.complete(
-				model=selected_model,
-				max_tokens=1000,
-				messages=api_messages,
-			)
-			response_body = response.choices[0].message.content
-			messages.append({"role": "assistant", "content": response_body})
-
-		except Exception as e:
-			response_body = f"An error occurred: {str(e)}"
-			messages.append({"role": "assistant", "content": response_body})
-
-	for msg in reversed(messages[-10:]):
-		if msg['role'] == 'user':
-			output += f"<b>User:</b> {msg['content']}<br>"
-		elif msg['role'] == 'assistant':
-			output += f"<b>Mistral:</b> {msg['content']}<br>"
-
-	return render_template_string(HTML_TEMPLATE, output=output, selected_model=selected_model)
\ No newline at end of file
+	# Hold this client's lock so concurrent requests can't interleave its history
+	with state.lock:
+		if request.method == 'POST':
+			user_input = request.form['command']
+			state.selected_model = request.form['model']
+
+			# Check if the model has changed
+			if state.selected_model != state.previous_model:
+				state.previous_model = state.selected_model
+				state.messages = [{"role": "user", "content": user_input}]
+			else:
+				state.messages.append({"role": "user", "content": user_input})
+
+			# Prepare messages for the API call
+			api_messages = [{"role": msg["role"], "content": (system_prompt + msg["content"]) if msg["role"] == "user" and i < 2 else msg["content"]} for i, msg in enumerate(state.messages[-10:])]
+
+			# Send the conversation to Mistral La Plateforme and get the response,
+			# within the request's deadline
+			try:
+				timeout = bounded_timeout(REQUEST_DEADLINE, "Mistral request")
+				response = client.chat.complete(
+					model=state.selected_model,
+					max_tokens=1000,
+					messages=api_messages,
+					timeout_ms=int(timeout * 1000),
+				)
+				response_body = response.choices[0].message.content
+				state.messages.append({"role": "assistant", "content": response_body})
+
+			except DeadlineExceeded:
+				raise
+			except Exception as e:
+				# Out of time rather than failed: answered with the timed-out page
+				check_deadline("Mistral request")
+				response_body = f"An error occurred: {str(e)}"
+				state.messages.append({"role": "assistant", "content": response_body})
+
+		for msg in reversed(state.messages[-10:]):
+			if msg['role'] == 'user':
+				output += f"<b>User:</b> {msg['content']}<br>"
+			elif msg['role'] == 'assistant':
+				output += f"<b>Mistral:</b> {msg['content']}<br>"
+
+	return render_template_string(HTML_TEMPLATE, output=output, selected_model=state.selected_model)
\ No newline at end of file
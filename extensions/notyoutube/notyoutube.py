@@ -2,6 +2,7 @@
 
 import os
 import json
+import logging
 import random
 import string
 import subprocess
@@ -9,6 +10,8 @@ from flask import request, send_file, render_template_string
 from urllib.parse import urlparse, parse_qs
 import config
 
+logger = logging.getLogger(__name__)
+
 DOMAIN = "notyoutube.com"
 EXTENSION_DIR = os.path.dirname(os.path.abspath(__file__))
 JSON_FILE_PATH = os.path.join(EXTENSION_DIR, "videos.json")
@@ -30,10 +33,10 @@ def load_recommended_videos():
 			data = json.load(json_file)
 			return data
 	except FileNotFoundError:
-		print(f"Error: {JSON_FILE_PATH} not found.")
+		logger.error("%s not found.", JSON_FILE_PATH)
 		return []
 	except json.JSONDecodeError:
-		print(f"Error: Invalid JSON in {JSON_FILE_PATH}.")
+		logger.error("Invalid JSON in %s.", JSON_FILE_PATH)
 		return []
 
 RECOMMENDED_VIDEOS = load_recommended_videos()
@@ -1,5 +1,5 @@
 from flask import request, redirect
-import requests
+from utils.http_utils import session
 from bs4 import BeautifulSoup
 
 DOMAIN = "npr.org"
@@ -13,7 +13,7 @@ DOMAIN = "npr.org"
 def handle_get(req):
 	url = f"https://text.npr.org{req.path}"
 	try:
-		response = requests.get(url)
+		response = session.get(url)
 
 		# Parse the HTML and remove the <header> tag
 		soup = BeautifulSoup(response.text, 'html.parser')
@@ -1,4 +1,5 @@
 from flask import request, render_template_string
+from utils.state_utils import get_client_state
 
 DOMAIN = "override.test"
 
@@ -22,27 +23,27 @@ HTML_TEMPLATE = """
 </html>
 """
 
-override_active = False
+def get_state():
+	return get_client_state(__name__, override_active=False)
 
 def get_override_status():
-	global override_active
-	return override_active
+	return get_state().override_active
 
 def handle_request(req):
-	global override_active
+	state = get_state()
 
 	if req.method == 'POST':
 		action = req.form.get('action')
 		if action == 'Enable Override':
-			override_active = True
+			state.override_active = True
 		elif action == 'Disable Override':
-			override_active = False
+			state.override_active = False
 
-	status = "Override Active" if override_active else "Override Inactive"
+	status = "Override Active" if state.override_active else "Override Inactive"
 	
-	requested_url = req.url if override_active else ""
+	requested_url = req.url if state.override_active else ""
 
 	return render_template_string(HTML_TEMPLATE, 
 								  status=status, 
-								  override_active=override_active,
+								  override_active=state.override_active,
 								  requested_url=requested_url)
\ No newline at end of file
@@ -1,4 +1,4 @@
-import requests
+from requests import RequestException
 from bs4 import BeautifulSoup
 from flask import Response
 import io
@@ -8,9 +8,9 @@ import hashlib
 import os
 import shutil
 import mimetypes
+from utils.http_utils import session
 
 DOMAIN = "reddit.com"
-USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
 
 def handle_request(request):
 	if request.method != 'GET':
@@ -22,11 +22,10 @@ def handle_request(request):
 		url = url.replace("reddit.com", "old.reddit.com", 1)
 	
 	try:
-		headers = {'User-Agent': USER_AGENT} if USER_AGENT else {}
-		resp = requests.get(url, headers=headers, allow_redirects=True, timeout=10)
+		resp = session.get(url, allow_redirects=True, timeout=10)
 		resp.raise_for_status()
 		return process_content(resp.content, url)
-	except requests.RequestException as e:
+	except RequestException as e:
 		return Response(f"An error occurred: {str(e)}", status=500)
 
 def process_comments(comments_area, parent_element, new_soup, depth=0):
@@ -1,25 +1,22 @@
 from flask import request, render_template_string
 from urllib.parse import urlparse, urlunparse, urljoin
-import requests
 from bs4 import BeautifulSoup
 import datetime
 import calendar
+import logging
 import re
 import os
 import time
+from utils.http_utils import session
+from utils.state_utils import get_client_state
+
+logger = logging.getLogger(__name__)
 
 DOMAIN = "web.archive.org"
-TARGET_DATE = "19960101"
-date_update_message = ""
+DEFAULT_TARGET_DATE = "19960101"
 last_request_time = 0
 REQUEST_DELAY = 0.2  # Minimum time between requests in seconds
 
-USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
-
-# Create a session object for persistent connections
-session = requests.Session()
-session.headers.update({'User-Agent': USER_AGENT})
-
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -67,17 +64,24 @@ HTML_TEMPLATE = """
 </html>
 """
 
-override_active = False
 current_date = datetime.datetime.now()
-selected_month = current_date.strftime("%b").upper()
-selected_day = current_date.day
-selected_year = 1996
 current_year = current_date.year
 months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
 
+def get_state():
+	# Each client travels to its own date
+	return get_client_state(
+		__name__,
+		override_active=False,
+		target_date=DEFAULT_TARGET_DATE,
+		date_update_message="",
+		selected_month=current_date.strftime("%b").upper(),
+		selected_day=current_date.day,
+		selected_year=1996,
+	)
+
 def get_override_status():
-	global override_active
-	return override_active
+	return get_state().override_active
 
 def rate_limit_request():
 	"""Implement rate limiting between requests"""
@@ -97,7 +101,7 @@ def construct_wayback_url(url, timestamp):
 	"""Construct a Wayback Machine URL with the given timestamp"""
 	return f"https://web.archive.org/web/{timestamp}/{url}"
 
-def find_closest_snapshot(url):
+def find_closest_snapshot(url, target_date=DEFAULT_TARGET_DATE):
 	"""Use Wayback CDX API to find closest available snapshot"""
 	try:
 		cdx_url = f"https://web.archive.org/cdx/search/cdx"
@@ -105,7 +109,7 @@ def find_closest_snapshot(url):
 			'url': url,
 			'matchType': 'prefix',
 			'limit': -1,  # Get all results
-			'from': TARGET_DATE,  # Start from our target date
+			'from': target_date,  # Start from our target date
 			'output': 'json',
 			'sort': 'closest',
 			'filter': '!statuscode:[500 TO 599]'  # Exclude server errors
@@ -117,7 +121,7 @@ def find_closest_snapshot(url):
 			if len(data) > 1:  # First row is header
 				# Sort snapshots to prefer earlier dates
 				snapshots = data[1:]  # Skip header row
-				target_timestamp = int(TARGET_DATE + "000000")
+				target_timestamp = int(target_date + "000000")
 				
 				# Sort by absolute difference from target date, but prefer later dates
 				snapshots.sort(key=lambda x: (
@@ -130,19 +134,19 @@ def find_closest_snapshot(url):
 					return timestamp
 					
 	except Exception as e:
-		print(f"Error finding snapshot: {str(e)}")
-	return TARGET_DATE + "000000"  # Return target date if no snapshot found
+		logger.warning("Error finding snapshot: %s", e)
+	return target_date + "000000"  # Return target date if no snapshot found
 
-def make_archive_request(url, follow_redirects=True, original_timestamp=None):
+def make_archive_request(url, follow_redirects=True, original_timestamp=None, target_date=DEFAULT_TARGET_DATE):
 	"""Make a request to the archive with rate limiting and redirect handling"""
 	rate_limit_request()
 	
 	try:
 		# Simply use original_timestamp if provided, otherwise find closest snapshot
-		timestamp_to_use = original_timestamp if original_timestamp else find_closest_snapshot(url)
+		timestamp_to_use = original_timestamp if original_timestamp else find_closest_snapshot(url, target_date)
 		
 		wayback_url = construct_wayback_url(url, timestamp_to_use)
-		print(f'Requesting: {wayback_url}')
+		logger.debug("Requesting: %s", wayback_url)
 		response = session.get(wayback_url, timeout=10)
 		
 		# Handle Wayback Machine redirects
@@ -154,7 +158,7 @@ def make_archive_request(url, follow_redirects=True, original_timestamp=None):
 				redirect_match = re.search(r'Redirecting to\.\.\.\s*\n\s*(.*?)\s*$', content, re.MULTILINE)
 				if redirect_match:
 					redirect_url = redirect_match.group(1).strip()
-					print(f'Following Wayback redirect to: {redirect_url}')
+					logger.debug("Following Wayback redirect to: %s", redirect_url)
 					
 					# Make a new request to the redirect URL, maintaining original timestamp
 					return make_archive_request(
@@ -168,7 +172,7 @@ def make_archive_request(url, follow_redirects=True, original_timestamp=None):
 				redirect_match = re.search(r'window\.location\.replace\(["\'](.+?)["\']\)', content)
 				if redirect_match:
 					redirect_url = redirect_match.group(1).strip()
-					print(f'Following JS redirect to: {redirect_url}')
+					logger.debug("Following JS redirect to: %s", redirect_url)
 					
 					# Make a new request to the redirect URL, maintaining original timestamp
 					return make_archive_request(
@@ -180,7 +184,7 @@ def make_archive_request(url, follow_redirects=True, original_timestamp=None):
 		return response
 		
 	except Exception as e:
-		print(f"Request failed: {str(e)}")
+		logger.warning("Request failed: %s", e)
 		raise
 
 def extract_original_url(url, base_url):
@@ -225,7 +229,7 @@ def extract_original_url(url, base_url):
 
         return url
     except Exception as e:
-        print(f"Error in extract_original_url: {url} - {str(e)}")
+        logger.warning("Error in extract_original_url: %s - %s", url, e)
         return url
 
 def process_html_content(content, base_url):
@@ -271,11 +275,11 @@ def process_html_content(content, base_url):
 
 		return str(soup)
 	except Exception as e:
-		print(f"Error in process_html_content: {str(e)}")
+		logger.warning("Error in process_html_content: %s", e)
 		return content
 
 def handle_request(req):
-	global override_active, selected_month, selected_day, selected_year, TARGET_DATE, date_update_message
+	state = get_state()
 
 	parsed_url = urlparse(req.url)
 	is_wayback_domain = parsed_url.netloc == DOMAIN
@@ -284,13 +288,13 @@ def handle_request(req):
 		if req.method == 'POST':
 			action = req.form.get('action')
 			if action == 'enable':
-				override_active = True
-				date_update_message = ""
+				state.override_active = True
+				state.date_update_message = ""
 			elif action == 'disable':
-				override_active = False
-				date_update_message = ""
+				state.override_active = False
+				state.date_update_message = ""
 			elif action == 'set date':
-				override_active = True
+				state.override_active = True
 				
 				selected_month = req.form.get('month')
 				selected_day = int(req.form.get('day'))
@@ -306,36 +310,36 @@ def handle_request(req):
 				if selected_year == current_year and selected_date > current_date:
 					selected_date = current_date
 					
-				selected_year = selected_date.year
-				selected_month = months[selected_date.month - 1]
-				selected_day = selected_date.day
+				state.selected_year = selected_date.year
+				state.selected_month = months[selected_date.month - 1]
+				state.selected_day = selected_date.day
 
 				month_num = str(selected_date.month).zfill(2)
-				TARGET_DATE = f"{selected_year}{month_num}{str(selected_day).zfill(2)}"
+				state.target_date = f"{state.selected_year}{month_num}{str(state.selected_day).zfill(2)}"
 				
-				date_update_message = f"{selected_month} {selected_day}, {selected_year}"
+				state.date_update_message = f"{state.selected_month} {state.selected_day}, {state.selected_year}"
 
 		return render_template_string(HTML_TEMPLATE, 
-								   override_active=override_active,
+								   override_active=state.override_active,
 								   months=months,
-								   selected_month=selected_month,
-								   selected_day=selected_day,
-								   selected_year=selected_year,
+								   selected_month=state.selected_month,
+								   selected_day=state.selected_day,
+								   selected_year=state.selected_year,
 								   current_year=current_year,
-								   date_update_message=date_update_message), 200
+								   date_update_message=state.date_update_message), 200
 
 	try:
 		url = req.url
-		print(f'Handling request for: {url}')
+		logger.debug("Handling request for: %s", url)
 		
-		response = make_archive_request(url)
+		response = make_archive_request(url, target_date=state.target_date)
 		
 		content = response.content
 		if not content:
 			raise Exception("Empty response received from archive")
 		
 		content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
-		print(f"Content-Type: {content_type}")
+		logger.debug("Content-Type: %s", content_type)
 		
 		# Even if it's a 404, process and return the content as it might be an archived 404 page
 		if content_type.startswith('image/'):
@@ -354,5 +358,5 @@ def handle_request(req):
 			return content, response.status_code, {'Content-Type': content_type}
 	
 	except Exception as e:
-		print(f"Error occurred: {str(e)}")
+		logger.warning("Error occurred: %s", e)
 		return f"<html><body><p>Error fetching archived page: {str(e)}</p></body></html>", 500, {'Content-Type': 'text/html'}
\ No newline at end of file
@@ -4,10 +4,16 @@
 from flask import request, render_template_string, Response
 import anthropic
 import config
+from utils.deadline_utils import DeadlineExceeded, bounded_timeout, check_deadline
+from utils.state_utils import get_client_state
 import importlib.util
+import itertools
+import logging
 import os
 from urllib.parse import urlparse, parse_qs
 
+logger = logging.getLogger(__name__)
+
 client = anthropic.Anthropic(api_key=config.ANTHROPIC_API_KEY)
 
 RED = '\033[91m'
@@ -19,6 +25,7 @@ CYAN = '\033[96m'
 RESET = '\033[0m'  # Reset to default color
 
 DOMAIN = "websimulator.ai"
+REQUEST_DEADLINE = 180
 
 MAX_HISTORY = 3
 
@@ -121,21 +128,19 @@ if hasattr(config, 'PRESET') and config.PRESET:
 		if hasattr(preset_module, 'WEB_SIMULATOR_PROMPT_ADDENDUM'):
 			PRESET_PROMPT_ADDENDUM = preset_module.WEB_SIMULATOR_PROMPT_ADDENDUM
 	except Exception as e:
-		print(f"Error loading preset {config.PRESET}: {e}")
+		logger.warning("Error loading preset %s: %s", config.PRESET, e)
 
 # Combine the prompts once at module initialization
 FULL_SYSTEM_PROMPT = SYSTEM_PROMPT + "\n\n" + PRESET_PROMPT_ADDENDUM
 
-override_active = False
-message_history = []
-total_spend = 0.00
+def get_state():
+	return get_client_state(__name__, override_active=False, message_history=[], total_spend=0.00)
 
 def get_override_status():
-	global override_active
-	return override_active
+	return get_state().override_active
 
 def handle_request(req):
-	global override_active, message_history, total_spend
+	state = get_state()
 
 	parsed_url = urlparse(req.url)
 	is_websimulator_domain = parsed_url.netloc == DOMAIN
@@ -143,15 +148,16 @@ def handle_request(req):
 	if is_websimulator_domain:
 		if req.method == 'POST' and req.form.get('action') in ['enable', 'disable']:
 			action = req.form.get('action')
-			override_active = (action == 'enable')
-			if not override_active:
-				message_history = []
-				total_spend = 0.00
+			with state.lock:
+				state.override_active = (action == 'enable')
+				if not state.override_active:
+					state.message_history = []
+					state.total_spend = 0.00
 
-		status = "websimulator enabled" if override_active else "websimulator disabled"
+		status = "websimulator enabled" if state.override_active else "websimulator disabled"
 		return render_template_string(WEBSIMULATOR_TEMPLATE, 
 									status=status, 
-									override_active=override_active)
+									override_active=state.override_active)
 
 	return simulate_web_request(req)
 
@@ -160,8 +166,9 @@ def format_cost(cost):
 	return f"{GREEN}{formatted}{RESET}"
 
 def simulate_web_request(req):
-	global message_history
-	global total_spend
+	# The response below is streamed after the request context is gone, so
+	# hold on to this client's state object rather than looking it up again
+	state = get_state()
 
 	# Parse the request
 	parsed_url = urlparse(req.url)
@@ -169,7 +176,9 @@ def simulate_web_request(req):
 
 	# Prepare the context for the API call
 	context_messages = []
-	for r in message_history:
+	with state.lock:
+		history = list(state.message_history)
+	for r in history:
 		context_messages.extend([
 			{"role": "user", "content": r['request']},
 			{"role": "assistant", "content": r['response']}
@@ -193,6 +202,9 @@ def simulate_web_request(req):
 	# Combine context messages with the current request
 	all_messages = context_messages + [current_request]
 
+	# Within the request's deadline (a retry would get the whole timeout again)
+	timeout = bounded_timeout(REQUEST_DEADLINE, "Web Simulator request")
+
 	def generate():
 		"""Stream HTML chunks as they arrive from the API."""
 		full_response = []
@@ -210,7 +222,7 @@ def simulate_web_request(req):
 					if len(key) > max_key_len:
 						max_key_len = len(key)
 
-			with client.messages.stream(
+			with client.with_options(timeout=timeout, max_retries=0).messages.stream(
 				model="claude-sonnet-4-6",
 				max_tokens=8192,
 				messages=all_messages,
@@ -257,28 +269,39 @@ def simulate_web_request(req):
 			nonlocal total_spend_delta
 			total_spend_delta = input_cost + output_cost
 			output_size = len(simulated_content.encode('utf-8'))
-			print(f"Tokens used: {input_tokens} input, {output_tokens} output")
-			print(f"Output size: {output_size} bytes")
-			print(f"Cost for request: ${format_cost(round(input_cost + output_cost, 2))}")
-			print(f"Total spend this session: ${format_cost(round(total_spend + total_spend_delta, 2))}")
+			logger.info("Tokens used: %s input, %s output", input_tokens, output_tokens)
+			logger.info("Output size: %s bytes", output_size)
+			logger.info("Cost for request: $%s", format_cost(round(input_cost + output_cost, 2)))
+			logger.info("Total spend this session: $%s", format_cost(round(state.total_spend + total_spend_delta, 2)))
 
 			# Update message history
-			message_history.append({"request": current_request_content, "response": simulated_content})
-			if len(message_history) > MAX_HISTORY:
-				message_history.pop(0)
+			with state.lock:
+				state.message_history.append({"request": current_request_content, "response": simulated_content})
+				if len(state.message_history) > MAX_HISTORY:
+					state.message_history.pop(0)
 
+		except DeadlineExceeded:
+			raise
 		except Exception as e:
+			if not full_response:
+				# Out of time rather than failed, with nothing sent yet:
+				# answered with the timed-out page
+				check_deadline("Web Simulator request")
 			yield f"<html><body><p>An error occurred while simulating the webpage: {str(e)}</p></body></html>"
 
 	total_spend_delta = 0.0
 
-	response = Response(generate(), mimetype='text/html')
+	# The first chunk is waited for here, under the request's deadline; the
+	# rest streams after the request (and its deadline) is over
+	chunks = generate()
+	first_chunk = next(chunks, "")
+	response = Response(itertools.chain([first_chunk], chunks), mimetype='text/html')
 	# After the generator completes, update total spend
 	# (this happens via the nonlocal variable after the response is fully sent)
 
 	@response.call_on_close
 	def on_close():
-		global total_spend
-		total_spend += total_spend_delta
+		with state.lock:
+			state.total_spend += total_spend_delta
 
 	return response
\ No newline at end of file
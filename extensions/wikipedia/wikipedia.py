@@ -1,10 +1,14 @@
 # HINT: MacWeb 2.0 doesn't seem to have CSS support. To work around this, set <h5> styling to font="Palatino" and <h6> styling to font="Times", both with Size="As Is"
 
 from flask import request
-import requests
+from requests import RequestException
+from utils.http_utils import session
 from bs4 import BeautifulSoup, Comment
 import urllib.parse
 import re
+import logging
+
+logger = logging.getLogger(__name__)
 
 DOMAIN = "wikipedia.org"
 
@@ -38,7 +42,7 @@ def create_search_form():
 
 def get_featured_article_snippet(lang='en'):
 	try:
-		response = requests.get(f"https://{lang}.wikipedia.org/wiki/Main_Page", headers=HEADERS)
+		response = session.get(f"https://{lang}.wikipedia.org/wiki/Main_Page", headers=HEADERS)
 		response.raise_for_status()
 		soup = BeautifulSoup(response.text, 'html.parser')
 		tfa_div = soup.find('div', id='mp-tfa')
@@ -47,7 +51,7 @@ def get_featured_article_snippet(lang='en'):
 			if first_p:
 				return f'<br><br><b>From today\'s featured article:</b>{str(first_p)}'
 	except Exception as e:
-		print(f"Error fetching featured article: {str(e)}")
+		logger.warning("Error fetching featured article: %s", e)
 	return ''
 
 def process_html(content, title):
@@ -86,7 +90,7 @@ def handle_wiki_page(title, lang='en'):
 	}
 	
 	try:
-		search_response = requests.get(search_url, params=params, headers=HEADERS)
+		search_response = session.get(search_url, params=params, headers=HEADERS)
 		search_response.raise_for_status()
 		search_data = search_response.json()
 
@@ -96,7 +100,7 @@ def handle_wiki_page(title, lang='en'):
 			
 			# Now fetch the page using the found title
 			url = f"https://{lang}.wikipedia.org/wiki/{urllib.parse.quote(found_title)}"
-			response = requests.get(url, headers=HEADERS)
+			response = session.get(url, headers=HEADERS)
 			response.raise_for_status()
 
 			soup = BeautifulSoup(response.text, 'html.parser')
@@ -269,7 +273,7 @@ def handle_wiki_page(title, lang='en'):
 		else:
 			return process_html("<p>No results found.</p>", f"Search - Wikipedia"), 404
 
-	except requests.RequestException as e:
+	except RequestException as e:
 		if hasattr(e, 'response') and e.response.status_code == 404:
 			return process_html("<p>Page not found.</p>", f"Error - Wikipedia"), 404
 		else:
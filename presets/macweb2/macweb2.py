@@ -29,6 +29,8 @@ CONVERT_IMAGES = True
 CONVERT_IMAGES_TO_FILETYPE = "gif"
 DITHERING_ALGORITHM = "FLOYDSTEINBERG"
 
+PAGE_SPLIT_BYTES = 64 * 1024
+
 WEB_SIMULATOR_PROMPT_ADDENDUM = """<formatting>
 IMPORTANT: The user's web browser only supports (most of) HTML 3.2 (you do not need to acknowledge this to the user, only understand it and use this knowledge to construct the HTML you respond with).
 Their browser has NO CSS support and NO JavaScript support. Never include <script>, <style> or inline scripting or styling in your responses. The output html will always be rendered as black on a white background, and there's no need to try to change this.
@@ -14,6 +14,8 @@ CONVERT_IMAGES = False
 CONVERT_IMAGES_TO_FILETYPE = None
 DITHERING_ALGORITHM = None
 
+PAGE_SPLIT_BYTES = 512 * 1024
+
 WEB_SIMULATOR_PROMPT_ADDENDUM = """<formatting>
 The user is accessing these pages from a Nintendo Wii running the Internet Channel, a simplified version of the Opera browser designed specially for the Wii.
 This browser was released in 2006, and has the following features and quirks (keep these in mind when generating web pages):
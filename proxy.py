@@ -1,146 +1,342 @@
 # Standard library imports
 import argparse
+import hashlib
+import html
+import logging
 import os
-import shutil
 import socket
-from urllib.parse import urlparse
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
 
 # Third-party imports
 import requests
-from flask import Flask, request, session, g, abort, Response, send_from_directory
+from flask import Flask, request, g, abort, Response
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_date
 from werkzeug.serving import get_interface_ip
 from werkzeug.wrappers.response import Response as WerkzeugResponse
 
 # First-party imports
-from utils.html_utils import transcode_html, transcode_content
-from utils.image_utils import is_image_url, fetch_and_cache_image, CACHE_DIR
+from utils.image_utils import image_pool
+
+# Fork the image workers while this is still the only thread: a process forked
+# while other threads hold locks can find them held forever
+if image_pool is not None:
+	image_pool.start()
+
+from utils.log_utils import setup_logging, start_access_log, write_access_log, note
+
+# Start logging before the imports below load the preset; the configured
+# level is applied once the preset has been loaded
+setup_logging()
+
+from utils.html_utils import cached_transcode, cached_transcode_html, transcode_content, transcode_fingerprint, transcode_key, split_html, is_whitelisted
+from utils.image_utils import is_image_url, fetch_and_cache_image, prepare_image_cache, send_cached_image
+from utils.bandwidth_utils import BandwidthTiers, tier_setting, tier_name
+from utils.cache_utils import ByteLRU, ResponseCache
+from utils.deadline_utils import DeadlineExceeded, start_deadline, end_deadline
+from utils.domain_utils import DomainIndex
+from utils.extension_utils import load_extensions
+from utils.flight_utils import SingleFlight, flight_key
+from utils.http_utils import session, USER_AGENT
+from utils.metrics_utils import timed, start_request_timer, record_request, render_metrics, PROMETHEUS_CONTENT_TYPE, METRICS_ENABLED
+from utils.prefetch_utils import Prefetcher, ImageWarmer, select_images, request_started, request_finished
+from utils.server_utils import run_production_server
+from utils.state_utils import get_client_state
 from utils.system_utils import load_preset
 
 
 os.environ['FLASK_ENV'] = 'development'
 app = Flask(__name__)
-session = requests.Session()
+logger = logging.getLogger(__name__)
 
 HTTP_ERRORS = (403, 404, 500, 503, 504)
 ERROR_HEADER = "[[Macproxy Encountered an Error]]"
 
-# Global variable to store the override extension
-override_extension = None
-
-# User-Agent string
-USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
-
-# Call this function every time the proxy starts
-def clear_image_cache():
-	if os.path.exists(CACHE_DIR):
-		shutil.rmtree(CACHE_DIR)
-	os.makedirs(CACHE_DIR, exist_ok=True)
-
-clear_image_cache()
+# List of content types that should not be transcoded
+NON_TRANSCODE_TYPES = [
+	'application/octet-stream',
+	'application/pdf',
+	'application/zip',
+	'application/x-zip-compressed',
+	'application/x-rar-compressed',
+	'application/x-tar',
+	'application/x-gzip',
+	'application/x-bzip2',
+	'application/x-7z-compressed',
+	'application/mac-binary',
+	'application/macbinary',
+	'application/x-binary',
+	'application/x-macbinary',
+	'application/binhex',
+	'application/binhex4',
+	'application/mac-binhex',
+	'application/mac-binhex40',
+	'application/x-binhex40',
+	'application/x-mac-binhex40',
+	'application/x-sit',
+	'application/x-stuffit',
+	'application/vnd.openxmlformats-officedocument',
+	'application/vnd.ms-excel',
+	'application/vnd.ms-powerpoint',
+	'application/msword',
+	'audio/',
+	'video/',
+	'text/plain'
+]
+
+# Non-transcoded types that are streamed straight through to the client as they
+# arrive, rather than buffered in memory (text/plain stays buffered so it can be cached)
+STREAMED_TYPES = [t for t in NON_TRANSCODE_TYPES if t != 'text/plain']
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Headers forwarded as-is on streamed responses
+STREAMED_HEADERS = (
+	'Content-Type',
+	'Content-Length',
+	'Content-Range',
+	'Accept-Ranges',
+	'Content-Disposition',
+	'Last-Modified',
+	'ETag',
+)
 
 # Load preset immediately after config import
 config = load_preset()
 
+setup_logging(getattr(config, 'LOG_LEVEL', "INFO"), getattr(config, 'ACCESS_LOG', True))
+
 # Now get the settings we need after preset has potentially modified them
 ENABLED_EXTENSIONS = config.ENABLED_EXTENSIONS
 
-# Load extensions
-extensions = {}
-domain_to_extension = {}
-print('Enabled Extensions: ')
-for ext in ENABLED_EXTENSIONS:
-	print(ext)
-	module = __import__(f"extensions.{ext}.{ext}", fromlist=[''])
-	extensions[ext] = module
-	domain_to_extension[module.DOMAIN] = module
+# Cache of upstream responses for handle_default_request
+response_cache = None
+if getattr(config, 'RESPONSE_CACHE_ENABLED', True):
+	response_cache = ResponseCache(
+		memory_bytes=getattr(config, 'RESPONSE_CACHE_MEMORY_BYTES', 32 * 1024 * 1024),
+		disk_bytes=getattr(config, 'RESPONSE_CACHE_DISK_BYTES', 256 * 1024 * 1024),
+		max_object_bytes=getattr(config, 'RESPONSE_CACHE_MAX_OBJECT_BYTES', 8 * 1024 * 1024),
+	)
+
+# Other pages of documents split because they were bigger than PAGE_SPLIT_BYTES,
+# keyed by page id; page n of a document is requested as <url>?macproxy_page=<id>-<n>
+PAGE_SPLIT_PARAM = "macproxy_page"
+PAGE_SPLIT_TTL = getattr(config, 'PAGE_SPLIT_TTL', 600)
+split_pages = ByteLRU(
+	getattr(config, 'PAGE_SPLIT_CACHE_BYTES', 16 * 1024 * 1024),
+	sizeof=lambda item: sum(len(page) for page in item[1]),
+)
+
+# Seconds browsers may use a transcoded page (or stylesheet or script) before
+# asking whether it changed; the answer is a 304 when it hasn't
+BROWSER_PAGE_MAX_AGE = getattr(config, 'BROWSER_PAGE_MAX_AGE', 0)
+
+# Upstream headers replaced by the proxy's own on transcoded responses (Date
+# included: one from the response cache can be older than our Last-Modified)
+UPSTREAM_VALIDATORS = ('date', 'etag', 'last-modified', 'cache-control', 'expires')
+
+# Concurrent identical GETs for pages fetched without an extension share one upstream fetch
+page_flights = SingleFlight("page")
+
+# Register extensions (each is imported on its first request unless LAZY_EXTENSIONS is False)
+logger.info("Enabled extensions: %s", ", ".join(ENABLED_EXTENSIONS))
+extensions = load_extensions(ENABLED_EXTENSIONS, lazy=getattr(config, 'LAZY_EXTENSIONS', True))
+domain_to_extension = DomainIndex()
+for extension in extensions.values():
+	domain_to_extension.add(extension.DOMAIN, extension)
+
+# Default time budget for a request, and per-extension overrides
+REQUEST_DEADLINE = getattr(config, 'REQUEST_DEADLINE', 30)
+EXTENSION_DEADLINES = getattr(config, 'EXTENSION_DEADLINES', {})
+
+def deadline_for(extension):
+	"""
+	Deadline for requests handled by an extension: EXTENSION_DEADLINES in
+	config.py, then the extension's own REQUEST_DEADLINE, then the default.
+	"""
+	if extension.name in EXTENSION_DEADLINES:
+		return EXTENSION_DEADLINES[extension.name]
+	return getattr(extension.load(), 'REQUEST_DEADLINE', REQUEST_DEADLINE)
+
+app.before_request(start_access_log)
+app.before_request(start_request_timer)
+
+# Image, page size and page split settings chosen per client, by pinning its IP
+# address to a tier or from how fast it takes its responses
+bandwidth = None
+if getattr(config, 'ADAPTIVE_BANDWIDTH', False) or getattr(config, 'BANDWIDTH_TIER_BY_IP', {}):
+	bandwidth = BandwidthTiers(
+		getattr(config, 'BANDWIDTH_TIERS', []),
+		pinned=getattr(config, 'BANDWIDTH_TIER_BY_IP', {}),
+		min_sample_bytes=getattr(config, 'BANDWIDTH_MIN_SAMPLE_BYTES', 64 * 1024),
+		send_buffer_bytes=getattr(config, 'BANDWIDTH_SEND_BUFFER_BYTES', 16 * 1024),
+		max_age=getattr(config, 'BANDWIDTH_ESTIMATE_MAX_AGE', 600),
+	)
+	app.before_request(bandwidth.select_tier)
+	if getattr(config, 'ADAPTIVE_BANDWIDTH', False):
+		app.wsgi_app = bandwidth.wrap(app.wsgi_app)
+
+@app.before_request
+def start_request_deadline():
+	g.deadline_token = start_deadline(REQUEST_DEADLINE)
+
+@app.teardown_request
+def end_request_deadline(exc):
+	token = g.pop('deadline_token', None)
+	if token is not None:
+		end_deadline(token)
+
+@app.errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(e):
+	# A small, well-formed page the browser can render right away, instead
+	# of a connection that hangs until the client gives up
+	logger.warning("%s for URL: %s", e, request.url)
+	url = html.escape(request.url, quote=True)
+	content = (
+		"<html><head><title>Page Timed Out</title></head><body>"
+		"<h1>Page Timed Out</h1>"
+		f"<p>{url} took too long to load.</p>"
+		f"<p><a href=\"{url}\">Try again</a></p>"
+		"</body></html>"
+	)
+	return Response(content, 504, content_type='text/html')
+
+def is_direct_request():
+	"""
+	True if the request is addressed to Macproxy itself ("GET /metrics")
+	rather than proxied through it ("GET http://example.com/metrics").
+	"""
+	return request.environ.get('RAW_URI', request.path).startswith('/')
+
+@app.route("/metrics", methods=["GET", "POST"])
+def serve_metrics():
+	# Sites proxied through Macproxy may have a /metrics page of their own
+	if not METRICS_ENABLED or request.method != "GET" or not is_direct_request():
+		return handle_request("metrics")
+	return Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+def image_settings():
+	"""fetch_and_cache_image arguments from config.py and the client's bandwidth tier."""
+	return dict(
+		resize=config.RESIZE_IMAGES,
+		max_width=tier_setting(config, 'MAX_IMAGE_WIDTH'),
+		max_height=tier_setting(config, 'MAX_IMAGE_HEIGHT'),
+		convert=config.CONVERT_IMAGES,
+		convert_to=config.CONVERT_IMAGES_TO_FILETYPE,
+		dithering=tier_setting(config, 'DITHERING_ALGORITHM'),
+		color_depth=tier_setting(config, 'IMAGE_COLOR_DEPTH', '1bit'),
+		variant=tier_name()
+	)
+
+def transcode_settings():
+	"""transcode_html arguments from config.py and the client's bandwidth tier."""
+	return dict(
+		whitelisted_domains=config.WHITELISTED_DOMAINS,
+		simplify_html=config.SIMPLIFY_HTML,
+		tags_to_unwrap=config.TAGS_TO_UNWRAP,
+		tags_to_strip=config.TAGS_TO_STRIP,
+		attributes_to_strip=config.ATTRIBUTES_TO_STRIP,
+		convert_characters=config.CONVERT_CHARACTERS,
+		conversion_table=config.CONVERSION_TABLE,
+		max_image_width=tier_setting(config, 'MAX_IMAGE_WIDTH'),
+		max_image_height=tier_setting(config, 'MAX_IMAGE_HEIGHT'),
+		max_images=tier_setting(config, 'MAX_IMAGES_PER_PAGE', 0)
+	)
+
+# Keep images converted in earlier runs, unless they were converted with other settings
+cache_settings = image_settings()
+del cache_settings["variant"]
+if bandwidth is not None:
+	cache_settings["bandwidth_tiers"] = bandwidth.tiers
+prepare_image_cache(cache_settings, clear=getattr(config, 'CLEAR_IMAGE_CACHE_ON_START', False))
 
 @app.route("/cached_image/<path:filename>")
 def serve_cached_image(filename):
-	return send_from_directory(CACHE_DIR, filename, mimetype='image/gif')
+	return send_cached_image(filename)
 
 def handle_image_request(url):
 	# Pass config values to fetch_and_cache_image
-	cached_url = fetch_and_cache_image(
-		url,
-		resize=config.RESIZE_IMAGES,
-		max_width=config.MAX_IMAGE_WIDTH,
-		max_height=config.MAX_IMAGE_HEIGHT,
-		convert=config.CONVERT_IMAGES,
-		convert_to=config.CONVERT_IMAGES_TO_FILETYPE,
-		dithering=config.DITHERING_ALGORITHM
-	)
+	cached_url = fetch_and_cache_image(url, **image_settings())
 	if cached_url:
-		return send_from_directory(CACHE_DIR, os.path.basename(cached_url), mimetype='image/gif')
+		return send_cached_image(cached_url)
 	else:
 		return abort(404, "Image not found or could not be processed")
 
 @app.route("/", defaults={"path": "/"}, methods=["GET", "POST"])
 @app.route("/<path:path>", methods=["GET", "POST"])
 def handle_request(path):
-	global override_extension
-	parsed_url = urlparse(request.url)
-	scheme = parsed_url.scheme
-	host = parsed_url.netloc.split(':')[0]  # Remove port if present
-	
-	if override_extension:
-		print(f'Current override extension: {override_extension}')
+	if PAGE_SPLIT_PARAM in request.args:
+		return serve_split_page(request.args[PAGE_SPLIT_PARAM])
+
+	with timed("routing"):
+		parsed_url = urlparse(request.url)
+		scheme = parsed_url.scheme
+		host = parsed_url.netloc.split(':')[0]  # Remove port if present
+
+		# Overrides are tracked per client, so one machine enabling an override
+		# extension doesn't redirect every other machine using the proxy
+		client = get_client_state('proxy', override_extension=None)
+		if client.override_extension:
+			logger.debug("Current override extension: %s", client.override_extension)
+
+		matching_extension = find_matching_extension(host)
 
-	override_response = handle_override_extension(scheme)
+	override_response = handle_override_extension(client, scheme)
 	if override_response is not None:
 		return process_response(override_response, request.url)
 
-	matching_extension = find_matching_extension(host)
 	if matching_extension:
-		response = handle_matching_extension(matching_extension)
+		response = handle_matching_extension(client, matching_extension)
 		return process_response(response, request.url)
 	
 	# Only handle image requests here if we're not using an extension
-	if is_image_url(request.url) and not (override_extension or matching_extension):
+	if is_image_url(request.url) and not (client.override_extension or matching_extension):
 		return handle_image_request(request.url)
 
 	return handle_default_request()
 
-def handle_override_extension(scheme):
-	global override_extension
-	if override_extension:
-		extension_name = override_extension.split('.')[-1]
+def handle_override_extension(client, scheme):
+	if client.override_extension:
+		extension_name = client.override_extension.split('.')[-1]
 		if extension_name in extensions:
 			if scheme in ['http', 'https', 'ftp']:
-				response = extensions[extension_name].handle_request(request)
-				check_override_status(extension_name)
+				note(extension=extension_name)
+				start_deadline(deadline_for(extensions[extension_name]))
+				with timed("extension"):
+					response = extensions[extension_name].handle_request(request)
+				check_override_status(client, extension_name)
 				return response
 			else:
-				print(f"Warning: Unsupported scheme '{scheme}' for override extension.")
+				logger.warning("Unsupported scheme '%s' for override extension", scheme)
 		else:
-			print(f"Warning: Override extension '{extension_name}' not found. Resetting override.")
-			override_extension = None
+			logger.warning("Override extension '%s' not found, resetting override", extension_name)
+			client.override_extension = None
 	return None  # Return None if no override is active
 
-def check_override_status(extension_name):
-	global override_extension
-	if hasattr(extensions[extension_name], 'get_override_status') and not extensions[extension_name].get_override_status():
-		override_extension = None
-		print("Override disabled")
+def check_override_status(client, extension_name):
+	if extensions[extension_name].can_override and not extensions[extension_name].get_override_status():
+		client.override_extension = None
+		logger.info("Override disabled")
 
 def find_matching_extension(host):
-	for domain, extension in domain_to_extension.items():
-		if host.endswith(domain):
-			return extension
-	return None
-
-def handle_matching_extension(matching_extension):
-	global override_extension
-	print(f"Handling request with matching extension: {matching_extension.__name__}")
-	response = matching_extension.handle_request(request)
+	return domain_to_extension.lookup(host)
+
+def handle_matching_extension(client, matching_extension):
+	logger.debug("Handling request with matching extension: %s", matching_extension.name)
+	note(extension=matching_extension.name)
+	start_deadline(deadline_for(matching_extension))
+	with timed("extension"):
+		response = matching_extension.handle_request(request)
 	
-	if hasattr(matching_extension, 'get_override_status') and matching_extension.get_override_status():
-		override_extension = matching_extension.__name__
-		print(f"Override enabled for {override_extension}")
+	if matching_extension.can_override and matching_extension.get_override_status():
+		client.override_extension = matching_extension.__name__
+		logger.info("Override enabled for %s", client.override_extension)
 	
 	return response
 
 def process_response(response, url):
-	print(f"Processing response for URL: {url}")
+	logger.debug("Processing response for URL: %s", url)
 
 	if isinstance(response, tuple):
 		if len(response) == 3:
@@ -160,132 +356,453 @@ def process_response(response, url):
 		headers = {}
 
 	content_type = headers.get('Content-Type', '').lower()
-	print(f"Content-Type: {content_type}")
+	logger.debug("Content-Type: %s", content_type)
+	note(content_type=content_type)
 
 	if content_type.startswith('image/'):
 		# For image content, use the fetch_and_cache_image function with config values
-		cached_url = fetch_and_cache_image(
-			url,
-			content,
-			resize=config.RESIZE_IMAGES,
-			max_width=config.MAX_IMAGE_WIDTH,
-			max_height=config.MAX_IMAGE_HEIGHT,
-			convert=config.CONVERT_IMAGES,
-			convert_to=config.CONVERT_IMAGES_TO_FILETYPE,
-			dithering=config.DITHERING_ALGORITHM
-		)
+		cached_url = fetch_and_cache_image(url, content, **image_settings())
 		if cached_url:
-			return send_from_directory(CACHE_DIR, os.path.basename(cached_url), mimetype='image/gif')
+			return send_cached_image(cached_url)
 		else:
 			return abort(404, "Image could not be processed")
 
+	# Browsers may keep what's made of successful GETs, and revalidate it with the proxy
+	validators = None
+	revalidatable = status_code == 200 and request.method == "GET" and is_storable(headers)
+	last_modified = page_last_modified(headers) if revalidatable else None
+
 	# Handle CSS and JavaScript
 	if content_type in ['text/css', 'text/javascript', 'application/javascript', 'application/x-javascript']:
-		content = transcode_content(content)
+		with timed("transcode_content"):
+			content = transcode_content(content)
 		response = Response(content, status_code)
 		response.headers['Content-Type'] = content_type
-		return response
-
-	# List of content types that should not be transcoded
-	non_transcode_types = [
-		'application/octet-stream',
-		'application/pdf',
-		'application/zip',
-		'application/x-zip-compressed',
-		'application/x-rar-compressed',
-		'application/x-tar',
-		'application/x-gzip',
-		'application/x-bzip2',
-		'application/x-7z-compressed',
-		'application/mac-binary',
-		'application/macbinary',
-		'application/x-binary',
-		'application/x-macbinary',
-		'application/binhex',
-		'application/binhex4',
-		'application/mac-binhex',
-		'application/mac-binhex40',
-		'application/x-binhex40',
-		'application/x-mac-binhex40',
-		'application/x-sit',
-		'application/x-stuffit',
-		'application/vnd.openxmlformats-officedocument',
-		'application/vnd.ms-excel',
-		'application/vnd.ms-powerpoint',
-		'application/msword',
-		'audio/',
-		'video/',
-		'text/plain'
-	]
+		if revalidatable:
+			etag = hashlib.sha256(content if isinstance(content, bytes) else content.encode('utf-8')).hexdigest()[:32]
+			set_validators(response, etag, last_modified)
+		return response.make_conditional(request)
 
 	# Check if content type is in the list of non-transcode types
-	should_transcode = not any(content_type.startswith(t) for t in non_transcode_types)
+	should_transcode = not any(content_type.startswith(t) for t in NON_TRANSCODE_TYPES)
 
 	if should_transcode:
-		print("Transcoding content")
-		if isinstance(content, bytes):
-			content = content.decode('utf-8', errors='replace')
-		content = transcode_html(
-			content,
-			url,
-			whitelisted_domains=config.WHITELISTED_DOMAINS,
-			simplify_html=config.SIMPLIFY_HTML,
-			tags_to_unwrap=config.TAGS_TO_UNWRAP,
-			tags_to_strip=config.TAGS_TO_STRIP,
-			attributes_to_strip=config.ATTRIBUTES_TO_STRIP,
-			convert_characters=config.CONVERT_CHARACTERS,
-			conversion_table=config.CONVERSION_TABLE
-		)
+		settings = transcode_settings()
+		is_html = not content_type or content_type.startswith('text/html')
+		split_bytes = tier_setting(config, 'PAGE_SPLIT_BYTES', 0)
+		if not (status_code == 200 and is_html) or is_whitelisted(url, config.WHITELISTED_DOMAINS):
+			split_bytes = 0
+		if revalidatable:
+			# Known before transcoding, so an unchanged page costs neither a transcode nor its bytes
+			key = transcode_key(content, url, **settings)
+			validators = (hashlib.sha256(f"{key} {split_bytes}".encode('utf-8')).hexdigest()[:32], last_modified)
+			# Unless its inline SVG images need rendering again, which only transcoding does
+			if not split_bytes and is_not_modified(*validators) and cached_transcode(key) is not None:
+				logger.debug("Not modified: %s", url)
+				response = Response(status=304)
+				set_validators(response, *validators)
+				return response
+
+		logger.debug("Transcoding content")
+		content = cached_transcode_html(content, url, **settings)
+		if split_bytes:
+			content = first_split_page(content, url, split_bytes)
+		if image_warmer is not None and status_code == 200 and is_html and request.method == "GET":
+			schedule_image_warmup(url, content)
 	else:
-		print(f"Content type {content_type} should not be transcoded, passing through unchanged")
+		logger.debug("Content type %s should not be transcoded, passing through unchanged", content_type)
 
 	response = Response(content, status_code)
 	for key, value in headers.items():
 		if key.lower() not in ["content-encoding", "content-length", "transfer-encoding"]:
-			response.headers[key] = value
+			if validators is None or key.lower() not in UPSTREAM_VALIDATORS:
+				response.headers[key] = value
+
+	if validators is not None:
+		set_validators(response, *validators)
+		# Split pages are only answered with a 304 here, once split again, so their other pages are kept
+		response = response.make_conditional(request)
 
-	print("Finished processing response")
+	logger.debug("Finished processing response")
 	return response
 
+def is_storable(headers):
+	"""Whether browsers may keep (and revalidate) a response transcoded from one with these upstream headers."""
+	return "no-store" not in Headers(headers).get('Cache-Control', '').lower()
+
+def upstream_last_modified(headers):
+	"""
+	When the upstream response last changed: its Last-Modified, else its Date,
+	which a response served from the response cache keeps from when it was fetched.
+	"""
+	headers = Headers(headers)
+	return parse_date(headers.get('Last-Modified')) or parse_date(headers.get('Date'))
+
+def settings_changed_at():
+	"""
+	When the settings the current client's responses are made with (its
+	bandwidth tier's, its override extension...) last changed, as far as
+	this run of the proxy knows; a client's first request counts as a change.
+	"""
+	override = get_client_state('proxy', override_extension=None).override_extension
+	settings = (
+		transcode_fingerprint(**transcode_settings()),
+		sorted(image_settings().items()),
+		tier_setting(config, 'PAGE_SPLIT_BYTES', 0),
+		override,
+	)
+	fingerprint = hashlib.sha256(repr(settings).encode('utf-8')).hexdigest()
+	state = get_client_state('validators', fingerprint=None, changed_at=None)
+	with state.lock:
+		if state.fingerprint != fingerprint:
+			state.fingerprint = fingerprint
+			state.changed_at = datetime.now(timezone.utc)
+		return state.changed_at
+
+def page_last_modified(headers):
+	"""
+	Last-Modified for a response made from one with these upstream headers:
+	upstream's date, moved forward to when the client's settings last
+	changed, so browsers sending only If-Modified-Since see that too. Never
+	later than now, so None during the second the settings changed in; the
+	ETag, which changes with the settings, covers that second.
+	"""
+	last_modified = upstream_last_modified(headers)
+	if not last_modified:
+		return None
+	now = datetime.now(timezone.utc).replace(microsecond=0)
+	changed_at = settings_changed_at()
+	# HTTP dates are in whole seconds: rounded up, so a copy from earlier in
+	# the second of the change doesn't look current
+	if changed_at.microsecond:
+		changed_at = changed_at.replace(microsecond=0) + timedelta(seconds=1)
+	if changed_at > now:
+		return None
+	return min(max(last_modified, changed_at), now)
+
+def is_not_modified(etag, last_modified):
+	"""Whether the browser's copy, per If-None-Match (or else If-Modified-Since), is still current."""
+	if request.if_none_match:
+		return request.if_none_match.contains(etag)
+	if request.if_modified_since and last_modified:
+		return last_modified.replace(microsecond=0) <= request.if_modified_since
+	return False
+
+def set_validators(response, etag, last_modified, max_age=None):
+	response.date = datetime.now(timezone.utc)
+	response.set_etag(etag)
+	if last_modified:
+		response.last_modified = last_modified
+	response.headers.pop('Expires', None)
+	response.headers['Cache-Control'] = f"private, max-age={BROWSER_PAGE_MAX_AGE if max_age is None else max_age}"
+
+def split_page_url(url, page_id, number):
+	parts = urlsplit(url)
+	query = f"{parts.query}&" if parts.query else ""
+	return urlunsplit(parts._replace(query=f"{query}{PAGE_SPLIT_PARAM}={page_id}-{number}", fragment=""))
+
+def get_split_pages(page_id):
+	item = split_pages.get(page_id)
+	if item is None:
+		return None
+	stored_at, pages = item
+	if time.monotonic() - stored_at > PAGE_SPLIT_TTL:
+		split_pages.pop(page_id)
+		return None
+	return pages
+
+def first_split_page(content, url, max_bytes):
+	"""
+	Split a transcoded page bigger than max_bytes into smaller pages, keep
+	them for PAGE_SPLIT_TTL seconds, and return the first.
+	"""
+	content_bytes = content.encode('utf-8') if isinstance(content, str) else content
+	if len(content_bytes) <= max_bytes:
+		return content
+	page_id = hashlib.sha256(f"{url} {max_bytes} ".encode('utf-8') + content_bytes).hexdigest()[:16]
+	pages = get_split_pages(page_id)
+	if pages is None:
+		pages = split_html(content_bytes, max_bytes, lambda number: split_page_url(url, page_id, number))
+		if len(pages) > 1:
+			logger.debug("Split %s into %d pages", url, len(pages))
+			split_pages.put(page_id, (time.monotonic(), pages))
+	return pages[0]
+
+def serve_split_page(token):
+	"""Serve page n of a split document, from memory, for ?macproxy_page=<id>-<n>."""
+	page_id, _, number = token.partition("-")
+	# The id is a hash of the whole document, so page n of it never changes
+	if page_id.isalnum() and number.isdigit() and is_not_modified(token, None):
+		response = Response(status=304)
+		set_validators(response, token, None, max_age=PAGE_SPLIT_TTL)
+		return response
+	pages = get_split_pages(page_id)
+	if pages is not None and number.isdigit() and 1 <= int(number) <= len(pages):
+		note(cache="split", bytes_in=0)
+		response = Response(pages[int(number) - 1], 200, content_type='text/html')
+		set_validators(response, token, None, max_age=PAGE_SPLIT_TTL)
+		return response
+
+	# Expired (or never existed): link back to the start of the document
+	parts = urlsplit(request.url)
+	query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != PAGE_SPLIT_PARAM])
+	url = html.escape(urlunsplit(parts._replace(query=query)), quote=True)
+	content = (
+		"<html><head><title>Page Expired</title></head><body>"
+		"<h1>Page Expired</h1>"
+		"<p>This part of the page is no longer available.</p>"
+		f"<p><a href=\"{url}\">Start again from the first page</a></p>"
+		"</body></html>"
+	)
+	return Response(content, 410, content_type='text/html')
+
 def handle_default_request():
 	url = request.url.replace("https://", "http://", 1)
 	headers = prepare_headers()
 	
-	print(f"Handling default request for URL: {url}")
+	logger.debug("Handling default request for URL: %s", url)
 	
 	try:
-		resp = send_request(url, headers)
-		content = resp.content
-		status_code = resp.status_code
-		headers = dict(resp.headers)
-		return process_response((content, status_code, headers), url)
+		# Either a (content, status_code, headers) tuple, or an already
+		# streaming Response that process_response passes through untouched
+		response = process_response(fetch_shared(url, headers), url)
+		if prefetcher is not None:
+			schedule_prefetch(url, headers, response)
+		return response
+	except DeadlineExceeded:
+		raise
+	except requests.exceptions.Timeout:
+		raise DeadlineExceeded("upstream fetch")
 	except requests.exceptions.ConnectionError as e:
 		error_args = str(e.args)
 		if any(keyword in error_args for keyword in ["NameResolutionError", "nodename nor servname provided", "Failed to resolve"]):
-			print(f"DNS lookup failed for {url}")
+			logger.warning("DNS lookup failed for %s", url)
 			return abort(502, f"DNS lookup failed for {url}. Please check the domain name.")
 		else:
-			print(f"Connection error for {url}: {str(e)}")
+			logger.warning("Connection error for %s: %s", url, e)
 			return abort(502, f"Connection error: {str(e)}")
 	except Exception as e:
-		print(f"Error in handle_default_request: {str(e)}")
+		logger.exception("Error in handle_default_request for %s", url)
 		return abort(500, ERROR_HEADER + str(e))
 
+def fetch_shared(url, headers):
+	"""
+	fetch_upstream, with concurrent identical GETs sharing one fetch. Streamed
+	downloads can't be shared, so a request that waited on one of those makes
+	its own.
+	"""
+	if request.method != "GET":
+		return fetch_upstream(url, headers)
+
+	if prefetcher is not None and not headers.get("Range"):
+		prefetched = prefetcher.take(url)
+		if prefetched is not None:
+			logger.debug("Serving prefetched response: %s", url)
+			note(cache="prefetched", bytes_in=0)
+			return prefetched
+
+	result, shared = page_flights.do(flight_key(url, headers), fetch_upstream, url, headers)
+	if not shared:
+		return result
+	if not isinstance(result, tuple):
+		return fetch_upstream(url, headers)
+
+	logger.debug("Shared in-flight fetch: %s", url)
+	note(cache="coalesced", bytes_in=0)
+	content, status_code, response_headers = result
+	return content, status_code, dict(response_headers)
+
+def schedule_prefetch(url, headers, response):
+	"""Queue the same-site links on an HTML page just served, for the client's next click."""
+	if request.method != "GET" or response.status_code != 200 or response.direct_passthrough:
+		return
+	if response.mimetype != 'text/html':
+		return
+	# The headers the client's browser will send when it follows one of the links
+	link_headers = {**headers, "Referer": url, "Range": None, "If-Range": None}
+	# Prefetched pages are transcoded and their images converted as this client would have them
+	settings = dict(transcode=transcode_settings(), images=image_settings())
+	prefetcher.schedule(url, response.get_data(as_text=True), link_headers, settings)
+
+def schedule_image_warmup(url, content):
+	"""Start converting the images on a page just transcoded, before the browser asks for them."""
+	if get_client_state('proxy', override_extension=None).override_extension:
+		# The override extension will handle the image requests, not the image cache
+		return
+	page_html = content.decode('utf-8', errors='replace') if isinstance(content, bytes) else content
+	image_warmer.schedule(url, page_html, image_settings())
+
+def is_proxied_image(url):
+	"""Whether a request for url would be converted into the image cache, rather than handled by an extension."""
+	return find_matching_extension(urlsplit(url).hostname or "") is None
+
+def prefetch_page(url, headers, settings):
+	"""
+	Prefetcher callback, run on a worker thread: fetch and transcode url as
+	handle_default_request would, and convert its images into the image
+	cache, with the settings of the client the link was shown to. Returns
+	the upstream response to keep for the next request.
+	"""
+	with app.test_request_context(url):
+		result, _ = page_flights.do(flight_key(url, headers), fetch_upstream, url, headers)
+		if not isinstance(result, tuple):
+			# A download, not a page
+			result.close()
+			return None
+		content, status_code, response_headers = result
+		content_type = next((v for k, v in response_headers.items() if k.lower() == 'content-type'), '')
+		if status_code != 200 or not content_type.lower().startswith('text/html'):
+			return None
+
+		page_html = cached_transcode_html(content, url, **settings["transcode"])
+		if isinstance(page_html, bytes):
+			page_html = page_html.decode('utf-8', errors='replace')
+		for image_url in select_images(url, page_html, PREFETCH_IMAGES):
+			fetch_and_cache_image(image_url, **settings["images"])
+		return result
+
+# Prefetching the links on pages served without an extension
+PREFETCH_IMAGES = getattr(config, 'PREFETCH_IMAGES', 10)
+prefetcher = None
+if getattr(config, 'PREFETCH_ENABLED', False):
+	prefetcher = Prefetcher(
+		prefetch_page,
+		workers=getattr(config, 'PREFETCH_WORKERS', 2),
+		links_per_page=getattr(config, 'PREFETCH_LINKS', 3),
+		max_per_host=getattr(config, 'PREFETCH_MAX_PER_HOST', 4),
+		max_queued=getattr(config, 'PREFETCH_MAX_QUEUED', 32),
+		max_active_requests=getattr(config, 'PREFETCH_MAX_ACTIVE_REQUESTS', 2),
+		max_load=getattr(config, 'PREFETCH_MAX_LOAD', 0.75),
+		ttl=getattr(config, 'PREFETCH_TTL', 120),
+		cache_bytes=getattr(config, 'PREFETCH_CACHE_BYTES', 16 * 1024 * 1024),
+		deadline=REQUEST_DEADLINE,
+	)
+	app.before_request(request_started)
+	app.teardown_request(request_finished)
+
+# Converting the images on pages as they are served, before the browser asks for them
+image_warmer = None
+if getattr(config, 'IMAGE_WARMUP_ENABLED', True):
+	image_warmer = ImageWarmer(
+		workers=getattr(config, 'IMAGE_WARMUP_WORKERS', 4),
+		max_per_host=getattr(config, 'IMAGE_WARMUP_MAX_PER_HOST', 2),
+		max_queued=getattr(config, 'IMAGE_WARMUP_MAX_QUEUED', 64),
+		images_per_page=getattr(config, 'IMAGE_WARMUP_IMAGES_PER_PAGE', 20),
+		deadline=REQUEST_DEADLINE,
+		accept=is_proxied_image,
+	)
+
+def fetch_upstream(url, headers):
+	"""
+	Fetch url through the response cache: serve fresh entries directly,
+	revalidate stale ones with their validators, and store what's cacheable.
+	Binary downloads come back as a streaming Response instead of a tuple.
+	"""
+	if response_cache is None:
+		resp = send_request(url, headers)
+		if should_stream(resp):
+			return stream_response(resp)
+		content = read_body(resp)
+		return content, resp.status_code, dict(resp.headers)
+
+	if request.method != "GET":
+		# Unsafe methods invalidate whatever we had stored for the URL
+		response_cache.invalidate(url)
+		resp = send_request(url, headers)
+		if should_stream(resp):
+			return stream_response(resp)
+		content = read_body(resp)
+		return content, resp.status_code, dict(resp.headers)
+
+	entry = response_cache.lookup(url, headers)
+	if entry is not None and entry.is_fresh():
+		logger.debug("Response cache hit: %s", url)
+		note(cache="hit", bytes_in=0)
+		return entry.content, entry.status_code, dict(entry.headers)
+
+	request_headers = headers
+	if entry is not None:
+		logger.debug("Revalidating cached response: %s", url)
+		request_headers = {**headers, **entry.validators()}
+
+	resp = send_request(url, request_headers)
+	if entry is not None and resp.status_code == 304:
+		logger.debug("Cached response still valid: %s", url)
+		note(cache="revalidated", bytes_in=0)
+		resp.close()
+		entry = response_cache.revalidated(url, entry, resp.headers)
+		return entry.content, entry.status_code, dict(entry.headers)
+
+	if should_stream(resp):
+		return stream_response(resp)
+
+	content = read_body(resp)
+	note(cache="miss")
+	response_cache.store(url, headers, resp.status_code, dict(resp.headers), content)
+	return content, resp.status_code, dict(resp.headers)
+
+def read_body(resp):
+	with timed("upstream_body"):
+		content = resp.content
+	note(bytes_in=len(content))
+	return content
+
+def should_stream(resp):
+	"""
+	Decide from the upstream headers alone whether the body should bypass
+	buffering and transcoding: binary downloads and partial content.
+	"""
+	if resp.status_code == 206:
+		return True
+	content_type = resp.headers.get('Content-Type', '').lower()
+	return any(content_type.startswith(t) for t in STREAMED_TYPES)
+
+def stream_response(resp):
+	"""
+	Pass an upstream response through to the client chunk by chunk, so large
+	downloads start immediately and never sit in memory in full.
+	"""
+	logger.debug("Streaming %s response for URL: %s", resp.headers.get('Content-Type', ''), resp.url)
+	note(cache="stream", bytes_in=resp.headers.get('Content-Length', '-'))
+
+	def generate():
+		try:
+			for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+				if chunk:
+					yield chunk
+		finally:
+			resp.close()
+
+	response = Response(generate(), resp.status_code, direct_passthrough=True)
+	for key in STREAMED_HEADERS:
+		if key in resp.headers:
+			response.headers[key] = resp.headers[key]
+
+	# iter_content decodes any Content-Encoding, which invalidates the upstream length
+	if resp.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+		response.headers.pop('Content-Length', None)
+	return response
+
 def prepare_headers():
 	headers = {
 		"Accept": request.headers.get("Accept"),
 		"Accept-Language": request.headers.get("Accept-Language"),
 		"Referer": request.headers.get("Referer"),
+		"Range": request.headers.get("Range"),
+		"If-Range": request.headers.get("If-Range"),
 		"User-Agent": USER_AGENT,
 	}
 	return headers
 
 def send_request(url, headers):
-	print(f"Sending request to: {url}")
-	if request.method == "POST":
-		return session.post(url, data=request.form, headers=headers, allow_redirects=True)
-	else:
-		return session.get(url, params=request.args, headers=headers)
+	logger.debug("Sending request to: %s", url)
+	with timed("upstream_fetch"):
+		if request.method == "POST":
+			resp = session.post(url, data=request.form, headers=headers, allow_redirects=True, stream=True)
+		else:
+			resp = session.get(url, params=request.args, headers=headers, stream=True)
+		note(content_type=resp.headers.get('Content-Type'))
+	return resp
 
 @app.after_request
 def apply_caching(resp):
@@ -295,6 +812,9 @@ def apply_caching(resp):
 		pass
 	return resp
 
+app.after_request(record_request)
+app.after_request(write_access_log)
+
 def get_proxy_hostname(hostname):
 	# Based on the `log_startup` function from werkzeug.serving.
 	# Translates a "bind all addresses" string into a real IP
@@ -323,6 +843,35 @@ if __name__ == "__main__":
 		action="store",
 		help="Port number the web server will run on",
 	)
+	parser.add_argument(
+		"--server",
+		type=str,
+		choices=["development", "production"],
+		default=getattr(config, 'SERVER_MODE', "development"),
+		action="store",
+		help="Serve with the Werkzeug development server, or the pooled production server",
+	)
+	parser.add_argument(
+		"--workers",
+		type=int,
+		default=getattr(config, 'SERVER_WORKERS', 32),
+		action="store",
+		help="Number of worker threads (production server only)",
+	)
+	parser.add_argument(
+		"--backlog",
+		type=int,
+		default=getattr(config, 'SERVER_BACKLOG', 128),
+		action="store",
+		help="Listen backlog for pending connections (production server only)",
+	)
+	parser.add_argument(
+		"--queue-size",
+		type=int,
+		default=getattr(config, 'SERVER_QUEUE_SIZE', 256),
+		action="store",
+		help="Connections allowed to wait for a worker before new ones get a 503 (production server only)",
+	)
 	arguments = parser.parse_args()
 
 	# Translate the bind address (typically 0.0.0.0 or ::) to a friendly
@@ -331,4 +880,16 @@ if __name__ == "__main__":
 	# in the HTML (as opposed to the site we are proxying the request to).
 	app.config['MACPROXY_HOST_AND_PORT'] = f"{get_proxy_hostname(arguments.host)}:{arguments.port}"
 
-	app.run(host=arguments.host, port=arguments.port, debug=False)
+	if arguments.server == "production":
+		run_production_server(
+			app,
+			arguments.host,
+			arguments.port,
+			workers=arguments.workers,
+			backlog=arguments.backlog,
+			queue_size=arguments.queue_size,
+			keep_alive_timeout=getattr(config, 'KEEP_ALIVE_TIMEOUT', 5),
+			max_keep_alive_requests=getattr(config, 'MAX_KEEP_ALIVE_REQUESTS', 100),
+		)
+	else:
+		app.run(host=arguments.host, port=arguments.port, debug=False)
@@ -0,0 +1,197 @@
+# Standard library imports
+import logging
+import math
+import socket
+import threading
+import time
+
+# Third-party imports
+from flask import g, has_request_context, request
+
+# First-party imports
+from utils.cache_utils import ByteLRU
+from utils.metrics_utils import bandwidth_tiers
+
+
+logger = logging.getLogger(__name__)
+
+# Settings a bandwidth tier may override
+TIER_SETTINGS = (
+	"MAX_IMAGE_WIDTH",
+	"MAX_IMAGE_HEIGHT",
+	"IMAGE_COLOR_DEPTH",
+	"DITHERING_ALGORITHM",
+	"MAX_IMAGES_PER_PAGE",
+	"PAGE_SPLIT_BYTES",
+)
+
+
+class ThroughputMeter:
+	"""
+	Each client's download throughput in kbit/s, for at most max_clients
+	clients (least recently measured forgotten first). Samples are averaged
+	on a log scale, each weighted by smoothing, so one unusually fast or slow
+	response moves the estimate by a factor rather than by orders of magnitude.
+	An estimate not updated for max_age seconds is forgotten, so a client
+	whose responses have become too small to measure is measured afresh.
+	"""
+	def __init__(self, smoothing=0.3, max_clients=256, max_age=600):
+		self.smoothing = smoothing
+		self.max_age = max_age
+		# (log of the estimate, when it was last updated) by client
+		self._estimates = ByteLRU(max_clients, sizeof=lambda item: 1)
+		self._lock = threading.Lock()
+
+	def record(self, client, kbps):
+		sample = math.log(max(kbps, 1))
+		with self._lock:
+			estimate = self._current(client)
+			if estimate is not None:
+				sample = estimate + self.smoothing * (sample - estimate)
+			self._estimates.put(client, (sample, time.monotonic()))
+		return math.exp(sample)
+
+	def _current(self, client):
+		item = self._estimates.get(client)
+		if item is None:
+			return None
+		estimate, updated_at = item
+		if self.max_age and time.monotonic() - updated_at > self.max_age:
+			return None
+		return estimate
+
+	def estimate(self, client):
+		"""The client's estimated throughput in kbit/s, or None if it hasn't been measured lately."""
+		estimate = self._current(client)
+		return None if estimate is None else math.exp(estimate)
+
+
+class MeteredBody:
+	"""
+	A WSGI response body that times how long the server blocks writing it to
+	the client. Once it's closed, throughput is worked out from the bytes that
+	can't have fitted in the socket's send buffer and the time spent waiting
+	for them to go out.
+	"""
+	def __init__(self, body, on_close, buffer_bytes):
+		self._body = body
+		self._on_close = on_close
+		self._buffer_bytes = buffer_bytes
+		self.bytes_written = 0
+		self.write_seconds = 0.0
+		self._yielded_at = None
+
+	def __iter__(self):
+		for chunk in self._body:
+			self.bytes_written += len(chunk)
+			self._yielded_at = time.perf_counter()
+			yield chunk
+			# Stop timing before pulling the next chunk, which may wait on upstream
+			self._wrote()
+
+	def _wrote(self):
+		# The server writes each chunk between being handed it and asking for the next
+		if self._yielded_at is not None:
+			self.write_seconds += time.perf_counter() - self._yielded_at
+			self._yielded_at = None
+
+	def close(self):
+		self._wrote()
+		try:
+			if hasattr(self._body, "close"):
+				self._body.close()
+		finally:
+			unbuffered = self.bytes_written - self._buffer_bytes
+			if unbuffered > 0 and self.write_seconds > 0:
+				self._on_close(unbuffered * 8 / 1000 / self.write_seconds, self.bytes_written)
+
+
+class BandwidthTiers:
+	"""
+	Chooses the settings each client gets from its measured download
+	throughput: tiers is a list of dicts, each with a name, the highest
+	throughput it applies to (max_kbps, None for no limit) and TIER_SETTINGS
+	overrides. Clients can be pinned to a tier by IP address. Clients not yet
+	measured (or faster than every tier) get config.py's settings.
+
+	Throughput is measured on responses of at least min_sample_bytes, and a
+	client not measured for max_age seconds gets config.py's settings until it
+	is measured again (tiers' smaller pages and images may never reach
+	min_sample_bytes, which would otherwise keep a client in its tier). The
+	send buffer of every connection is set to send_buffer_bytes, so writes
+	block once that much is waiting to be sent, and only time spent on the
+	bytes beyond it is counted.
+	"""
+	def __init__(self, tiers, pinned=None, min_sample_bytes=64 * 1024, send_buffer_bytes=16 * 1024, smoothing=0.3, max_age=600):
+		for tier in tiers:
+			unknown = set(tier) - {"name", "max_kbps", *TIER_SETTINGS}
+			if unknown:
+				raise ValueError(f"Bandwidth tier {tier.get('name')!r} has unknown settings: {', '.join(sorted(unknown))}")
+		self.tiers = sorted(tiers, key=lambda tier: float("inf") if tier.get("max_kbps") is None else tier["max_kbps"])
+		self.by_name = {tier["name"]: tier for tier in tiers}
+		self.pinned = dict(pinned or {})
+		for address, name in self.pinned.items():
+			if name not in self.by_name:
+				raise ValueError(f"BANDWIDTH_TIER_BY_IP pins {address} to unknown tier {name!r}")
+		self.min_sample_bytes = min_sample_bytes
+		self.send_buffer_bytes = send_buffer_bytes
+		self.meter = ThroughputMeter(smoothing, max_age=max_age)
+
+	def tier_for(self, address):
+		"""The tier (a dict) for a client address, or None for config.py's settings."""
+		if address in self.pinned:
+			return self.by_name[self.pinned[address]]
+		kbps = self.meter.estimate(address)
+		if kbps is None:
+			return None
+		return next((tier for tier in self.tiers if tier.get("max_kbps") is None or kbps <= tier["max_kbps"]), None)
+
+	def select_tier(self):
+		"""before_request hook choosing the current client's tier."""
+		g.bandwidth_tier = self.tier_for(request.remote_addr)
+		bandwidth_tiers.inc(tier=g.bandwidth_tier["name"] if g.bandwidth_tier else "-")
+
+	def wrap(self, app):
+		"""WSGI middleware measuring how fast each client takes its responses."""
+		def metered_app(environ, start_response):
+			connection = environ.get("werkzeug.socket")
+			buffer_bytes = self._set_send_buffer(connection)
+			body = app(environ, start_response)
+			if buffer_bytes is None:
+				return body
+			address = environ.get("REMOTE_ADDR")
+			return MeteredBody(body, lambda kbps, size: self._record(address, kbps, size), buffer_bytes)
+		return metered_app
+
+	def _set_send_buffer(self, connection):
+		"""The connection's send buffer size once set, or None if it can't be measured."""
+		if connection is None:
+			return None
+		try:
+			connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_bytes)
+			# Linux reserves twice the size asked for, and reports that
+			return connection.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+		except OSError:
+			return None
+
+	def _record(self, address, kbps, size):
+		if size < self.min_sample_bytes or address in self.pinned:
+			return
+		previous = self.tier_for(address)
+		estimate = self.meter.record(address, kbps)
+		tier = self.tier_for(address)
+		if tier is not previous:
+			logger.info("Client %s downloads at about %d kbit/s, using bandwidth tier %s",
+				address, estimate, tier["name"] if tier else "(none)")
+
+def tier_setting(config, name, default=None):
+	"""A setting for the current request: its client's bandwidth tier's value, else config.py's."""
+	tier = g.get("bandwidth_tier") if has_request_context() else None
+	if tier is not None and name in tier:
+		return tier[name]
+	return getattr(config, name, default)
+
+def tier_name():
+	"""Name of the current request's bandwidth tier, or "" for config.py's settings."""
+	tier = g.get("bandwidth_tier") if has_request_context() else None
+	return tier["name"] if tier else ""
@@ -0,0 +1,526 @@
+# Standard library imports
+import calendar
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate
+from urllib.parse import urlsplit, urlunsplit
+
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_DIR = os.path.join(os.path.dirname(__file__), "cached_responses")
+
+# Status codes we are willing to store (the "heuristically cacheable" set from
+# RFC 7231, minus the ones the proxy never sees in practice)
+CACHEABLE_STATUS_CODES = (200, 203, 301, 404, 410)
+
+# Headers that describe the connection rather than the representation, and
+# so must never be replayed from the cache
+HOP_BY_HOP_HEADERS = (
+	"connection",
+	"keep-alive",
+	"proxy-authenticate",
+	"proxy-authorization",
+	"te",
+	"trailer",
+	"transfer-encoding",
+	"upgrade",
+)
+
+# Upper bound for heuristic freshness (Last-Modified without explicit expiry)
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+
+
+class ByteLRU:
+	"""
+	A thread-safe LRU mapping that evicts least recently used entries once the
+	combined size of its values exceeds max_bytes.
+	"""
+	def __init__(self, max_bytes, sizeof=len):
+		self.max_bytes = max_bytes
+		self.sizeof = sizeof
+		self.total_bytes = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key not in self._entries:
+				return default
+			self._entries.move_to_end(key)
+			return self._entries[key][0]
+
+	def put(self, key, value):
+		size = self.sizeof(value)
+		if size > self.max_bytes:
+			return False
+		with self._lock:
+			if key in self._entries:
+				self.total_bytes -= self._entries.pop(key)[1]
+			self._entries[key] = (value, size)
+			self.total_bytes += size
+			while self.total_bytes > self.max_bytes:
+				_, (_, evicted_size) = self._entries.popitem(last=False)
+				self.total_bytes -= evicted_size
+		return True
+
+	def pop(self, key, default=None):
+		with self._lock:
+			if key not in self._entries:
+				return default
+			value, size = self._entries.pop(key)
+			self.total_bytes -= size
+			return value
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.total_bytes = 0
+
+	def __contains__(self, key):
+		with self._lock:
+			return key in self._entries
+
+	def __len__(self):
+		with self._lock:
+			return len(self._entries)
+
+def atomic_write(file_path, data):
+	"""
+	Write data to file_path via a temp file in the same directory followed by
+	a rename, so concurrent readers never observe a partially written file.
+	"""
+	directory = os.path.dirname(file_path)
+	os.makedirs(directory, exist_ok=True)
+	fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		os.replace(temp_path, file_path)
+	except BaseException:
+		try:
+			os.unlink(temp_path)
+		except OSError:
+			pass
+		raise
+
+class DiskLRU:
+	"""
+	Files kept in a directory, spread over subdirectories named after the first
+	two characters of each file's name, and capped at max_bytes and max_files.
+	A janitor thread deletes least recently used files every interval seconds,
+	and as soon as a write takes the cache over either cap. Files are written
+	atomically, so a reader never sees a half-written one.
+	"""
+	def __init__(self, directory, max_bytes, max_files, interval=60):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.max_files = max_files
+		self.interval = interval
+		self.total_bytes = 0
+		self._index = OrderedDict()
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._janitor = None
+
+	def shard_dir(self, name):
+		return os.path.join(self.directory, name[:2])
+
+	def path(self, name):
+		return os.path.join(self.shard_dir(name), name)
+
+	def load(self):
+		"""
+		Index the files already in the cache, least recently used (by access or
+		modification time) first, removing any a crash left half-written.
+		"""
+		files = []
+		os.makedirs(self.directory, exist_ok=True)
+		for shard in os.scandir(self.directory):
+			if not shard.is_dir():
+				continue
+			for entry in os.scandir(shard.path):
+				try:
+					if entry.name.startswith(".tmp-"):
+						os.unlink(entry.path)
+						continue
+					stat = entry.stat()
+				except OSError:
+					continue
+				files.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+		with self._lock:
+			self._index.clear()
+			self.total_bytes = 0
+			for _, name, size in sorted(files):
+				self._index[name] = size
+				self.total_bytes += size
+		return len(files)
+
+	def contains(self, name):
+		"""Whether name is cached, counting as a use of it."""
+		with self._lock:
+			if name not in self._index:
+				return False
+			self._index.move_to_end(name)
+		if os.path.exists(self.path(name)):
+			return True
+		self._forget(name)
+		return False
+
+	def touch(self, name):
+		with self._lock:
+			if name in self._index:
+				self._index.move_to_end(name)
+
+	def write(self, name, data):
+		atomic_write(self.path(name), data)
+		with self._lock:
+			self.total_bytes -= self._index.pop(name, 0)
+			self._index[name] = len(data)
+			self.total_bytes += len(data)
+			over = self._over_limits()
+		if over:
+			self._wake.set()
+
+	def _forget(self, name):
+		with self._lock:
+			self.total_bytes -= self._index.pop(name, 0)
+
+	def _over_limits(self):
+		return (self.max_bytes and self.total_bytes > self.max_bytes) or (self.max_files and len(self._index) > self.max_files)
+
+	def evict(self):
+		"""Delete least recently used files until the cache is within its caps. Returns how many were deleted."""
+		evicted = []
+		with self._lock:
+			while self._index and self._over_limits():
+				name, size = self._index.popitem(last=False)
+				self.total_bytes -= size
+				evicted.append(name)
+		for name in evicted:
+			try:
+				os.unlink(self.path(name))
+			except OSError:
+				pass
+		return len(evicted)
+
+	def start_janitor(self):
+		if self._janitor is None:
+			self._janitor = threading.Thread(target=self._run_janitor, name="cache-janitor", daemon=True)
+			self._janitor.start()
+
+	def _run_janitor(self):
+		while True:
+			self._wake.wait(self.interval)
+			self._wake.clear()
+			try:
+				evicted = self.evict()
+			except Exception as e:
+				logger.warning("Error evicting from %s: %s", self.directory, e)
+				continue
+			if evicted:
+				logger.debug("Evicted %d files from %s", evicted, self.directory)
+
+	def __len__(self):
+		with self._lock:
+			return len(self._index)
+
+def canonicalize_url(url):
+	"""
+	Normalize a URL for use as a cache key: lowercase the scheme and host,
+	drop default ports and fragments, and treat https and http as the same
+	resource (the proxy always fetches over http first).
+	"""
+	parts = urlsplit(url)
+	scheme = parts.scheme.lower()
+	if scheme == "https":
+		scheme = "http"
+	host = (parts.hostname or "").lower()
+	if parts.port and parts.port not in (80, 443):
+		host = f"{host}:{parts.port}"
+	path = parts.path or "/"
+	return urlunsplit((scheme, host, path, parts.query, ""))
+
+def parse_cache_control(value):
+	"""
+	Parse a Cache-Control header into a dict of lowercase directive -> value
+	(None for directives without an argument).
+	"""
+	directives = {}
+	if not value:
+		return directives
+	for part in value.split(","):
+		part = part.strip()
+		if not part:
+			continue
+		if "=" in part:
+			name, _, arg = part.partition("=")
+			directives[name.strip().lower()] = arg.strip().strip('"')
+		else:
+			directives[part.lower()] = None
+	return directives
+
+def parse_http_date(value):
+	if not value:
+		return None
+	parsed = parsedate(value)
+	if parsed is None:
+		return None
+	try:
+		return calendar.timegm(parsed)
+	except (TypeError, ValueError, OverflowError):
+		return None
+
+def _header(headers, name):
+	"""Case-insensitive lookup on a plain dict of headers."""
+	name = name.lower()
+	for key, value in headers.items():
+		if key.lower() == name:
+			return value
+	return None
+
+def _int_or_none(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+def freshness_lifetime(headers, now=None):
+	"""
+	Compute how many seconds a response remains fresh from the time it was
+	received, following RFC 7234 section 4.2.
+	"""
+	now = now if now is not None else time.time()
+	directives = parse_cache_control(_header(headers, "Cache-Control"))
+	if "no-cache" in directives:
+		return 0
+
+	date = parse_http_date(_header(headers, "Date")) or now
+	age = _int_or_none(_header(headers, "Age")) or 0
+
+	lifetime = None
+	for directive in ("s-maxage", "max-age"):
+		if directive in directives:
+			lifetime = _int_or_none(directives[directive])
+			if lifetime is not None:
+				break
+	if lifetime is None:
+		expires = _header(headers, "Expires")
+		if expires is not None:
+			expires_at = parse_http_date(expires)
+			# An invalid Expires value (e.g. "0") means "already expired"
+			lifetime = (expires_at - date) if expires_at else 0
+	if lifetime is None:
+		last_modified = parse_http_date(_header(headers, "Last-Modified"))
+		if last_modified and last_modified < date:
+			lifetime = min((date - last_modified) // 10, MAX_HEURISTIC_FRESHNESS)
+		else:
+			lifetime = 0
+
+	return max(0, lifetime - age)
+
+
+class CachedResponse:
+	"""
+	A stored upstream response plus the metadata needed to decide whether it
+	can be served as-is or must be revalidated.
+	"""
+	def __init__(self, url, status_code, headers, content, vary):
+		self.url = url
+		self.status_code = status_code
+		self.headers = headers
+		self.content = content
+		self.vary = vary
+		self.stored_at = time.time()
+		self.fresh_until = self.stored_at + freshness_lifetime(headers, self.stored_at)
+
+	@property
+	def size(self):
+		return len(self.content) + 512
+
+	def is_fresh(self):
+		return time.time() < self.fresh_until
+
+	def validators(self):
+		"""Conditional request headers for revalidating this entry."""
+		validators = {}
+		etag = _header(self.headers, "ETag")
+		if etag:
+			validators["If-None-Match"] = etag
+		last_modified = _header(self.headers, "Last-Modified")
+		if last_modified:
+			validators["If-Modified-Since"] = last_modified
+		return validators
+
+	def matches(self, request_headers):
+		"""Check the request headers named by the Vary header still match."""
+		for name, value in self.vary.items():
+			if _header(request_headers, name) != value:
+				return False
+		return True
+
+	def revalidate(self, not_modified_headers):
+		"""
+		A new entry with the headers of a 304 response merged in and its
+		freshness clock restarted. This one is left untouched, since other
+		threads may be serving it.
+		"""
+		headers = dict(self.headers)
+		for key, value in not_modified_headers.items():
+			if key.lower() in HOP_BY_HOP_HEADERS or key.lower() in ("content-length", "content-encoding"):
+				continue
+			for existing in [k for k in headers if k.lower() == key.lower()]:
+				del headers[existing]
+			headers[key] = value
+		return CachedResponse(self.url, self.status_code, headers, self.content, self.vary)
+
+
+class ResponseCache:
+	"""
+	Two-tier (memory + disk) cache of upstream responses, keyed on the
+	canonical URL and honoring Cache-Control, Expires, Vary and validators.
+	"""
+	def __init__(self, memory_bytes, disk_bytes, max_object_bytes, cache_dir=RESPONSE_CACHE_DIR):
+		self.memory = ByteLRU(memory_bytes, sizeof=lambda entry: entry.size)
+		self.disk_bytes = disk_bytes
+		self.max_object_bytes = max_object_bytes
+		self.cache_dir = cache_dir
+		self._disk_index = OrderedDict()
+		self._disk_total = 0
+		self._disk_lock = threading.Lock()
+		if self.disk_bytes:
+			self._load_disk_index()
+
+	def _key(self, url):
+		return hashlib.sha256(canonicalize_url(url).encode()).hexdigest()
+
+	def _disk_path(self, key):
+		return os.path.join(self.cache_dir, f"{key}.cache")
+
+	def _load_disk_index(self):
+		os.makedirs(self.cache_dir, exist_ok=True)
+		files = []
+		for name in os.listdir(self.cache_dir):
+			if not name.endswith(".cache"):
+				continue
+			try:
+				stat = os.stat(os.path.join(self.cache_dir, name))
+			except OSError:
+				continue
+			files.append((stat.st_mtime, name[:-len(".cache")], stat.st_size))
+		for _, key, size in sorted(files):
+			self._disk_index[key] = size
+			self._disk_total += size
+
+	def _read_disk(self, key):
+		with self._disk_lock:
+			if key not in self._disk_index:
+				return None
+			self._disk_index.move_to_end(key)
+		try:
+			with open(self._disk_path(key), 'rb') as f:
+				return pickle.load(f)
+		except Exception:
+			self._remove_disk(key)
+			return None
+
+	def _write_disk(self, key, entry):
+		data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+		if len(data) > self.disk_bytes:
+			return
+		try:
+			atomic_write(self._disk_path(key), data)
+		except OSError as e:
+			logger.warning("Error writing response cache entry: %s", e)
+			return
+		evicted = []
+		with self._disk_lock:
+			self._disk_total -= self._disk_index.pop(key, 0)
+			self._disk_index[key] = len(data)
+			self._disk_total += len(data)
+			while self._disk_total > self.disk_bytes:
+				old_key, old_size = self._disk_index.popitem(last=False)
+				self._disk_total -= old_size
+				evicted.append(old_key)
+		for old_key in evicted:
+			self._unlink(old_key)
+
+	def _remove_disk(self, key):
+		with self._disk_lock:
+			self._disk_total -= self._disk_index.pop(key, 0)
+		self._unlink(key)
+
+	def _unlink(self, key):
+		try:
+			os.unlink(self._disk_path(key))
+		except OSError:
+			pass
+
+	def lookup(self, url, request_headers):
+		"""
+		Return the stored entry for url (fresh or stale) if its Vary headers
+		match the request, otherwise None.
+		"""
+		key = self._key(url)
+		entry = self.memory.get(key)
+		if entry is None and self.disk_bytes:
+			entry = self._read_disk(key)
+			if entry is not None:
+				self.memory.put(key, entry)
+		if entry is None or not entry.matches(request_headers):
+			return None
+		return entry
+
+	def store(self, url, request_headers, status_code, headers, content):
+		"""
+		Store an upstream response if HTTP caching rules allow a shared cache
+		to keep it. Returns the new entry, or None if it was not stored.
+		"""
+		if status_code not in CACHEABLE_STATUS_CODES:
+			return None
+		if len(content) > self.max_object_bytes:
+			return None
+		directives = parse_cache_control(_header(headers, "Cache-Control"))
+		if "no-store" in directives or "private" in directives:
+			return None
+		if _header(headers, "Set-Cookie") is not None:
+			return None
+		vary_header = _header(headers, "Vary") or ""
+		vary_names = [name.strip().lower() for name in vary_header.split(",") if name.strip()]
+		if "*" in vary_names:
+			return None
+
+		stored_headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+		vary = {name: _header(request_headers, name) for name in vary_names}
+		entry = CachedResponse(canonicalize_url(url), status_code, stored_headers, content, vary)
+
+		# Responses that are neither fresh nor revalidatable are useless to keep
+		if not entry.is_fresh() and not entry.validators():
+			return None
+
+		key = self._key(url)
+		self.memory.put(key, entry)
+		if self.disk_bytes:
+			self._write_disk(key, entry)
+		return entry
+
+	def revalidated(self, url, entry, not_modified_headers):
+		"""Replace an entry after upstream answered 304 Not Modified, returning the new one."""
+		entry = entry.revalidate(dict(not_modified_headers))
+		key = self._key(url)
+		self.memory.put(key, entry)
+		if self.disk_bytes:
+			self._write_disk(key, entry)
+		return entry
+
+	def invalidate(self, url):
+		key = self._key(url)
+		self.memory.pop(key)
+		if self.disk_bytes:
+			self._remove_disk(key)
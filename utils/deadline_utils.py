@@ -0,0 +1,52 @@
+# Standard library imports
+import contextvars
+import time
+
+
+# Absolute time.monotonic() value the current request must finish by, or None
+_deadline = contextvars.ContextVar("macproxy_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+	"""Raised when the current request has run out of time."""
+	def __init__(self, stage=None):
+		self.stage = stage
+		super().__init__(f"Request deadline exceeded{f' during {stage}' if stage else ''}")
+
+
+def start_deadline(seconds):
+	"""
+	Give the current request (thread) `seconds` to finish, or no deadline if
+	seconds is falsy. Returns a token for end_deadline.
+	"""
+	return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+def end_deadline(token):
+	_deadline.reset(token)
+
+def remaining():
+	"""Seconds left before the deadline, or None if there is no deadline."""
+	deadline = _deadline.get()
+	if deadline is None:
+		return None
+	return deadline - time.monotonic()
+
+def check_deadline(stage=None):
+	"""Raise DeadlineExceeded if the current request is out of time."""
+	left = remaining()
+	if left is not None and left <= 0:
+		raise DeadlineExceeded(stage)
+
+def bounded_timeout(timeout, stage="upstream fetch"):
+	"""
+	Shrink a requests-style timeout (a number or a (connect, read) tuple) so
+	it never outlasts the current deadline.
+	"""
+	left = remaining()
+	if left is None:
+		return timeout
+	if left <= 0:
+		raise DeadlineExceeded(stage)
+	if isinstance(timeout, tuple):
+		return tuple(left if t is None else min(t, left) for t in timeout)
+	return left if timeout is None else min(timeout, left)
@@ -0,0 +1,130 @@
+# Standard library imports
+import functools
+
+# First-party imports
+from utils.palette_utils import apple_cube_index, depth_profile, palette_data, palette_image
+
+
+def pillow_engine(img, depth, dither=True):
+	"""
+	Quantize with Pillow's own (C) quantizer, mapping each pixel to the
+	nearest palette color, with Floyd-Steinberg dithering unless dither is False.
+	"""
+	from PIL import Image
+	profile = depth_profile(depth)
+	dither = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
+	if "palette" not in profile:
+		return img.convert("L").convert("1", dither=dither)
+	if not profile.get("color"):
+		# Quantized by luminance; Pillow only quantizes RGB images to a given palette
+		img = img.convert("L").convert("RGB")
+	return img.quantize(palette=palette_image(profile["palette"]), dither=dither)
+
+def numpy_engine(dither_levels):
+	"""
+	An engine reducing each channel to the profile's levels with
+	dither_levels(values, levels), which takes float32 values (0-255) shaped
+	(channels, height, width) and returns the level of each as uint8.
+	"""
+	def engine(img, depth):
+		import numpy
+		from PIL import Image
+		profile = depth_profile(depth)
+		if profile.get("color"):
+			values = numpy.asarray(img.convert("RGB"), dtype=numpy.float32).transpose(2, 0, 1)
+		else:
+			values = numpy.asarray(img.convert("L"), dtype=numpy.float32)[numpy.newaxis]
+		levels = dither_levels(values, profile["levels"])
+
+		if profile.get("color"):
+			# Only the Apple System palette keeps color, and its cube has 6 levels per channel
+			indexes = apple_cube_index(*levels.astype(numpy.uint16)).astype(numpy.uint8)
+		elif "palette" not in profile:
+			# Black and white: saved as a 1-bit image, like Pillow's output
+			return Image.fromarray(levels[0] * 255).convert("1", dither=Image.Dither.NONE)
+		else:
+			indexes = levels[0]
+		output = Image.fromarray(indexes)
+		output.putpalette(palette_data(profile["palette"]))
+		return output
+	return engine
+
+@functools.lru_cache(maxsize=None)
+def bayer_matrix(size):
+	"""size x size Bayer threshold matrix (size a power of two), as fractions between 0 and 1."""
+	import numpy
+	matrix = numpy.zeros((1, 1))
+	while matrix.shape[0] < size:
+		matrix = numpy.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+	return ((matrix + 0.5) / matrix.size).astype(numpy.float32)
+
+def ordered_levels(values, levels, size=8):
+	"""
+	Ordered dithering: each pixel is rounded up or down depending on a
+	threshold tiled over the image, so no pixel depends on another and the
+	whole image is done in a few array operations. The regular pattern also
+	compresses better than error diffusion.
+	"""
+	import numpy
+	matrix = bayer_matrix(size)
+	height, width = values.shape[1:]
+	thresholds = numpy.tile(matrix, (-(-height // size), -(-width // size)))[:height, :width]
+	scaled = values * ((levels - 1) / 255) + thresholds
+	return numpy.clip(numpy.floor(scaled), 0, levels - 1).astype(numpy.uint8)
+
+def atkinson_levels(values, levels):
+	"""
+	Atkinson dithering, as on the original Macintosh: each pixel's rounding
+	error is spread in eighths over six neighbors (ahead of it on its row,
+	and on the two rows below), and the remaining quarter is dropped, which
+	keeps highlights and shadows clean.
+
+	Error diffusion is sequential, but pixel (y, x) only waits for pixels
+	with a smaller x + 2y, so each of those anti-diagonals is done at once,
+	as a strided slice of the flattened image.
+	"""
+	import numpy
+	channels, height, width = values.shape
+	step = 255 / (levels - 1)
+	# One column of padding on the left and two on the right and below,
+	# for the error spread past the edges
+	stride = width + 3
+	errors = numpy.zeros((channels, height + 2, stride), dtype=numpy.float32)
+	errors[:, :height, 1:width + 1] = values
+	errors = errors.reshape(channels, -1)
+	output = numpy.zeros_like(errors, dtype=numpy.uint8)
+	neighbors = (1, 2, stride - 1, stride, stride + 1, 2 * stride)
+
+	for diagonal in range(width + 2 * (height - 1)):
+		first = max(0, (diagonal - width + 2) // 2)
+		last = min(height - 1, diagonal // 2)
+		start = first * stride + diagonal - 2 * first + 1
+		stop = start + (last - first) * (stride - 2) + 1
+		pixels = slice(start, stop, stride - 2)
+
+		level = numpy.clip(numpy.rint(errors[:, pixels] / step), 0, levels - 1)
+		output[:, pixels] = level
+		error = (errors[:, pixels] - level * step) / 8
+		for offset in neighbors:
+			errors[:, start + offset:stop + offset:stride - 2] += error
+	return output.reshape(channels, height + 2, stride)[:, :height, 1:width + 1]
+
+# Dithering engines by DITHERING_ALGORITHM: each takes an RGB image and a
+# DEPTH_PROFILES name and returns the image reduced to that depth
+DITHERING_ENGINES = {
+	"NONE": functools.partial(pillow_engine, dither=False),
+	"FLOYDSTEINBERG": pillow_engine,
+	"ATKINSON": numpy_engine(atkinson_levels),
+	"BAYER4": numpy_engine(functools.partial(ordered_levels, size=4)),
+	"BAYER8": numpy_engine(functools.partial(ordered_levels, size=8)),
+}
+
+def reduce_depth(img, depth, dithering="FLOYDSTEINBERG"):
+	"""An RGB image reduced to one of DEPTH_PROFILES with a DITHERING_ENGINES algorithm, ready to be saved as a GIF."""
+	if depth_profile(depth)["levels"] == 256:
+		# GIFs hold 256 colors, so 8-bit gray needs no dithering
+		return img.convert("L")
+	name = (dithering or "NONE").upper()
+	if name not in DITHERING_ENGINES:
+		raise ValueError(f"Unknown dithering algorithm {dithering!r}, expected one of {', '.join(DITHERING_ENGINES)}")
+	return DITHERING_ENGINES[name](img, depth)
@@ -0,0 +1,59 @@
+class DomainIndex:
+	"""
+	Suffix trie over reversed domain labels ("en.wikipedia.org" is stored as
+	org -> wikipedia -> en). A lookup walks the labels of a host once and
+	returns the value of the most specific domain it falls under, so
+	"notreddit.com" does not match "reddit.com" but "old.reddit.com" does.
+	"""
+	_VALUE = object()
+
+	def __init__(self, domains=None):
+		self._root = {}
+		self._size = 0
+		if domains:
+			items = domains.items() if isinstance(domains, dict) else ((domain, True) for domain in domains)
+			for domain, value in items:
+				self.add(domain, value)
+
+	@staticmethod
+	def labels(host):
+		"""Split a host (or domain) into lowercase labels, ignoring any port."""
+		if not host:
+			return []
+		host = host.strip().lower()
+		if host.startswith("["):
+			# IPv6 literal, optionally with a port: match it as a single label
+			return [host.split("]")[0] + "]"]
+		host = host.split(":")[0].strip(".")
+		if host.startswith("*."):
+			host = host[2:]
+		return host.split(".") if host else []
+
+	def add(self, domain, value=True):
+		labels = self.labels(domain)
+		if not labels:
+			return
+		node = self._root
+		for label in reversed(labels):
+			node = node.setdefault(label, {})
+		if self._VALUE not in node:
+			self._size += 1
+		node[self._VALUE] = value
+
+	def lookup(self, host, default=None):
+		"""Return the value for the most specific domain that host is within."""
+		match = default
+		node = self._root
+		for label in reversed(self.labels(host)):
+			node = node.get(label)
+			if node is None:
+				break
+			if self._VALUE in node:
+				match = node[self._VALUE]
+		return match
+
+	def __contains__(self, host):
+		return self.lookup(host, self._VALUE) is not self._VALUE
+
+	def __len__(self):
+		return self._size
@@ -0,0 +1,99 @@
+# Standard library imports
+import importlib
+import json
+import logging
+import os
+import threading
+
+# First-party imports
+from utils.metrics_utils import timed
+
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "extensions")
+MANIFEST_PATH = os.path.join(EXTENSIONS_DIR, "manifest.json")
+
+
+class Extension:
+	"""
+	An enabled extension, known from extensions/manifest.json by its name,
+	DOMAIN and whether it can take over every request (override). Its module,
+	and whatever libraries it pulls in, is only imported when first used;
+	any other attribute is looked up on the module.
+	"""
+	def __init__(self, name, domain, can_override=False, module=None):
+		self.name = name
+		self.DOMAIN = domain
+		self.can_override = can_override
+		self.__name__ = f"extensions.{name}.{name}"
+		self._module = module
+		self._lock = threading.Lock()
+
+	def load(self):
+		"""Import the extension's module, once, and return it."""
+		if self._module is None:
+			with self._lock:
+				if self._module is None:
+					self._module = self._import()
+		return self._module
+
+	@property
+	def module(self):
+		return self.load()
+
+	@property
+	def loaded(self):
+		return self._module is not None
+
+	def _import(self):
+		with timed("extension_import", extension=self.name):
+			try:
+				module = importlib.import_module(self.__name__)
+			except Exception:
+				logger.exception("Could not load extension '%s'", self.name)
+				raise
+		if getattr(module, "DOMAIN", self.DOMAIN) != self.DOMAIN:
+			logger.warning("Extension '%s' has DOMAIN %r, but extensions/manifest.json says %r",
+				self.name, module.DOMAIN, self.DOMAIN)
+		logger.debug("Loaded extension '%s'", self.name)
+		return module
+
+	def __getattr__(self, attribute):
+		# Only called for attributes not set in __init__
+		if attribute.startswith("__"):
+			raise AttributeError(attribute)
+		return getattr(self.module, attribute)
+
+	def __repr__(self):
+		return f"<Extension {self.name} ({'loaded' if self.loaded else 'not loaded'})>"
+
+
+def read_manifest(path=MANIFEST_PATH):
+	try:
+		with open(path, encoding="utf-8") as f:
+			return json.load(f)
+	except (OSError, ValueError) as e:
+		logger.warning("Could not read %s (%s), importing every extension at startup", path, e)
+		return {}
+
+def load_extensions(names, lazy=True):
+	"""
+	Extension objects for the enabled extensions, by name. Extensions listed
+	in the manifest are imported on first use (or right away, if lazy is
+	False); extensions missing from it are imported now to learn their DOMAIN.
+	"""
+	manifest = read_manifest()
+	extensions = {}
+	for name in names:
+		entry = manifest.get(name)
+		if entry is None:
+			logger.debug("Extension '%s' is not in extensions/manifest.json, importing it now", name)
+			module = importlib.import_module(f"extensions.{name}.{name}")
+			extension = Extension(name, module.DOMAIN, hasattr(module, "get_override_status"), module)
+		else:
+			extension = Extension(name, entry["domain"], entry.get("override", False))
+			if not lazy:
+				extension.load()
+		extensions[name] = extension
+	return extensions
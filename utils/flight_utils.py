@@ -0,0 +1,80 @@
+# Standard library imports
+import threading
+
+# First-party imports
+import config
+from utils.cache_utils import canonicalize_url
+from utils.deadline_utils import DeadlineExceeded, remaining
+from utils.metrics_utils import coalesced_requests
+
+
+COALESCE_REQUESTS = getattr(config, 'COALESCE_REQUESTS', True)
+
+
+class _Call:
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight:
+	"""
+	Coalesces concurrent calls that share a key: the first caller runs the
+	function, and callers arriving while it is still running wait for it and
+	get its result (or exception) instead of repeating the work. Nothing is
+	kept once the call completes; caching is left to the caller.
+	"""
+	def __init__(self, kind):
+		self.kind = kind
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, fn, *args, **kwargs):
+		"""
+		Run fn(*args, **kwargs), or wait for the identical call already in
+		flight. Returns (result, shared), where shared is True for callers that
+		got another caller's result. A waiting caller gives up with
+		DeadlineExceeded when its own request runs out of time.
+		"""
+		if not COALESCE_REQUESTS:
+			return fn(*args, **kwargs), False
+
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+
+		if not leader:
+			coalesced_requests.inc(kind=self.kind)
+			left = remaining()
+			if not call.done.wait(timeout=None if left is None else max(left, 0)):
+				raise DeadlineExceeded(f"shared {self.kind} fetch")
+			if call.error is not None:
+				raise call.error
+			return call.result, True
+
+		try:
+			call.result = fn(*args, **kwargs)
+			return call.result, False
+		except BaseException as e:
+			call.error = e
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.done.set()
+
+	def __len__(self):
+		with self._lock:
+			return len(self._calls)
+
+
+def flight_key(url, headers=None):
+	"""
+	Key for a fetch of url with the given request headers: the canonical URL
+	(as in the response cache) plus every header that is actually sent.
+	"""
+	fields = tuple(sorted((str(k).lower(), str(v)) for k, v in (headers or {}).items() if v is not None))
+	return canonicalize_url(url), fields
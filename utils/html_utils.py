@@ -1,43 +1,71 @@
 # Standard library imports
 import copy
+import functools
 import hashlib
 import html
+import logging
 import re
 
-# Third-party imports
-from bs4 import BeautifulSoup
-from bs4.formatter import HTMLFormatter
+# Third-party imports (bs4, and html5lib with it, are imported on first use
+# rather than at startup)
 from flask import current_app, url_for
 
 # First-party imports
-from utils.image_utils import fetch_and_cache_image
+from utils.cache_utils import ByteLRU
+from utils.deadline_utils import check_deadline
+from utils.domain_utils import DomainIndex
+from utils.flight_utils import SingleFlight
+from utils.image_utils import fetch_and_cache_image, image_cache
+from utils.metrics_utils import timed, record_conversion
+from utils.srcset_utils import pick_image_sources
 from utils.system_utils import load_preset
 
+logger = logging.getLogger(__name__)
+
 # Get config
 config = load_preset()
 
+# Transcoded output and the image cache files it links to (inline SVGs
+# rendered by transcode_html), keyed on the input bytes plus the effective settings
+transcode_cache = ByteLRU(getattr(config, 'TRANSCODE_CACHE_BYTES', 16 * 1024 * 1024), sizeof=lambda item: len(item[0]))
+# Identical transcodes running at the same time, keyed like transcode_cache
+transcode_flights = SingleFlight("transcode")
 
-class URLAwareHTMLFormatter(HTMLFormatter):
-	def __init__(self, *args, **kwargs):
-		super().__init__(*args, **kwargs)
+# Links to the proxy's own /cached_image/ route in transcoded output
+CACHED_IMAGE_LINK = re.compile(rb"/cached_image/([\w.-]+)")
 
-	def escape(self, string):
-		"""
-		Escape special characters in the given string or list of strings.
-		"""
-		if isinstance(string, list):
-			return [html.escape(str(item), quote=True) for item in string]
-		elif string is None:
-			return ''
-		else:
-			return html.escape(str(string), quote=True)
 
-	def attributes(self, tag):
-		for key, val in tag.attrs.items():
-			if key in ['href', 'src']:  # Don't escape URL attributes
-				yield key, val
+@functools.lru_cache(maxsize=None)
+def _url_aware_formatter_class():
+	from bs4.formatter import HTMLFormatter
+
+	class URLAwareHTMLFormatter(HTMLFormatter):
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, **kwargs)
+
+		def escape(self, string):
+			"""
+			Escape special characters in the given string or list of strings.
+			"""
+			if isinstance(string, list):
+				return [html.escape(str(item), quote=True) for item in string]
+			elif string is None:
+				return ''
 			else:
-				yield key, self.escape(val)
+				return html.escape(str(string), quote=True)
+
+		def attributes(self, tag):
+			for key, val in tag.attrs.items():
+				if key in ['href', 'src']:  # Don't escape URL attributes
+					yield key, val
+				else:
+					yield key, self.escape(val)
+
+	return URLAwareHTMLFormatter
+
+def url_aware_formatter():
+	"""An HTMLFormatter that leaves href and src attributes unescaped."""
+	return _url_aware_formatter_class()()
 
 def transcode_content(content):
 	"""
@@ -62,74 +90,189 @@ def transcode_content(content):
 	
 	return content.encode('utf-8')
 
+@functools.lru_cache(maxsize=8)
+def _whitelist_index(whitelisted_domains):
+	return DomainIndex(whitelisted_domains)
+
+def is_whitelisted(url, whitelisted_domains):
+	if not url or not whitelisted_domains:
+		return False
+	from urllib.parse import urlparse
+	domain = urlparse(url).netloc
+	return domain in _whitelist_index(tuple(whitelisted_domains))
+
+def transcode_fingerprint(url=None, **settings):
+	"""
+	Hash everything other than the input bytes that can change the output of
+	transcode_html: its arguments, the image settings used for inline SVGs,
+	whether the URL is whitelisted, and the proxy's own address.
+	"""
+	whitelisted = is_whitelisted(url, settings.get('whitelisted_domains'))
+	image_settings = (
+		config.RESIZE_IMAGES,
+		config.MAX_IMAGE_WIDTH,
+		config.MAX_IMAGE_HEIGHT,
+		config.CONVERT_IMAGES,
+		config.CONVERT_IMAGES_TO_FILETYPE,
+		config.DITHERING_ALGORITHM,
+		getattr(config, 'IMAGE_COLOR_DEPTH', '1bit'),
+	)
+	host_and_port = current_app.config.get('MACPROXY_HOST_AND_PORT')
+	state = repr((sorted(settings.items()), image_settings, whitelisted, host_and_port))
+	return hashlib.sha256(state.encode('utf-8')).hexdigest()
+
+def transcode_key(html, url=None, **settings):
+	"""
+	Key identifying the output of transcode_html(html, url, **settings),
+	worked out without transcoding: the hash of the input bytes and the
+	fingerprint of the settings.
+	"""
+	html_bytes = html.encode('utf-8') if isinstance(html, str) else html
+	return hashlib.sha256(html_bytes).hexdigest() + transcode_fingerprint(url, **settings)
+
+def cached_transcode(key):
+	"""
+	The transcoded output stored under key, or None. Output linking to an
+	inline SVG image the image cache has since evicted is dropped, so the
+	page is transcoded (and the SVG rendered) again; the check counts as a
+	use of each image, keeping a page's images as fresh as the page.
+	"""
+	item = transcode_cache.get(key)
+	if item is None:
+		return None
+	transcoded, image_names = item
+	if all(image_cache.contains(name) for name in image_names):
+		return transcoded
+	logger.debug("Transcoded page links to evicted images, transcoding again")
+	transcode_cache.pop(key)
+	return None
+
+def cached_transcode_html(html, url=None, **settings):
+	"""
+	Same as transcode_html, but returns a previously transcoded result when
+	the input bytes and effective settings are unchanged. Identical
+	transcodes requested at the same time are only run once.
+	"""
+	if transcode_cache.max_bytes <= 0:
+		return transcode_html(html, url, **settings)
+
+	html_bytes = html.encode('utf-8') if isinstance(html, str) else html
+	key = transcode_key(html_bytes, url, **settings)
+	cached = cached_transcode(key)
+	if cached is not None:
+		logger.debug("Transcode cache hit: %s", url)
+		return cached
+
+	def transcode_and_store():
+		transcoded = transcode_html(html_bytes, url, **settings)
+		output = transcoded.encode('utf-8') if isinstance(transcoded, str) else transcoded
+		# SVGs that failed to render were never in the image cache, and can't be missed
+		image_names = {name.decode('ascii') for name in CACHED_IMAGE_LINK.findall(output)}
+		image_names = {name for name in image_names if image_cache.contains(name)}
+		transcode_cache.put(key, (transcoded, image_names))
+		return transcoded
+
+	transcoded, _ = transcode_flights.do(key, transcode_and_store)
+	return transcoded
+
+def limit_images(soup, max_images):
+	"""
+	Replace every image after the first max_images with a link to it (or just
+	its alt text, if it is already inside a link), so slow clients only load
+	the images they ask for.
+	"""
+	for img in soup.find_all("img")[max_images:]:
+		label = f"[{img.get('alt') or 'Image'}]"
+		if img.get("src") and img.find_parent("a") is None:
+			link = soup.new_tag("a", href=img["src"])
+			link.string = label
+			img.replace_with(link)
+		else:
+			img.replace_with(label)
+
 def transcode_html(html, url=None, whitelisted_domains=None, simplify_html=False, 
 				  tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None,
-				  convert_characters=False, conversion_table=None):
+				  convert_characters=False, conversion_table=None, max_image_width=None,
+				  max_image_height=None, max_images=0):
 	"""
 	Uses BeautifulSoup to transcode payloads of the text/html content type
 	"""
+	if max_image_width is None:
+		max_image_width = config.MAX_IMAGE_WIDTH
+	if max_image_height is None:
+		max_image_height = config.MAX_IMAGE_HEIGHT
 
-	if isinstance(html, bytes):
-		html = html.decode("utf-8", errors="replace")
+	size_in = len(html) if isinstance(html, bytes) else len(html.encode('utf-8'))
+	with timed("decode"):
+		if isinstance(html, bytes):
+			html = html.decode("utf-8", errors="replace")
 
-	# Handle character conversion regardless of whitelist status
-	if convert_characters:
-		for key, replacement in conversion_table.items():
-			if isinstance(replacement, bytes):
-				replacement = replacement.decode("utf-8")
-			html = html.replace(key, replacement)
+		# Handle character conversion regardless of whitelist status
+		if convert_characters:
+			for key, replacement in conversion_table.items():
+				if isinstance(replacement, bytes):
+					replacement = replacement.decode("utf-8")
+				html = html.replace(key, replacement)
 
 	# The html5lib parser is required in order to preserve case-sensitivity of
 	# tags. Using html.parser will corrupt SVGs and possibly other XML tags.
-	soup = BeautifulSoup(html, "html5lib")
-
-	# Contents of <pre> tags should always use HTML entities
-	for tag in soup.find_all(['pre']):
-		tag.replace_with(str(tag))
-
-	# Always convert HTTPS to HTTP regardless of whitelist status
-	for tag in soup(['link', 'script', 'img', 'a', 'iframe']):
-		# Handle src attributes
-		if 'src' in tag.attrs:
-			if tag['src'].startswith('https://'):
-				tag['src'] = tag['src'].replace('https://', 'http://')
-			elif tag['src'].startswith('//'):  # Handle protocol-relative URLs
-				tag['src'] = 'http:' + tag['src']
-
-		# Handle href attributes
-		if 'href' in tag.attrs:
-			if tag['href'].startswith('https://'):
-				tag['href'] = tag['href'].replace('https://', 'http://')
-			elif tag['href'].startswith('//'):  # Handle protocol-relative URLs
-				tag['href'] = 'http:' + tag['href']
-
-	# Check if domain is whitelisted
-	is_whitelisted = False
-	if url:
-		from urllib.parse import urlparse
-		domain = urlparse(url).netloc
-		is_whitelisted = any(domain.endswith(whitelisted) for whitelisted in whitelisted_domains)
+	from bs4 import BeautifulSoup
+	with timed("parse"):
+		soup = BeautifulSoup(html, "html5lib")
+
+	simplify = simplify_html and not is_whitelisted(url, whitelisted_domains)
+
+	# Point images at the smallest rendition the page offers that the resized
+	# image still needs, before their URLs are rewritten below
+	if simplify and config.RESIZE_IMAGES and max_image_width and max_image_height:
+		with timed("pick_images"):
+			pick_image_sources(soup, max_image_width, max_image_height, convert=config.CONVERT_IMAGES)
+	if simplify and max_images:
+		limit_images(soup, max_images)
+
+	with timed("rewrite_links"):
+		# Contents of <pre> tags should always use HTML entities
+		for tag in soup.find_all(['pre']):
+			tag.replace_with(str(tag))
+
+		# Always convert HTTPS to HTTP regardless of whitelist status
+		for tag in soup(['link', 'script', 'img', 'a', 'iframe']):
+			# Handle src attributes
+			if 'src' in tag.attrs:
+				if tag['src'].startswith('https://'):
+					tag['src'] = tag['src'].replace('https://', 'http://')
+				elif tag['src'].startswith('//'):  # Handle protocol-relative URLs
+					tag['src'] = 'http:' + tag['src']
+
+			# Handle href attributes
+			if 'href' in tag.attrs:
+				if tag['href'].startswith('https://'):
+					tag['href'] = tag['href'].replace('https://', 'http://')
+				elif tag['href'].startswith('//'):  # Handle protocol-relative URLs
+					tag['href'] = 'http:' + tag['href']
 
 	# Only perform tag/attribute stripping if the domain is not whitelisted and SIMPLIFY_HTML is True
-	if simplify_html and not is_whitelisted:
-		for tag in soup(tags_to_unwrap):
-			tag.unwrap()
-		for tag in soup(tags_to_strip):
-			tag.decompose()
-		for tag in soup():
-			for attr in attributes_to_strip:
-				if attr in tag.attrs:
-					del tag[attr]
-
-	# Always handle meta refresh tags
-	for tag in soup.find_all('meta', attrs={'http-equiv': 'refresh'}):
-		if 'content' in tag.attrs and 'https://' in tag['content']:
-			tag['content'] = tag['content'].replace('https://', 'http://')
-
-	# Always handle CSS with inline URLs
-	for tag in soup.find_all(['style', 'link']):
-		if tag.string:
-			tag.string = tag.string.replace('https://', 'http://')
+	if simplify:
+		with timed("simplify"):
+			for tag in soup(tags_to_unwrap):
+				tag.unwrap()
+			for tag in soup(tags_to_strip):
+				tag.decompose()
+			for tag in soup():
+				for attr in attributes_to_strip:
+					if attr in tag.attrs:
+						del tag[attr]
+
+	with timed("rewrite_inline_urls"):
+		# Always handle meta refresh tags
+		for tag in soup.find_all('meta', attrs={'http-equiv': 'refresh'}):
+			if 'content' in tag.attrs and 'https://' in tag['content']:
+				tag['content'] = tag['content'].replace('https://', 'http://')
+
+		# Always handle CSS with inline URLs
+		for tag in soup.find_all(['style', 'link']):
+			if tag.string:
+				tag.string = tag.string.replace('https://', 'http://')
 
 	# Handle inline SVGs - first pass
 	# if any SVG has a child element containing <use href="#value"> or
@@ -138,23 +281,25 @@ def transcode_html(html, url=None, whitelisted_domains=None, simplify_html=False
 	# contents of the first element with the contents of the second. If the
 	# symbol tag defines a viewport, that viewport needs to be copied to the
 	# parent of the use tag (which should be a svg tag)
-	for use_tag in soup.find_all(['use']):
-		attrs = use_tag.attrs
-		if 'href' in attrs:
-			attr = 'href'
-		elif 'xlink:href' in attrs:
-			attr = 'xlink:href'
-		symbol_tag = soup.find("symbol", {"id": use_tag[attr][1:]})
-		if 'viewBox' in symbol_tag.attrs and use_tag.parent.name == 'svg' and 'viewBox' not in use_tag.parent.attrs:
-			use_tag.parent["viewBox"] = symbol_tag["viewBox"]
-		symbol_tag_copy = copy.copy(symbol_tag)
-		use_tag.replace_with(symbol_tag_copy)
-		symbol_tag_copy.unwrap()
+	with timed("svg_symbols"):
+		for use_tag in soup.find_all(['use']):
+			attrs = use_tag.attrs
+			if 'href' in attrs:
+				attr = 'href'
+			elif 'xlink:href' in attrs:
+				attr = 'xlink:href'
+			symbol_tag = soup.find("symbol", {"id": use_tag[attr][1:]})
+			if 'viewBox' in symbol_tag.attrs and use_tag.parent.name == 'svg' and 'viewBox' not in use_tag.parent.attrs:
+				use_tag.parent["viewBox"] = symbol_tag["viewBox"]
+			symbol_tag_copy = copy.copy(symbol_tag)
+			use_tag.replace_with(symbol_tag_copy)
+			symbol_tag_copy.unwrap()
 
 	# Handle inline SVGs - second pass
 	# Fetch, cache, and convert them - then replace the inline <svg> tag with
 	# an <img> tag whose src attribute points to this proxy _itself_.
 	for tag in soup.find_all(['svg']):
+		check_deadline("SVG rendering")
 
 		# Set height and width equal to the viewport if one is not specified
 		svg_attrs = tag.attrs
@@ -169,17 +314,19 @@ def transcode_html(html, url=None, whitelisted_domains=None, simplify_html=False
 		fake_url = hashlib.md5(str(tag).encode()).hexdigest()
 		convert = config.CONVERT_IMAGES
 		convert_to = config.CONVERT_IMAGES_TO_FILETYPE
-		fetch_and_cache_image(
-			fake_url,
-			str(tag).encode('utf-8'),
-			resize=config.RESIZE_IMAGES,
-			max_width=config.MAX_IMAGE_WIDTH,
-			max_height=config.MAX_IMAGE_HEIGHT,
-			convert=convert,
-			convert_to=convert_to,
-			dithering=config.DITHERING_ALGORITHM,
-			hash_url=False,
-		)
+		with timed("svg_render"):
+			fetch_and_cache_image(
+				fake_url,
+				str(tag).encode('utf-8'),
+				resize=config.RESIZE_IMAGES,
+				max_width=config.MAX_IMAGE_WIDTH,
+				max_height=config.MAX_IMAGE_HEIGHT,
+				convert=convert,
+				convert_to=convert_to,
+				dithering=config.DITHERING_ALGORITHM,
+				color_depth=getattr(config, 'IMAGE_COLOR_DEPTH', '1bit'),
+				hash_url=False,
+			)
 		extension = convert_to.lower() if convert and convert_to else "gif"
 
 		# The _external=True attribute of `url_for` doesn't work here, and will
@@ -195,13 +342,164 @@ def transcode_html(html, url=None, whitelisted_domains=None, simplify_html=False
 		img = soup.new_tag("img", **img_attrs)
 		tag.replace_with(img)
 
-	# Use the custom formatter when converting the soup back to a string
-	html = soup.decode(formatter=URLAwareHTMLFormatter())
+	with timed("serialize"):
+		# Use the custom formatter when converting the soup back to a string
+		html = soup.decode(formatter=url_aware_formatter())
 
-	html = html.replace('<br/>', '<br>')
-	html = html.replace('<hr/>', '<hr>')
-	
-	# Ensure the output is properly encoded
-	html_bytes = html.encode('utf-8')
+		html = html.replace('<br/>', '<br>')
+		html = html.replace('<hr/>', '<hr>')
+
+		# Ensure the output is properly encoded
+		html_bytes = html.encode('utf-8')
 
+	record_conversion("html", size_in, len(html_bytes))
 	return html_bytes
+
+# Containers a page may be cut inside of when they are too big for one page;
+# every other element always stays whole on a single page
+SPLITTABLE_TAGS = {
+	"body", "div", "section", "article", "main", "aside", "header", "footer", "nav",
+	"center", "blockquote", "ul", "ol", "li", "dl", "dd", "table", "tbody", "thead", "tfoot",
+	"tr", "td", "th",
+}
+
+SPLIT_CONTENT_MARKER = "MACPROXYSPLITCONTENT"
+SPLIT_TITLE_MARKER = "MACPROXYSPLITTITLE"
+
+def _byte_length(string):
+	return len(string.encode('utf-8'))
+
+def _split_pieces(soup, element, wrappers, budget, formatter):
+	"""
+	Yield (wrappers, markup) for the children of element, descending into
+	splittable containers that don't fit in budget. wrappers is the stack of
+	(id, opening tag, closing tag) of the containers a piece sits inside.
+	"""
+	from bs4 import Tag
+	# An ordered list reopened on a later page carries on counting from there
+	start = items = None
+	if element.name == "ol" and wrappers:
+		start, items = _list_start(element), 0
+	for child in element.children:
+		if items:
+			element_id, _, closing = wrappers[-1]
+			opening = _opening_tag(soup, element, formatter, start=str(start + items))
+			wrappers = wrappers[:-1] + ((element_id, opening, closing),)
+		if not isinstance(child, Tag):
+			yield wrappers, child.output_ready(formatter)
+			continue
+		markup = child.decode(formatter=formatter)
+		if (_byte_length(markup) > budget and child.name in SPLITTABLE_TAGS
+				and any(isinstance(grandchild, Tag) for grandchild in child.children)):
+			wrapper = (id(child), _opening_tag(soup, child, formatter), f"</{child.name}>")
+			yield from _split_pieces(soup, child, wrappers + (wrapper,), budget, formatter)
+		else:
+			yield wrappers, markup
+		if items is not None and child.name == "li":
+			items += 1
+
+def _opening_tag(soup, tag, formatter, **attrs):
+	closing = f"</{tag.name}>"
+	return soup.new_tag(tag.name, attrs={**tag.attrs, **attrs}).decode(formatter=formatter)[:-len(closing)]
+
+def _list_start(ol):
+	try:
+		return int(ol.get("start", 1))
+	except ValueError:
+		return 1
+
+def _common_depth(a, b):
+	depth = 0
+	while depth < len(a) and depth < len(b) and a[depth][0] == b[depth][0]:
+		depth += 1
+	return depth
+
+def _wrapper_bytes(wrappers):
+	return sum(len(opening) + len(closing) for _, opening, closing in wrappers)
+
+def _paginate(pieces, budget):
+	"""Group pieces into pages of at most budget bytes (a piece too big on its own gets its own page)."""
+	pages = []
+	current = []
+	size = 0
+	stack = ()
+	for wrappers, markup in pieces:
+		depth = _common_depth(stack, wrappers)
+		piece_size = _byte_length(markup) + _wrapper_bytes(wrappers[depth:])
+		if current and size + piece_size > budget and markup.strip():
+			pages.append(current)
+			current, size = [], 0
+			piece_size = _byte_length(markup) + _wrapper_bytes(wrappers)
+		current.append((wrappers, markup))
+		size += piece_size
+		stack = wrappers
+	if current:
+		pages.append(current)
+	return pages
+
+def _render_page(pieces):
+	"""Join a page's pieces, closing and reopening their containers as needed."""
+	output = []
+	stack = ()
+	for wrappers, markup in pieces:
+		depth = _common_depth(stack, wrappers)
+		output.extend(closing for _, _, closing in reversed(stack[depth:]))
+		output.extend(opening for _, opening, _ in wrappers[depth:])
+		output.append(markup)
+		stack = wrappers
+	output.extend(closing for _, _, closing in reversed(stack))
+	return "".join(output)
+
+def _page_navigation(number, count, page_url):
+	links = []
+	if number > 1:
+		links.append(f'<a href="{html.escape(page_url(number - 1))}">Previous page</a>')
+	links.append(f"Page {number} of {count}")
+	if number < count:
+		links.append(f'<a href="{html.escape(page_url(number + 1))}">Next page</a>')
+	return f"<center>{' | '.join(links)}</center>"
+
+def split_html(html, max_bytes, page_url):
+	"""
+	Cut a transcoded page that is bigger than max_bytes into pages that
+	aren't, at block boundaries, each with the original <head> and
+	"Previous page"/"Next page" links. page_url(n) gives the URL of page n.
+	Returns a list of pages as bytes (just [html] if it fits already).
+	"""
+	html_bytes = html.encode('utf-8') if isinstance(html, str) else html
+	if len(html_bytes) <= max_bytes:
+		return [html_bytes]
+
+	from bs4 import BeautifulSoup
+	with timed("split"):
+		soup = BeautifulSoup(html_bytes.decode('utf-8', errors='replace'), "html5lib")
+		body = soup.body
+		if body is None:
+			return [html_bytes]
+		formatter = url_aware_formatter()
+
+		# Leave room for the <head> and the navigation links
+		head_bytes = _byte_length(soup.head.decode(formatter=formatter)) if soup.head else 0
+		budget = max(max_bytes - head_bytes - 512, max_bytes // 2)
+		pages = _paginate(list(_split_pieces(soup, body, (), budget, formatter)), budget)
+		if len(pages) < 2:
+			return [html_bytes]
+
+		# Every page is the original document with its body swapped out
+		body.clear()
+		body.append(SPLIT_CONTENT_MARKER)
+		if soup.title and soup.title.string:
+			soup.title.string = f"{soup.title.string} ({SPLIT_TITLE_MARKER})"
+		template = soup.decode(formatter=formatter)
+
+		output = []
+		for number, pieces in enumerate(pages, 1):
+			navigation = _page_navigation(number, len(pages), page_url)
+			content = f"{_render_page(pieces)}<hr>{navigation}"
+			if number > 1:
+				content = f"{navigation}<hr>{content}"
+			page = template.replace(SPLIT_CONTENT_MARKER, content, 1)
+			page = page.replace(SPLIT_TITLE_MARKER, f"{number} of {len(pages)}", 1)
+			page = page.replace('<br/>', '<br>').replace('<hr/>', '<hr>')
+			output.append(page.encode('utf-8'))
+	return output
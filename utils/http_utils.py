@@ -0,0 +1,90 @@
+# Standard library imports
+import copy
+from http.cookiejar import DefaultCookiePolicy
+
+# Third-party imports
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+# First-party imports
+import config
+from utils.deadline_utils import bounded_timeout
+from utils.flight_utils import SingleFlight, flight_key
+
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
+
+DEFAULT_HEADERS = {
+	"User-Agent": USER_AGENT,
+	"Accept-Language": "en-US,en;q=0.9",
+}
+
+
+class UpstreamSession(requests.Session):
+	"""
+	requests.Session shared by the proxy, every extension, and the image
+	fetcher. Connections (and with them their TLS sessions) are pooled per
+	host and kept alive between requests, every request gets a default
+	(connect, read) timeout that never outlasts the current request's
+	deadline, and headers follow one common policy.
+
+	Cookies set by upstream sites are honored within a single request's
+	redirect chain but never stored on the session, since it is shared by
+	every client of the proxy.
+
+	Identical GETs made at the same time (say, an extension's front page
+	loaded by a room full of machines) share one upstream request. Only
+	plain, fully read GETs are shared: streamed responses and requests
+	carrying a body, cookies or credentials always go upstream on their own.
+	"""
+	def __init__(self, pool_connections=32, pool_maxsize=16, timeout=(5, 30), max_retries=1):
+		super().__init__()
+		self.timeout = timeout
+		adapter = HTTPAdapter(
+			pool_connections=pool_connections,
+			pool_maxsize=pool_maxsize,
+			# Retry failed connections, but never a request the server may
+			# already have acted on (a read timeout is not retried)
+			max_retries=Retry(total=max_retries, connect=max_retries, read=False),
+		)
+		self.mount("http://", adapter)
+		self.mount("https://", adapter)
+		self.headers.update(DEFAULT_HEADERS)
+		self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+		self.flights = SingleFlight("upstream")
+
+	def request(self, method, url, **kwargs):
+		kwargs["timeout"] = bounded_timeout(kwargs.get("timeout") or self.timeout)
+		if not self.can_share(method, kwargs):
+			return super().request(method, url, **kwargs)
+
+		prepared_url = requests.Request(method, url, params=kwargs.get("params")).prepare().url
+		key = (flight_key(prepared_url, kwargs.get("headers")), kwargs.get("allow_redirects", True))
+		response, shared = self.flights.do(key, super().request, method, url, **kwargs)
+		return copy_response(response) if shared else response
+
+	@staticmethod
+	def can_share(method, kwargs):
+		if method.upper() != "GET" or kwargs.get("stream"):
+			return False
+		return not any(kwargs.get(name) for name in ("data", "json", "files", "cookies", "auth"))
+
+
+def copy_response(response):
+	"""A copy of a fully read response that callers can't modify for each other."""
+	copied = copy.copy(response)
+	copied.headers = CaseInsensitiveDict(response.headers)
+	return copied
+
+
+session = UpstreamSession(
+	pool_connections=getattr(config, 'UPSTREAM_POOL_HOSTS', 32),
+	pool_maxsize=getattr(config, 'UPSTREAM_POOL_SIZE_PER_HOST', 16),
+	timeout=(
+		getattr(config, 'UPSTREAM_CONNECT_TIMEOUT', 5),
+		getattr(config, 'UPSTREAM_READ_TIMEOUT', 30),
+	),
+	max_retries=getattr(config, 'UPSTREAM_RETRIES', 1),
+)
@@ -1,18 +1,85 @@
 # Standard library imports
 import hashlib
 import io
+import json
+import logging
 import mimetypes
 import os
+import shutil
 import tempfile
+import time
+from importlib import metadata
 
 # Third-party imports
-import requests
-from PIL import Image, UnidentifiedImageError
-from PILSVG import SVG
+from flask import send_from_directory
 
+# First-party imports
+import config
+from utils.cache_utils import DiskLRU, atomic_write
+from utils.deadline_utils import DeadlineExceeded, check_deadline
+from utils.dither_utils import reduce_depth
+from utils.flight_utils import SingleFlight
+from utils.http_utils import session
+from utils.metrics_utils import timed, record_conversion, collect_metrics, replay_metrics
+from utils.process_utils import JobTimeout, WorkerPool, can_fork, worker_count
+
+
+logger = logging.getLogger(__name__)
 
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "cached_images")
-USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
+CACHE_MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.json")
+
+# Bump when a change to optimize_image (or to how the cache is laid out)
+# makes images cached before it stale
+CACHE_FORMAT_VERSION = 2
+
+# Converted images, least recently served deleted first once either cap is exceeded
+image_cache = DiskLRU(
+	CACHE_DIR,
+	max_bytes=getattr(config, 'IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+	max_files=getattr(config, 'IMAGE_CACHE_MAX_FILES', 50000),
+	interval=getattr(config, 'IMAGE_CACHE_JANITOR_INTERVAL', 60),
+)
+
+# Seconds a converted image is served from the image cache before it is fetched and
+# converted again, in case it changed upstream at the same URL (0 to keep it for good)
+IMAGE_CACHE_MAX_AGE = getattr(config, 'IMAGE_CACHE_MAX_AGE', 24 * 60 * 60)
+
+# Source images bigger than this are refused: IMAGE_MAX_PIXELS before they are decoded (a
+# decompression bomb guard), IMAGE_MAX_DOWNLOAD_BYTES while they are downloaded
+IMAGE_MAX_PIXELS = getattr(config, 'IMAGE_MAX_PIXELS', 40_000_000)
+IMAGE_MAX_DOWNLOAD_BYTES = getattr(config, 'IMAGE_MAX_DOWNLOAD_BYTES', 16 * 1024 * 1024)
+
+# Seconds browsers may use a converted image before asking whether it changed
+BROWSER_IMAGE_MAX_AGE = getattr(config, 'BROWSER_IMAGE_MAX_AGE', 3600)
+
+# Once an image is at least this many times bigger than its target size, it is
+# first shrunk by an integer factor (cheap box reduction), then resampled with
+# LANCZOS the rest of the way. Pillow's docs: 3.0 is indistinguishable from
+# resampling the whole way, and much faster.
+REDUCING_GAP = 3.0
+
+# Chunk size images are downloaded in, so oversized ones are abandoned early
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Conversions of the same image with the same settings running at the same time
+image_flights = SingleFlight("image")
+
+# Worker processes converting images, so conversions run on every CPU core
+# instead of taking turns under the GIL (None: convert on the request thread)
+image_pool = None
+IMAGE_WORKERS = worker_count(getattr(config, 'IMAGE_WORKERS', None))
+if IMAGE_WORKERS and can_fork():
+	image_pool = WorkerPool(
+		"image",
+		IMAGE_WORKERS,
+		queue_size=getattr(config, 'IMAGE_QUEUE_SIZE', None),
+		timeout=getattr(config, 'IMAGE_JOB_TIMEOUT', 20),
+	)
+
+class ImageTooLarge(Exception):
+	"""Raised for source images over IMAGE_MAX_PIXELS or IMAGE_MAX_DOWNLOAD_BYTES."""
+
 
 def get_svg_renderer():
 	# If inkscape is installed and in the path, use that, because it supports
@@ -27,22 +94,117 @@ def get_svg_renderer():
 				break
 	return renderer
 
+def package_version(name):
+	try:
+		return metadata.version(name)
+	except metadata.PackageNotFoundError:
+		return None
+
+def cache_manifest(settings):
+	"""Everything besides the source image that determines a cached image."""
+	return {
+		"version": CACHE_FORMAT_VERSION,
+		"settings": settings,
+		"pillow": package_version("Pillow"),
+		"pillow_svg": package_version("pillow-svg"),
+		"svg_renderer": get_svg_renderer(),
+	}
+
+def prepare_image_cache(settings, clear=False):
+	"""
+	Keep the images converted in earlier runs if they were converted with the
+	same settings (fetch_and_cache_image arguments), renderer and library
+	versions as now; otherwise, or if clear is True, empty the cache. Either
+	way, starts the janitor that keeps the cache within its size limits.
+	"""
+	manifest = cache_manifest(settings)
+	try:
+		with open(CACHE_MANIFEST_PATH, encoding="utf-8") as f:
+			stored = json.load(f)
+	except (OSError, ValueError):
+		stored = None
+
+	if clear or stored != manifest:
+		if not clear and stored is not None:
+			logger.info("Image conversion settings have changed, clearing the image cache")
+		shutil.rmtree(CACHE_DIR, ignore_errors=True)
+		os.makedirs(CACHE_DIR, exist_ok=True)
+		atomic_write(CACHE_MANIFEST_PATH, json.dumps(manifest, indent=1).encode('utf-8'))
+		image_cache.load()
+	else:
+		kept = image_cache.load()
+		logger.info("Keeping %d images converted in earlier runs", kept)
+	image_cache.start_janitor()
+
 def is_image_url(url):
 	mime_type, _ = mimetypes.guess_type(url)
 	return mime_type and mime_type.startswith('image/')
 
 def optimize_image(image_data, resize=True, max_width=512, max_height=342, 
-				  convert=True, convert_to='gif', dithering='FLOYDSTEINBERG'):
+				  convert=True, convert_to='gif', dithering='FLOYDSTEINBERG', color_depth='1bit'):
+	"""
+	Convert an image as configured, in a worker process when there is an
+	image pool. Returns image_data unchanged if it can't be converted.
+	"""
+	settings = dict(
+		resize=resize,
+		max_width=max_width,
+		max_height=max_height,
+		convert=convert,
+		convert_to=convert_to,
+		dithering=dithering,
+		color_depth=color_depth
+	)
 	try:
+		if image_pool is None:
+			return convert_image(image_data, **settings)
+		output, records = image_pool.run(_convert_image_in_worker, image_data, settings)
+		replay_metrics(records)
+		return output
+	except (DeadlineExceeded, JobTimeout, ImageTooLarge):
+		# Not worth caching the unconverted image for
+		raise
+	except Exception as e:
+		logger.warning("Error optimizing image: %s", e)
+		return image_data
+
+def _convert_image_in_worker(image_data, settings):
+	with collect_metrics() as records:
+		output = convert_image(image_data, **settings)
+	return output, records
+
+def convert_image(image_data, resize=True, max_width=512, max_height=342,
+				  convert=True, convert_to='gif', dithering='FLOYDSTEINBERG', color_depth='1bit'):
+	"""optimize_image's conversion itself, raising if the image can't be decoded."""
+	# Imported on first use rather than at startup
+	from PIL import Image, UnidentifiedImageError
 
-		# Try to open the image directly using PIL
-		# If this fails, assume we have an SVG, and try to open it using PILSVG.
-		try:
-			img = Image.open(io.BytesIO(image_data))
-		except UnidentifiedImageError:
-			# PILSVG doesn't support loading an image directly from a
-			# byte stream, only from a file on disk. So create a temp file,
-			# save the image data there, and then pass the path to PILSVG.
+	# Pillow's own check, for the frames and layers the size check below doesn't see
+	Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS or None
+
+	# Try to open the image directly using PIL
+	# If this fails, assume we have an SVG, and try to open it using PILSVG.
+	try:
+		with timed("image_decode") as labels:
+			try:
+				img = Image.open(io.BytesIO(image_data))
+			except Image.DecompressionBombError as e:
+				raise ImageTooLarge(str(e)) from None
+			labels["content_type"] = Image.MIME.get(img.format, "-")
+			width, height = img.size
+			if IMAGE_MAX_PIXELS and width * height > IMAGE_MAX_PIXELS:
+				raise ImageTooLarge(f"{width}x{height} image is over IMAGE_MAX_PIXELS")
+			if resize and max_width and max_height and img.format == "JPEG":
+				# Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding,
+				# staying at least as big as the target size
+				img.draft("RGB", (max_width, max_height))
+			img.load()
+	except UnidentifiedImageError:
+		# PILSVG doesn't support loading an image directly from a
+		# byte stream, only from a file on disk. So create a temp file,
+		# save the image data there, and then pass the path to PILSVG.
+		from PILSVG import SVG
+		with timed("svg_rasterize", content_type="image/svg+xml"):
 			with tempfile.NamedTemporaryFile(delete=False) as fp:
 				try:
 					fp.write(image_data)
@@ -51,91 +213,169 @@ def optimize_image(image_data, resize=True, max_width=512, max_height=342,
 				finally:
 					fp.close()
 					os.unlink(fp.name)
+		labels = {"content_type": "image/svg+xml"}
 
-		# Convert RGBA images to RGB with white background
-		if img.mode == 'RGBA':
-			background = Image.new('RGB', img.size, (255, 255, 255))
-			background.paste(img, mask=img.split()[3])
-			img = background
-		elif img.mode != 'RGB':
-			img = img.convert('RGB')
-		
-		# Resize if enabled and necessary
-		if resize and max_width and max_height:
-			width, height = img.size
-			if width > max_width or height > max_height:
+	# Convert RGBA images to RGB with white background
+	if img.mode == 'RGBA':
+		background = Image.new('RGB', img.size, (255, 255, 255))
+		background.paste(img, mask=img.split()[3])
+		img = background
+	elif img.mode != 'RGB':
+		img = img.convert('RGB')
+	
+	# Resize if enabled and necessary
+	if resize and max_width and max_height:
+		width, height = img.size
+		if width > max_width or height > max_height:
+			with timed("image_resize", **labels):
 				ratio = min(max_width / width, max_height / height)
 				new_size = (int(width * ratio), int(height * ratio))
-				img = img.resize(new_size, Image.Resampling.LANCZOS)
-		
-		# Convert format if enabled
-		if convert and convert_to:
+				img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+	
+	# Convert format if enabled
+	if convert and convert_to:
+		with timed("image_dither", **labels):
 			if convert_to.lower() == 'gif':
-				# For black and white GIF
-				img = img.convert("L")  # Convert to grayscale first
-				dither_method = Image.Dither.FLOYDSTEINBERG if dithering and dithering.upper() == 'FLOYDSTEINBERG' else None
-				img = img.convert("1", dither=dither_method)
+				# Black and white, gray or Apple System palette, as deep as the display
+				img = reduce_depth(img, color_depth, dithering)
 			else:
 				# For other format conversions
 				img = img.convert(img.mode)
-		
+	
+	with timed("image_encode", **labels):
 		output = io.BytesIO()
 		save_format = convert_to.upper() if convert and convert_to else img.format
 		img.save(output, format=save_format, optimize=True)
-		return output.getvalue()
-		
-	except Exception as e:
-		print(f"Error optimizing image: {str(e)}")
-		return image_data
+	record_conversion("image", len(image_data), output.tell())
+	return output.getvalue()
+
+
+def image_file_name(url, convert=True, convert_to='gif', variant="", hash_url=True):
+	"""Name in the image cache of an image converted by fetch_and_cache_image."""
+	extension = convert_to.lower() if convert and convert_to else "gif"
+	suffix = f"-{variant}" if variant else ""
+	if hash_url:
+		return hashlib.md5(url.encode()).hexdigest() + f"{suffix}.{extension}"
+	return url + f"{suffix}.{extension}"
+
+def is_image_cached(url, convert=True, convert_to='gif', variant="", hash_url=True, **settings):
+	"""Whether fetch_and_cache_image(url, **settings) would find the image already converted."""
+	return is_cached_and_fresh(image_file_name(url, convert, convert_to, variant, hash_url))
+
+def is_cached_and_fresh(file_name):
+	"""Whether file_name is in the image cache, and converted less than IMAGE_CACHE_MAX_AGE ago."""
+	if not image_cache.contains(file_name):
+		return False
+	if not IMAGE_CACHE_MAX_AGE:
+		return True
+	try:
+		return time.time() - os.path.getmtime(image_cache.path(file_name)) < IMAGE_CACHE_MAX_AGE
+	except OSError:
+		return False
 
 def fetch_and_cache_image(url, content=None, resize=True, max_width=512, max_height=342,
 						 convert=True, convert_to='gif', dithering='FLOYDSTEINBERG',
-						 hash_url=True):
+						 color_depth='1bit', variant="", hash_url=True):
+	"""
+	Convert an image into the image cache, unless it's there already, and
+	return the /cached_image/ URL it's served from (None if it failed).
+	Images converted with other settings than the usual ones are told apart
+	by variant, which is added to their name.
+	"""
 	try:
-		print(f"Processing image: {url}")
+		logger.debug("Processing image: %s", url)
 		
-		# Generate filename with appropriate extension
-		extension = convert_to.lower() if convert and convert_to else "gif"
-		if hash_url:
-			file_name = hashlib.md5(url.encode()).hexdigest() + f".{extension}"
-		else:
-			file_name = url + f".{extension}"
-		file_path = os.path.join(CACHE_DIR, file_name)
-		
-		if not os.path.exists(file_path):
-			print(f"Optimizing and caching image: {url}")
-			if content is None:
-				response = requests.get(url, stream=True, headers={"User-Agent": USER_AGENT})
-				response.raise_for_status()
-				content = response.content
-			
-			# Only process if image conversion or resizing is enabled
-			if convert or resize:
-				optimized_image = optimize_image(
-					content,
-					resize=resize,
-					max_width=max_width,
-					max_height=max_height,
-					convert=convert,
-					convert_to=convert_to,
-					dithering=dithering
-				)
-			else:
-				optimized_image = content
-				
-			with open(file_path, 'wb') as f:
-				f.write(optimized_image)
+		file_name = image_file_name(url, convert, convert_to, variant, hash_url)
+		if not is_cached_and_fresh(file_name):
+			key = (file_name, resize, max_width, max_height, convert, convert_to, dithering, color_depth)
+			_, shared = image_flights.do(
+				key, cache_image, url, file_name, content,
+				resize=resize,
+				max_width=max_width,
+				max_height=max_height,
+				convert=convert,
+				convert_to=convert_to,
+				dithering=dithering,
+				color_depth=color_depth
+			)
+			if shared:
+				logger.debug("Shared in-flight conversion: %s", url)
 		else:
-			print(f"Image already cached: {url}")
+			logger.debug("Image already cached: %s", url)
 		
 		cached_url = f"/cached_image/{file_name}"
-		print(f"Cached URL: {cached_url}")
+		logger.debug("Cached URL: %s", cached_url)
 		return cached_url
 		
 	except Exception as e:
-		print(f"Error processing image: {url}, Error: {str(e)}")
+		logger.warning("Error processing image: %s, Error: %s", url, e)
 		return None
 
+def cache_image(url, file_name, content=None, resize=True, max_width=512, max_height=342,
+				convert=True, convert_to='gif', dithering='FLOYDSTEINBERG', color_depth='1bit'):
+	"""Fetch (unless content is given), convert and store one image in the cache as file_name."""
+	if is_cached_and_fresh(file_name):
+		# Finished by a conversion that was in flight until just now
+		return
+	logger.debug("Optimizing and caching image: %s", url)
+	if content is None:
+		check_deadline("image fetch")
+		with timed("image_fetch"):
+			content = download_image(url)
+	elif IMAGE_MAX_DOWNLOAD_BYTES and len(content) > IMAGE_MAX_DOWNLOAD_BYTES:
+		raise ImageTooLarge(f"{len(content)} byte image is over IMAGE_MAX_DOWNLOAD_BYTES")
+
+	# Only process if image conversion or resizing is enabled
+	if convert or resize:
+		check_deadline("image processing")
+		optimized_image = optimize_image(
+			content,
+			resize=resize,
+			max_width=max_width,
+			max_height=max_height,
+			convert=convert,
+			convert_to=convert_to,
+			dithering=dithering,
+			color_depth=color_depth
+		)
+	else:
+		optimized_image = content
+
+	# Written under a temporary name and renamed, so the file is never served half-written
+	image_cache.write(file_name, optimized_image)
+
+def download_image(url):
+	"""An image's bytes, giving up as soon as it turns out to be over IMAGE_MAX_DOWNLOAD_BYTES."""
+	with session.get(url, stream=True) as response:
+		response.raise_for_status()
+		limit = IMAGE_MAX_DOWNLOAD_BYTES
+		length = response.headers.get("Content-Length", "")
+		if limit and length.isdigit() and int(length) > limit:
+			raise ImageTooLarge(f"{length} byte image is over IMAGE_MAX_DOWNLOAD_BYTES")
+		content = bytearray()
+		for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+			content += chunk
+			if limit and len(content) > limit:
+				raise ImageTooLarge(f"Image is over IMAGE_MAX_DOWNLOAD_BYTES, stopped after {len(content)} bytes")
+	return bytes(content)
+
+def send_cached_image(cached_url):
+	"""
+	Response serving an image cached by fetch_and_cache_image, given the URL
+	it returned. Its ETag is the image's cache key and when it was converted,
+	and a request whose If-None-Match or If-Modified-Since still matches gets
+	a 304 without the image being read.
+	"""
+	file_name = os.path.basename(cached_url)
+	image_cache.touch(file_name)
+	try:
+		etag = f"{os.path.splitext(file_name)[0]}-{os.stat(image_cache.path(file_name)).st_mtime_ns}"
+	except OSError:
+		# Evicted just now: send_from_directory answers 404
+		etag = False
+	return send_from_directory(image_cache.shard_dir(file_name), file_name, mimetype='image/gif',
+		etag=etag, max_age=BROWSER_IMAGE_MAX_AGE or None)
+
 # Ensure cache directory exists
 if not os.path.exists(CACHE_DIR):
 	os.makedirs(CACHE_DIR)
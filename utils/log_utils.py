@@ -0,0 +1,76 @@
+# Standard library imports
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+# Third-party imports
+from flask import g, has_request_context, request
+
+
+access_logger = logging.getLogger("macproxy.access")
+
+_listener = None
+
+def setup_logging(level="INFO", access_log=True):
+	"""
+	Route all logging through a queue drained by a background thread, so
+	request threads never block on writes to stdout. Safe to call again
+	to change the level.
+	"""
+	global _listener
+	root = logging.getLogger()
+	root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+	access_logger.disabled = not access_log
+
+	# Werkzeug's own per-request line is replaced by our access log
+	logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+	if _listener is not None:
+		return
+
+	log_queue = queue.SimpleQueue()
+	handler = logging.StreamHandler()
+	handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+	_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+	_listener.start()
+	atexit.register(_listener.stop)
+
+	root.handlers = [logging.handlers.QueueHandler(log_queue)]
+
+def note(**fields):
+	"""
+	Attach fields (extension, cache outcome, upstream bytes...) to the
+	current request's access log line.
+	"""
+	if not has_request_context():
+		return
+	if 'access_fields' not in g:
+		g.access_fields = {}
+	g.access_fields.update(fields)
+
+def start_access_log():
+	g.request_started = time.perf_counter()
+
+def write_access_log(response):
+	"""after_request hook emitting one logfmt line per request."""
+	if access_logger.disabled or not access_logger.isEnabledFor(logging.INFO):
+		return response
+	started = g.get('request_started')
+	duration_ms = (time.perf_counter() - started) * 1000 if started else 0
+	fields = g.get('access_fields', {})
+	bytes_out = response.headers.get('Content-Length', '-')
+	access_logger.info(
+		'client=%s method=%s url="%s" status=%s ms=%.1f bytes_in=%s bytes_out=%s extension=%s cache=%s',
+		request.remote_addr,
+		request.method,
+		request.url,
+		response.status_code,
+		duration_ms,
+		fields.get('bytes_in', '-'),
+		bytes_out,
+		fields.get('extension', '-'),
+		fields.get('cache', '-'),
+	)
+	return response
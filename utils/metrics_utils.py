@@ -0,0 +1,243 @@
+# Standard library imports
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+# Third-party imports
+from flask import g, has_request_context
+
+# First-party imports
+import config
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', True)
+
+_registry = []
+
+# Set while collect_metrics() runs: measurements go into this list instead
+_collector = contextvars.ContextVar("macproxy_metrics_collector", default=None)
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, values, extra=None):
+	pairs = list(zip(labelnames, values))
+	if extra:
+		pairs.append(extra)
+	if not pairs:
+		return ""
+	return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_number(value):
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
+
+
+class Counter:
+	"""A monotonically increasing total per combination of label values."""
+	def __init__(self, name, help, labelnames=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self._values = {}
+		self._lock = threading.Lock()
+		_registry.append(self)
+
+	def inc(self, amount=1, **labels):
+		key = tuple(labels.get(name, "-") for name in self.labelnames)
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+		with self._lock:
+			items = sorted(self._values.items())
+		for key, value in items:
+			lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}")
+		return lines
+
+
+class Histogram:
+	"""Observations counted into cumulative buckets per combination of label values."""
+	def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+		self._values = {}
+		self._lock = threading.Lock()
+		_registry.append(self)
+
+	def observe(self, value, **labels):
+		key = tuple(labels.get(name, "-") for name in self.labelnames)
+		index = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			counts, total = self._values.get(key, (None, 0.0))
+			if counts is None:
+				counts = [0] * len(self.buckets)
+			counts[index] += 1
+			self._values[key] = (counts, total + value)
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+		with self._lock:
+			items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+		for key, (counts, total) in items:
+			cumulative = 0
+			for bound, count in zip(self.buckets, counts):
+				cumulative += count
+				labels = _format_labels(self.labelnames, key, ("le", _format_number(float(bound))))
+				lines.append(f"{self.name}_bucket{labels} {cumulative}")
+			labels = _format_labels(self.labelnames, key)
+			lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+			lines.append(f"{self.name}_count{labels} {cumulative}")
+		return lines
+
+
+stage_seconds = Histogram(
+	"macproxy_stage_seconds",
+	"Time spent in each stage of handling a request.",
+	("stage", "extension", "content_type"),
+)
+request_seconds = Histogram(
+	"macproxy_request_seconds",
+	"Time from receiving a request to returning its response headers.",
+	("extension", "content_type", "status"),
+)
+converted_bytes = Counter(
+	"macproxy_converted_bytes_total",
+	"Bytes going into (direction=in) and coming out of (direction=out) transcoding and image conversion.",
+	("kind", "direction"),
+)
+bytes_saved = Counter(
+	"macproxy_bytes_saved_total",
+	"Bytes removed by transcoding and image conversion, counted once per conversion.",
+	("kind",),
+)
+coalesced_requests = Counter(
+	"macproxy_coalesced_requests_total",
+	"Fetches and conversions that waited for an identical one already in flight instead of repeating it.",
+	("kind",),
+)
+pool_jobs = Counter(
+	"macproxy_pool_jobs_total",
+	"Jobs run in worker processes, by outcome (done, failed, timeout, queue_timeout).",
+	("kind", "outcome"),
+)
+prefetches = Counter(
+	"macproxy_prefetches_total",
+	"Links prefetched in the background, by outcome (fetched, used, skipped, disallowed, expired, failed).",
+	("outcome",),
+)
+image_warmups = Counter(
+	"macproxy_image_warmups_total",
+	"Images on served pages converted in the background before the browser asked for them, by outcome (converted, failed, dropped).",
+	("outcome",),
+)
+bandwidth_tiers = Counter(
+	"macproxy_bandwidth_tier_requests_total",
+	"Requests served with each bandwidth tier's settings (tier=- for clients not yet measured).",
+	("tier",),
+)
+
+
+def normalize_content_type(content_type):
+	if not content_type:
+		return "-"
+	return content_type.split(";")[0].strip().lower() or "-"
+
+def request_labels():
+	"""Extension and content type of the current request, as noted for the access log."""
+	fields = g.get('access_fields', {}) if has_request_context() else {}
+	return {
+		"extension": fields.get('extension', "-"),
+		"content_type": normalize_content_type(fields.get('content_type')),
+	}
+
+@contextlib.contextmanager
+def timed(stage, **labels):
+	"""
+	Record how long the block takes in macproxy_stage_seconds. The request's
+	extension and content type are used as labels unless given explicitly;
+	the block can also fill them in later through the yielded dict.
+	"""
+	labels = dict(labels)
+	if not METRICS_ENABLED:
+		yield labels
+		return
+	started = time.perf_counter()
+	try:
+		yield labels
+	finally:
+		elapsed = time.perf_counter() - started
+		records = _collector.get()
+		if records is not None:
+			records.append(("stage", stage, elapsed, labels))
+		else:
+			stage_seconds.observe(elapsed, stage=stage, **{**request_labels(), **labels})
+
+def record_conversion(kind, size_in, size_out):
+	"""Count the bytes in and out of one transcode or image conversion."""
+	if not METRICS_ENABLED:
+		return
+	records = _collector.get()
+	if records is not None:
+		records.append(("conversion", kind, size_in, size_out))
+		return
+	converted_bytes.inc(size_in, kind=kind, direction="in")
+	converted_bytes.inc(size_out, kind=kind, direction="out")
+	bytes_saved.inc(max(size_in - size_out, 0), kind=kind)
+
+@contextlib.contextmanager
+def collect_metrics():
+	"""
+	Keep what timed() and record_conversion() measure in the block in the
+	yielded list instead of recording it, so a worker process can send it
+	back to be recorded by replay_metrics() in the process serving /metrics.
+	"""
+	records = []
+	token = _collector.set(records)
+	try:
+		yield records
+	finally:
+		_collector.reset(token)
+
+def replay_metrics(records):
+	"""Record measurements collected by collect_metrics(), for the current request."""
+	for record in records:
+		if record[0] == "stage":
+			_, stage, elapsed, labels = record
+			stage_seconds.observe(elapsed, stage=stage, **{**request_labels(), **labels})
+		else:
+			record_conversion(*record[1:])
+
+def start_request_timer():
+	g.metrics_started = time.perf_counter()
+
+def record_request(response):
+	"""after_request hook recording the request's overall latency."""
+	started = g.get('metrics_started')
+	if METRICS_ENABLED and started is not None:
+		labels = request_labels()
+		if labels["content_type"] == "-":
+			labels["content_type"] = normalize_content_type(response.headers.get('Content-Type'))
+		request_seconds.observe(time.perf_counter() - started, status=str(response.status_code), **labels)
+	return response
+
+def render_metrics():
+	"""All metrics in the Prometheus text exposition format."""
+	lines = []
+	for metric in _registry:
+		lines.extend(metric.render())
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,72 @@
+# Standard library imports
+import functools
+
+
+# Steps of each channel in the 6x6x6 color cube of the Apple System palette,
+# and of the red, green, blue and gray ramps filling the rest of it
+APPLE_CUBE_LEVELS = (0xFF, 0xCC, 0x99, 0x66, 0x33, 0x00)
+APPLE_RAMP_LEVELS = (0xEE, 0xDD, 0xBB, 0xAA, 0x88, 0x77, 0x55, 0x44, 0x22, 0x11)
+APPLE_BLACK_INDEX = 255
+
+# Output depths for GIFs: how many evenly spaced levels each channel is reduced
+# to, whether color is kept, and the palette the levels are indexes into
+DEPTH_PROFILES = {
+	"1bit": {"levels": 2},
+	"gray4": {"levels": 16, "palette": "gray16"},
+	"gray8": {"levels": 256},
+	"apple8": {"levels": 6, "color": True, "palette": "apple"},
+}
+
+
+def depth_profile(depth):
+	try:
+		return DEPTH_PROFILES[depth]
+	except KeyError:
+		raise ValueError(f"Unknown image color depth {depth!r}, expected one of {', '.join(DEPTH_PROFILES)}") from None
+
+def apple_system_palette():
+	"""
+	The 256 colors of the 8-bit Apple System palette (the default color
+	lookup table of 8-bit Macs) as (r, g, b) tuples, in CLUT order: the color
+	cube from white down, its ramps, and black last.
+	"""
+	cube = [(r, g, b) for r in APPLE_CUBE_LEVELS for g in APPLE_CUBE_LEVELS for b in APPLE_CUBE_LEVELS]
+	colors = cube[:-1]
+	colors += [(level, 0, 0) for level in APPLE_RAMP_LEVELS]
+	colors += [(0, level, 0) for level in APPLE_RAMP_LEVELS]
+	colors += [(0, 0, level) for level in APPLE_RAMP_LEVELS]
+	colors += [(level, level, level) for level in APPLE_RAMP_LEVELS]
+	colors.append((0, 0, 0))
+	return colors
+
+def apple_cube_index(red, green, blue):
+	"""
+	Apple System palette index of a color cube entry, given each channel's
+	level (0 for 0x00 up to 5 for 0xFF). Works on NumPy arrays of levels too.
+	"""
+	index = (5 - red) * 36 + (5 - green) * 6 + (5 - blue)
+	# Black isn't at the end of the cube, but at the end of the palette
+	return index + (index == 215) * (APPLE_BLACK_INDEX - 215)
+
+def gray_palette(levels):
+	"""levels evenly spaced grays, black first."""
+	step = 255 / (levels - 1)
+	return [(round(i * step),) * 3 for i in range(levels)]
+
+PALETTES = {
+	"apple": apple_system_palette,
+	"gray16": functools.partial(gray_palette, 16),
+}
+
+@functools.lru_cache(maxsize=None)
+def palette_data(name):
+	"""A palette as the flat [r, g, b, r, g, b, ...] list Pillow takes; built once per process."""
+	return [channel for color in PALETTES[name]() for channel in color]
+
+@functools.lru_cache(maxsize=None)
+def palette_image(name):
+	"""A "P" image holding a palette, for Image.quantize; built once per process."""
+	from PIL import Image
+	palette = Image.new("P", (1, 1))
+	palette.putpalette(palette_data(name))
+	return palette
@@ -0,0 +1,409 @@
+# Standard library imports
+import html
+import logging
+import mimetypes
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urldefrag, urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+# Third-party imports
+import requests
+
+# First-party imports
+from utils.cache_utils import ByteLRU, canonicalize_url, freshness_lifetime, parse_cache_control
+from utils.deadline_utils import start_deadline, end_deadline
+from utils.http_utils import session
+from utils.image_utils import is_image_url, is_image_cached, fetch_and_cache_image
+from utils.metrics_utils import prefetches, image_warmups
+
+
+logger = logging.getLogger(__name__)
+
+# Name looked up in robots.txt (rules for "*" apply too)
+ROBOTS_USER_AGENT = "Macproxy"
+ROBOTS_TTL = 60 * 60
+ROBOTS_TIMEOUT = 5
+
+# How often a waiting worker checks whether the proxy has become idle
+IDLE_POLL_SECONDS = 0.5
+
+# Types a link may point to and still be worth prefetching (None: no file extension)
+PAGE_TYPES = (None, "text/html", "application/xhtml+xml")
+
+TAG_PATTERNS = {
+	"a": re.compile(r"<a\s[^>]*>", re.IGNORECASE),
+	"img": re.compile(r"<img\s[^>]*>", re.IGNORECASE),
+	"meta": re.compile(r"<meta\s[^>]*>", re.IGNORECASE),
+}
+ATTRIBUTE_PATTERN = re.compile(r"""([a-zA-Z_:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+
+_active_requests = 0
+_active_lock = threading.Lock()
+
+
+def request_started():
+	"""before_request hook counting the requests being served right now."""
+	global _active_requests
+	with _active_lock:
+		_active_requests += 1
+
+def request_finished(exc):
+	"""teardown_request counterpart of request_started."""
+	global _active_requests
+	with _active_lock:
+		_active_requests -= 1
+
+def active_requests():
+	with _active_lock:
+		return _active_requests
+
+def system_load():
+	"""1-minute load average per CPU, or None where the OS doesn't report one."""
+	try:
+		return os.getloadavg()[0] / (os.cpu_count() or 1)
+	except (AttributeError, OSError):
+		return None
+
+def tags(page_html, name):
+	"""Attribute dicts (lowercase names, unescaped values) of every `name` tag in page_html."""
+	for tag in TAG_PATTERNS[name].findall(page_html):
+		attributes = {}
+		for attribute, double, single, bare in ATTRIBUTE_PATTERN.findall(tag[len(name) + 1:]):
+			attributes[attribute.lower()] = html.unescape(double or single or bare)
+		yield attributes
+
+def site(host):
+	host = (host or "").lower()
+	return host[4:] if host.startswith("www.") else host
+
+def is_nofollow(page_html):
+	for meta in tags(page_html, "meta"):
+		if meta.get("name", "").lower() == "robots":
+			directives = [d.strip() for d in meta.get("content", "").lower().split(",")]
+			if "nofollow" in directives or "none" in directives:
+				return True
+	return False
+
+def select_links(page_url, page_html, limit):
+	"""
+	The first `limit` distinct same-site links on a page that a client might
+	follow next: plain http(s) links to pages, in document order, skipping
+	rel="nofollow" links and everything on pages marked nofollow.
+	"""
+	if limit <= 0 or is_nofollow(page_html):
+		return []
+	page_site = site(urlsplit(page_url).hostname)
+	seen = {canonicalize_url(page_url)}
+	links = []
+	for anchor in tags(page_html, "a"):
+		href = anchor.get("href")
+		if not href or "download" in anchor or "nofollow" in anchor.get("rel", "").lower().split():
+			continue
+		url = urldefrag(urljoin(page_url, href))[0]
+		parts = urlsplit(url)
+		if parts.scheme not in ("http", "https") or site(parts.hostname) != page_site:
+			continue
+		if mimetypes.guess_type(parts.path)[0] not in PAGE_TYPES:
+			continue
+		key = canonicalize_url(url)
+		if key in seen:
+			continue
+		seen.add(key)
+		links.append(url)
+		if len(links) >= limit:
+			break
+	return links
+
+def select_images(page_url, page_html, limit):
+	"""Up to `limit` distinct image URLs on a (transcoded) page, skipping images Macproxy already serves."""
+	images = []
+	for img in tags(page_html, "img"):
+		src = img.get("src")
+		if not src:
+			continue
+		url = urldefrag(urljoin(page_url, src))[0]
+		parts = urlsplit(url)
+		if parts.scheme not in ("http", "https") or parts.path.startswith("/cached_image/"):
+			continue
+		if is_image_url(url) and url not in images:
+			images.append(url)
+			if len(images) >= limit:
+				break
+	return images
+
+
+class RobotsCache:
+	"""robots.txt rules per origin, fetched on first use and kept for ttl seconds."""
+	def __init__(self, ttl=ROBOTS_TTL, max_origins=256):
+		self.ttl = ttl
+		self._parsers = ByteLRU(max_origins, sizeof=lambda item: 1)
+
+	def allowed(self, url):
+		parts = urlsplit(url)
+		origin = f"{parts.scheme}://{parts.netloc}"
+		item = self._parsers.get(origin)
+		if item is None or time.monotonic() - item[0] > self.ttl:
+			item = (time.monotonic(), self._fetch(origin))
+			self._parsers.put(origin, item)
+		return item[1].can_fetch(ROBOTS_USER_AGENT, url)
+
+	def _fetch(self, origin):
+		parser = RobotFileParser(f"{origin}/robots.txt")
+		try:
+			resp = session.get(f"{origin}/robots.txt", timeout=ROBOTS_TIMEOUT)
+		except requests.RequestException:
+			# Can't tell what the site allows, so leave it alone
+			parser.disallow_all = True
+			return parser
+		if resp.status_code in (401, 403) or resp.status_code >= 500:
+			parser.disallow_all = True
+		elif resp.status_code >= 400:
+			parser.allow_all = True
+		else:
+			parser.parse(resp.text.splitlines())
+		return parser
+
+
+def prefetch_lifetime(headers, ttl):
+	"""
+	Seconds a prefetched response may be kept: ttl, capped at its freshness
+	lifetime when upstream says how long it stays fresh, and 0 for no-store.
+	Responses that don't say are kept for ttl, as a heuristic lifetime.
+	"""
+	headers = {key.lower(): value for key, value in headers.items()}
+	directives = parse_cache_control(headers.get("cache-control"))
+	if "no-store" in directives:
+		return 0
+	explicit = {"no-cache", "max-age", "s-maxage"} & directives.keys()
+	if explicit or "expires" in headers or "last-modified" in headers:
+		return min(ttl, freshness_lifetime(headers))
+	return ttl
+
+
+class Prefetcher:
+	"""
+	Fetches the links a client is likely to follow next while it is still
+	rendering the current page, and keeps the results for ttl seconds (or
+	less, if upstream says they go stale sooner).
+
+	fetch_page(url, headers, settings) runs on a worker thread and returns a
+	(content, status_code, headers) tuple to keep, or None; settings are
+	those of the client whose page the link was on. Work is
+	limited per host (max_per_host pending links) and globally (max_queued),
+	and workers stay idle while more than max_active_requests client requests
+	are being served or the load average per CPU is above max_load.
+	"""
+	def __init__(self, fetch_page, workers=2, links_per_page=3, max_per_host=4, max_queued=32,
+				 max_active_requests=2, max_load=0.75, ttl=120, cache_bytes=16 * 1024 * 1024, deadline=30):
+		self.fetch_page = fetch_page
+		self.workers = workers
+		self.links_per_page = links_per_page
+		self.max_per_host = max_per_host
+		self.max_active_requests = max_active_requests
+		self.max_load = max_load
+		self.ttl = ttl
+		self.deadline = deadline
+		self.robots = RobotsCache()
+		# (expires_at, response) by canonical URL
+		self.cache = ByteLRU(cache_bytes, sizeof=lambda item: len(item[1][0]) + 512)
+		self._queue = queue.Queue(maxsize=max_queued)
+		self._pending_urls = set()
+		self._pending_hosts = {}
+		self._lock = threading.Lock()
+		self._threads = []
+
+	def is_busy(self):
+		if active_requests() > self.max_active_requests:
+			return True
+		load = system_load()
+		return load is not None and load > self.max_load
+
+	def take(self, url):
+		"""The prefetched (content, status_code, headers) for url, if still fresh."""
+		key = canonicalize_url(url)
+		item = self.cache.get(key)
+		if item is None:
+			return None
+		expires_at, (content, status_code, headers) = item
+		if time.monotonic() > expires_at:
+			self.cache.pop(key)
+			return None
+		prefetches.inc(outcome="used")
+		return content, status_code, dict(headers)
+
+	def schedule(self, page_url, page_html, headers, settings=None):
+		"""
+		Queue the links on a page just served to a client, to be fetched with
+		its request headers and settings. Returns how many were queued.
+		"""
+		if self.is_busy():
+			return 0
+		scheduled = 0
+		for url in select_links(page_url, page_html, self.links_per_page):
+			key = canonicalize_url(url)
+			host = urlsplit(key).hostname
+			if key in self.cache:
+				continue
+			with self._lock:
+				if key in self._pending_urls or self._pending_hosts.get(host, 0) >= self.max_per_host:
+					continue
+				try:
+					self._queue.put_nowait((url, key, host, headers, settings, time.monotonic()))
+				except queue.Full:
+					break
+				self._pending_urls.add(key)
+				self._pending_hosts[host] = self._pending_hosts.get(host, 0) + 1
+			scheduled += 1
+		if scheduled:
+			self._start_workers()
+		return scheduled
+
+	def _start_workers(self):
+		with self._lock:
+			while len(self._threads) < self.workers:
+				thread = threading.Thread(target=self._work, name=f"prefetch-{len(self._threads)}", daemon=True)
+				thread.start()
+				self._threads.append(thread)
+
+	def _wait_until_idle(self, queued_at):
+		"""Wait while the proxy is busy; False if the link went stale meanwhile."""
+		while self.is_busy():
+			if time.monotonic() - queued_at > self.ttl:
+				return False
+			time.sleep(IDLE_POLL_SECONDS)
+		return time.monotonic() - queued_at <= self.ttl
+
+	def _work(self):
+		while True:
+			url, key, host, headers, settings, queued_at = self._queue.get()
+			try:
+				self._prefetch(url, key, headers, settings, queued_at)
+			except Exception as e:
+				prefetches.inc(outcome="failed")
+				logger.debug("Prefetch of %s failed: %s", url, e)
+			finally:
+				with self._lock:
+					self._pending_urls.discard(key)
+					self._pending_hosts[host] -= 1
+					if not self._pending_hosts[host]:
+						del self._pending_hosts[host]
+				self._queue.task_done()
+
+	def _prefetch(self, url, key, headers, settings, queued_at):
+		if not self._wait_until_idle(queued_at):
+			prefetches.inc(outcome="expired")
+			return
+		if not self.robots.allowed(url):
+			prefetches.inc(outcome="disallowed")
+			logger.debug("Not prefetching %s: excluded by robots.txt", url)
+			return
+		token = start_deadline(self.deadline)
+		try:
+			result = self.fetch_page(url, headers, settings)
+		finally:
+			end_deadline(token)
+		lifetime = 0 if result is None else prefetch_lifetime(result[2], self.ttl)
+		if lifetime <= 0:
+			prefetches.inc(outcome="skipped")
+			return
+		self.cache.put(key, (time.monotonic() + lifetime, result))
+		prefetches.inc(outcome="fetched")
+		logger.debug("Prefetched %s", url)
+
+
+class ImageWarmer:
+	"""
+	Converts the images on a page just served into the image cache in the
+	background, so the browser's requests for them (often made one or two
+	at a time) find them ready. At most max_queued images wait, hosts take
+	turns, and no host has more than max_per_host images fetched at once.
+	Images for which accept(url) is False are left alone.
+	"""
+	def __init__(self, workers=4, max_per_host=2, max_queued=64, images_per_page=20, deadline=30, accept=None):
+		self.accept = accept
+		self.workers = workers
+		self.max_per_host = max_per_host
+		self.max_queued = max_queued
+		self.images_per_page = images_per_page
+		self.deadline = deadline
+		# Images waiting per host, in the order hosts get their turn
+		self._waiting = OrderedDict()
+		self._queued = 0
+		self._pending = set()
+		self._active = {}
+		self._condition = threading.Condition()
+		self._threads = []
+
+	def schedule(self, page_url, page_html, settings):
+		"""
+		Queue the images on a page to be converted with settings
+		(fetch_and_cache_image arguments). Returns how many were queued.
+		"""
+		scheduled = 0
+		for url in select_images(page_url, page_html, self.images_per_page):
+			if (self.accept is not None and not self.accept(url)) or is_image_cached(url, **settings):
+				continue
+			key = (url, settings.get("variant", ""))
+			with self._condition:
+				if key in self._pending:
+					continue
+				if self._queued >= self.max_queued:
+					image_warmups.inc(outcome="dropped")
+					break
+				host = urlsplit(url).hostname
+				self._waiting.setdefault(host, deque()).append((url, key, settings))
+				self._pending.add(key)
+				self._queued += 1
+				self._condition.notify()
+			scheduled += 1
+		if scheduled:
+			self._start_workers()
+		return scheduled
+
+	def _start_workers(self):
+		with self._condition:
+			while len(self._threads) < self.workers:
+				thread = threading.Thread(target=self._work, name=f"image-warmup-{len(self._threads)}", daemon=True)
+				thread.start()
+				self._threads.append(thread)
+
+	def _next(self):
+		"""Wait for an image whose host is below max_per_host; hosts are served round-robin."""
+		with self._condition:
+			while True:
+				for host, images in self._waiting.items():
+					if self._active.get(host, 0) < self.max_per_host:
+						url, key, settings = images.popleft()
+						if images:
+							# To the back of the line
+							self._waiting.move_to_end(host)
+						else:
+							del self._waiting[host]
+						self._queued -= 1
+						self._active[host] = self._active.get(host, 0) + 1
+						return host, url, key, settings
+				self._condition.wait()
+
+	def _work(self):
+		while True:
+			host, url, key, settings = self._next()
+			token = start_deadline(self.deadline)
+			try:
+				converted = fetch_and_cache_image(url, **settings)
+				image_warmups.inc(outcome="converted" if converted else "failed")
+			except Exception as e:
+				image_warmups.inc(outcome="failed")
+				logger.debug("Warming up %s failed: %s", url, e)
+			finally:
+				end_deadline(token)
+				with self._condition:
+					self._pending.discard(key)
+					self._active[host] -= 1
+					if not self._active[host]:
+						del self._active[host]
+					self._condition.notify_all()
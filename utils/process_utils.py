@@ -0,0 +1,190 @@
+# Standard library imports
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+# First-party imports
+from utils.deadline_utils import DeadlineExceeded, remaining
+from utils.metrics_utils import pool_jobs
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobTimeout(Exception):
+	"""Raised when a job takes longer than its pool allows, or can't be queued in time."""
+
+
+class _PoolKilled(Exception):
+	"""A job was lost because its pool was killed to stop another job."""
+
+
+def can_fork():
+	"""
+	Whether worker processes can be forked from the running proxy. Other
+	start methods would re-run proxy.py in every worker, and forking isn't
+	safe on macOS.
+	"""
+	return "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+
+def _init_worker(parent_pid):
+	# Ctrl+C is for the proxy, which stops its workers as it exits
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	# If the proxy is killed instead, exit with it
+	threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+
+def _exit_with_parent(parent_pid):
+	while os.getppid() == parent_pid:
+		time.sleep(1)
+	os._exit(0)
+
+
+class WorkerPool:
+	"""
+	Runs CPU-bound functions in worker processes, forked by start() (best
+	called before the proxy starts any threads) or else on first use. At
+	most workers + queue_size jobs are handed to the pool at once; callers
+	beyond that wait for a slot. A job that takes longer than timeout
+	seconds (or than the request has left) is abandoned, and its caller gets
+	JobTimeout (or DeadlineExceeded). A running job can't be stopped any
+	other way, so its pool's processes are killed and a new pool forked;
+	other jobs lost with them are run again once.
+
+	fn and its arguments and result must be picklable; fn runs with none of
+	the request's context, and its exceptions are re-raised in the caller.
+	"""
+	def __init__(self, kind, workers, queue_size=None, timeout=30):
+		self.kind = kind
+		self.workers = workers
+		self.timeout = timeout
+		self._slots = threading.BoundedSemaphore(workers + (workers * 2 if queue_size is None else queue_size))
+		self._executor = None
+		self._lock = threading.Lock()
+
+	def _get_executor(self):
+		with self._lock:
+			if self._executor is None:
+				logger.debug("Starting %d %s worker processes", self.workers, self.kind)
+				self._executor = concurrent.futures.ProcessPoolExecutor(
+					max_workers=self.workers,
+					mp_context=multiprocessing.get_context("fork"),
+					initializer=_init_worker,
+					initargs=(os.getpid(),),
+				)
+			return self._executor
+
+	def start(self):
+		"""Fork the worker processes now rather than on the first job."""
+		# ProcessPoolExecutor forks its workers when it is given its first job
+		self._get_executor().submit(int).result()
+
+	def _discard_executor(self, executor):
+		"""Replace a pool whose worker died; the next job starts a new one."""
+		with self._lock:
+			if self._executor is executor:
+				self._executor = None
+		executor.shutdown(wait=False, cancel_futures=True)
+
+	def _kill_executor(self, executor):
+		"""Replace a pool running a job that overran, killing its processes."""
+		executor.killed = True
+		with self._lock:
+			if self._executor is executor:
+				self._executor = None
+		for process in list((getattr(executor, "_processes", None) or {}).values()):
+			try:
+				process.kill()
+			except (OSError, ValueError):
+				pass
+		executor.shutdown(wait=False, cancel_futures=True)
+
+	def _wait_time(self, stage):
+		left = remaining()
+		if left is None:
+			return self.timeout, False
+		if left <= 0:
+			raise DeadlineExceeded(stage)
+		return min(self.timeout, left), left < self.timeout
+
+	def _stop_after(self, executor, future, delay):
+		"""Kill executor's processes if future is still running after delay seconds."""
+		def stop():
+			if not future.done():
+				logger.warning("A %s job ran for over %.1fs, restarting the pool", self.kind, self.timeout)
+				self._kill_executor(executor)
+		if delay <= 0:
+			stop()
+			return
+		timer = threading.Timer(delay, stop)
+		timer.daemon = True
+		timer.start()
+
+	def run(self, fn, *args, **kwargs):
+		"""Run fn(*args, **kwargs) in a worker process and return its result."""
+		try:
+			return self._run(fn, args, kwargs)
+		except _PoolKilled:
+			logger.debug("Running a %s job again after its pool was killed", self.kind)
+		try:
+			return self._run(fn, args, kwargs)
+		except _PoolKilled:
+			raise BrokenProcessPool(f"{self.kind} pool was killed twice while running a job") from None
+
+	def _run(self, fn, args, kwargs):
+		wait, deadline_first = self._wait_time(f"{self.kind} queue")
+		if not self._slots.acquire(timeout=wait):
+			pool_jobs.inc(kind=self.kind, outcome="queue_timeout")
+			if deadline_first:
+				raise DeadlineExceeded(f"{self.kind} queue")
+			raise JobTimeout(f"No {self.kind} worker free after {wait:.1f}s")
+
+		executor = self._get_executor()
+		try:
+			future = executor.submit(fn, *args, **kwargs)
+		except BaseException as e:
+			self._slots.release()
+			if getattr(executor, "killed", False) and isinstance(e, (BrokenProcessPool, RuntimeError)):
+				# Killed by another thread since we got it
+				raise _PoolKilled() from None
+			if isinstance(e, BrokenProcessPool):
+				self._discard_executor(executor)
+			raise
+		# The slot is held until the job is really over, even if its caller gave up
+		future.add_done_callback(lambda _: self._slots.release())
+
+		wait, deadline_first = self._wait_time(f"{self.kind} job")
+		try:
+			result = future.result(timeout=wait)
+		except concurrent.futures.TimeoutError:
+			if not future.cancel():
+				# Already running: give it the rest of the pool's timeout, then stop it
+				self._stop_after(executor, future, self.timeout - wait)
+			pool_jobs.inc(kind=self.kind, outcome="timeout")
+			if deadline_first:
+				raise DeadlineExceeded(f"{self.kind} job")
+			raise JobTimeout(f"{self.kind} job took longer than {wait:.1f}s")
+		except BrokenProcessPool:
+			if getattr(executor, "killed", False):
+				raise _PoolKilled() from None
+			pool_jobs.inc(kind=self.kind, outcome="failed")
+			logger.warning("A %s worker process died, restarting the pool", self.kind)
+			self._discard_executor(executor)
+			raise
+		except Exception:
+			pool_jobs.inc(kind=self.kind, outcome="failed")
+			raise
+		pool_jobs.inc(kind=self.kind, outcome="done")
+		return result
+
+
+def worker_count(setting):
+	"""Worker count for a *_WORKERS setting: None means one per CPU core, 0 means no pool."""
+	if setting is None:
+		return os.cpu_count() or 1
+	return max(int(setting), 0)
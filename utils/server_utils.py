@@ -0,0 +1,156 @@
+# Standard library imports
+import logging
+import queue
+import socket
+import threading
+from http import HTTPStatus
+
+# Third-party imports
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+logger = logging.getLogger(__name__)
+
+BUSY_RESPONSE_BODY = b"<html><body><p>Macproxy is busy, please try again in a moment.</p></body></html>"
+BUSY_RESPONSE = (
+	b"HTTP/1.0 503 Service Unavailable\r\n"
+	b"Content-Type: text/html\r\n"
+	b"Content-Length: " + str(len(BUSY_RESPONSE_BODY)).encode() + b"\r\n"
+	b"Retry-After: 1\r\n"
+	b"Connection: close\r\n"
+	b"\r\n" + BUSY_RESPONSE_BODY
+)
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+	"""
+	Request handler that keeps connections open between requests, both for
+	HTTP/1.1 clients and HTTP/1.0 clients that send "Connection: keep-alive".
+	"""
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		super().setup()
+		self.requests_served = 0
+		# Headers and body go out in separate writes; without this, Nagle holds
+		# the body back until the client's delayed ACK of the headers (~40 ms)
+		try:
+			self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		except OSError:
+			pass
+
+	def handle_one_request(self):
+		server = self.server
+		# Only wait keep_alive_timeout for a follow-up request on an idle
+		# connection, but give the request itself (and slow clients reading a
+		# large response) the full request_timeout.
+		self.connection.settimeout(server.keep_alive_timeout if self.requests_served else server.request_timeout)
+		self.raw_requestline = self.rfile.readline(65537)
+		if len(self.raw_requestline) > 65536:
+			# As BaseHTTPRequestHandler does
+			self.requestline = ""
+			self.request_version = ""
+			self.command = ""
+			self.send_error(HTTPStatus.REQUEST_URI_TOO_LONG)
+			self.close_connection = True
+			return
+		if not self.raw_requestline:
+			self.close_connection = True
+			return
+		self.connection.settimeout(server.request_timeout)
+		if not self.parse_request():
+			return
+
+		self.requests_served += 1
+		# Give the worker back to the pool if others are queued or this
+		# connection has been reused enough times
+		if self.requests_served >= server.max_keep_alive_requests or not server.request_queue.empty():
+			self.close_connection = True
+
+		self.run_wsgi()
+
+	def end_headers(self):
+		# HTTP/1.0 clients assume the connection closes unless told otherwise
+		if not self.close_connection and self.request_version == "HTTP/1.0":
+			self.send_header("Connection", "keep-alive")
+		super().end_headers()
+
+	def connection_dropped(self, error, environ=None):
+		self.close_connection = True
+
+
+class PooledWSGIServer(BaseWSGIServer):
+	"""
+	WSGI server that hands accepted connections to a fixed pool of worker
+	threads through a bounded queue, answering 503 when the queue is full.
+	"""
+	multithread = True
+
+	def __init__(self, host, port, app, workers=32, backlog=128, queue_size=256,
+				 keep_alive_timeout=5, max_keep_alive_requests=100, request_timeout=120):
+		# Must be set before the socket starts listening in BaseWSGIServer.__init__
+		self.request_queue_size = backlog
+		super().__init__(host, port, app, handler=KeepAliveRequestHandler)
+
+		self.keep_alive_timeout = keep_alive_timeout
+		self.max_keep_alive_requests = max_keep_alive_requests
+		self.request_timeout = request_timeout
+		self.request_queue = queue.Queue(maxsize=queue_size)
+		self.workers = []
+		for i in range(workers):
+			worker = threading.Thread(target=self._work, name=f"macproxy-worker-{i}", daemon=True)
+			worker.start()
+			self.workers.append(worker)
+
+	def process_request(self, request, client_address):
+		try:
+			self.request_queue.put_nowait((request, client_address))
+		except queue.Full:
+			self._reject(request)
+
+	def _reject(self, request):
+		# Without blocking the accept loop: the response fits in any send buffer,
+		# and a client that can't take even that much gets just the close
+		try:
+			request.setblocking(False)
+			request.send(BUSY_RESPONSE)
+		except OSError:
+			pass
+		self.shutdown_request(request)
+
+	def _work(self):
+		while True:
+			item = self.request_queue.get()
+			if item is None:
+				return
+			request, client_address = item
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+	def server_close(self):
+		for _ in self.workers:
+			try:
+				self.request_queue.put_nowait(None)
+			except queue.Full:
+				break
+		super().server_close()
+
+def run_production_server(app, host, port, workers=32, backlog=128, queue_size=256,
+						  keep_alive_timeout=5, max_keep_alive_requests=100, request_timeout=120):
+	server = PooledWSGIServer(
+		host,
+		port,
+		app,
+		workers=workers,
+		backlog=backlog,
+		queue_size=queue_size,
+		keep_alive_timeout=keep_alive_timeout,
+		max_keep_alive_requests=max_keep_alive_requests,
+		request_timeout=request_timeout,
+	)
+	logger.info("Serving on http://%s:%s with %s workers (backlog %s, queue %s)", host, server.port, workers, backlog, queue_size)
+	server.serve_forever()
@@ -0,0 +1,233 @@
+# Standard library imports
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+# Length of 1em/1rem in CSS pixels, as browsers assume for media queries and sizes
+EM_PIXELS = 16
+
+# <source type="..."> values the image converter can decode, and those that
+# are passed through to the browser as they are when images aren't converted
+DECODABLE_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/gif", "image/webp", "image/bmp"}
+PASSTHROUGH_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/gif"}
+
+# Thumbnail widths Wikimedia pre-renders (other widths are rendered on demand, and rate limited)
+WIKIMEDIA_THUMB_WIDTHS = (120, 250, 330, 500, 960, 1280, 1920)
+WIKIMEDIA_THUMB_PATTERN = re.compile(r"^(/[^/]+/[^/]+/thumb/.+/)(\d+)px-([^/]+)$")
+
+MEDIA_FEATURE_PATTERN = re.compile(r"^\(\s*(min|max)-width\s*:\s*([\d.]+)(px|em|rem)\s*\)$")
+LENGTH_PATTERN = re.compile(r"^([\d.]+)(px|vw|em|rem)$")
+
+
+def parse_srcset(srcset):
+	"""
+	Candidates of a srcset attribute as (url, descriptor) pairs, where the
+	descriptor is ("w", width), ("x", density), or ("x", 1.0) when absent.
+	URLs may contain commas; malformed descriptors drop the candidate.
+	"""
+	candidates = []
+	position = 0
+	length = len(srcset)
+	while position < length:
+		# Skip whitespace and separating commas
+		while position < length and (srcset[position].isspace() or srcset[position] == ","):
+			position += 1
+		start = position
+		while position < length and not srcset[position].isspace():
+			position += 1
+		url = srcset[start:position]
+		if not url:
+			break
+		descriptors = ""
+		if url.endswith(","):
+			url = url.rstrip(",")
+		else:
+			start = position
+			while position < length and srcset[position] != ",":
+				position += 1
+			descriptors = srcset[start:position].split()
+		descriptor = _parse_descriptor(descriptors)
+		if url and descriptor is not None:
+			candidates.append((url, descriptor))
+	return candidates
+
+def _parse_descriptor(descriptors):
+	if not descriptors:
+		return ("x", 1.0)
+	for descriptor in descriptors:
+		kind = descriptor[-1:].lower()
+		try:
+			value = float(descriptor[:-1])
+		except ValueError:
+			continue
+		if kind == "w" and value > 0:
+			return ("w", value)
+		if kind == "x" and value > 0:
+			return ("x", value)
+	return None
+
+def _pixels(value, unit, viewport_width):
+	value = float(value)
+	if unit == "vw":
+		return value * viewport_width / 100
+	if unit in ("em", "rem"):
+		return value * EM_PIXELS
+	return value
+
+def media_matches(media, viewport_width):
+	"""
+	Whether a media query list matches a screen viewport_width pixels wide.
+	Only width features (combined with "and", or listed with commas) are
+	understood; None if the query uses anything else.
+	"""
+	media = (media or "").strip().lower()
+	if not media or media in ("all", "screen"):
+		return True
+	for query in media.split(","):
+		matches = True
+		for part in re.split(r"\s+and\s+", query.strip()):
+			part = part.strip()
+			if part in ("all", "screen", "only screen"):
+				continue
+			feature = MEDIA_FEATURE_PATTERN.match(part)
+			if feature is None:
+				return None
+			bound, value, unit = feature.groups()
+			limit = _pixels(value, unit, viewport_width)
+			if (bound == "min" and viewport_width < limit) or (bound == "max" and viewport_width > limit):
+				matches = False
+		if matches:
+			return True
+	return False
+
+def source_size(sizes, viewport_width):
+	"""
+	Display width in pixels given by a sizes attribute on a screen
+	viewport_width pixels wide, or None if it can't be worked out.
+	"""
+	for entry in (sizes or "").split(","):
+		entry = entry.strip().lower()
+		if not entry:
+			continue
+		if entry.endswith(")") or " " not in entry:
+			media, size = "", entry
+		else:
+			media, size = entry.rsplit(None, 1)
+		matches = media_matches(media, viewport_width)
+		if matches is None:
+			return None
+		if matches:
+			length = LENGTH_PATTERN.match(size)
+			return _pixels(*length.groups(), viewport_width) if length else None
+	return None
+
+def _number(value):
+	try:
+		return float(str(value).strip().rstrip("px"))
+	except ValueError:
+		return None
+
+def target_width(img, max_width, max_height, sizes=None):
+	"""
+	Narrowest width an image needs so that, once scaled down to fit in
+	max_width x max_height, it is as sharp as its displayed size allows.
+	"""
+	target = float(max_width)
+	width = _number(img.get("width", ""))
+	height = _number(img.get("height", ""))
+	if width and height and max_height:
+		# Taller images are limited by max_height instead
+		target = min(target, max_height * width / height)
+	if width:
+		target = min(target, width)
+	slot = source_size(sizes, max_width)
+	if slot:
+		target = min(target, slot)
+	return max(1, int(round(target)))
+
+def choose_candidate(candidates, target):
+	"""
+	The smallest candidate that is at least target pixels wide (width
+	descriptors) or the lowest density from 1x up, or None if there is none.
+	"""
+	widths = [(value, url) for url, (kind, value) in candidates if kind == "w"]
+	if widths:
+		large_enough = [(value, url) for value, url in widths if value >= target]
+		return min(large_enough)[1] if large_enough else None
+	densities = [(value, url) for url, (kind, value) in candidates if kind == "x"]
+	at_least_1x = [(value, url) for value, url in densities if value >= 1]
+	return min(at_least_1x)[1] if at_least_1x else None
+
+def resize_cdn_url(url, width):
+	"""
+	url rewritten to ask an image CDN that resizes on request for an image
+	width pixels wide (never wider than what url already asks for), or url.
+	"""
+	parts = urlsplit(url)
+	host = (parts.hostname or "").lower()
+	if host == "upload.wikimedia.org":
+		thumb = WIKIMEDIA_THUMB_PATTERN.match(parts.path)
+		if thumb:
+			prefix, current, name = thumb.groups()
+			wider = [w for w in WIKIMEDIA_THUMB_WIDTHS if w >= width]
+			new_width = wider[0] if wider else WIKIMEDIA_THUMB_WIDTHS[-1]
+			if new_width < int(current):
+				return urlunsplit(parts._replace(path=f"{prefix}{new_width}px-{name}"))
+	elif re.match(r"^i[0-3]\.wp\.com$", host) or host.endswith(".files.wordpress.com"):
+		query = parse_qsl(parts.query, keep_blank_values=True)
+		current = next((_number(value) for key, value in query if key == "w"), None)
+		if current is None or current > width:
+			query = [(key, value) for key, value in query if key not in ("w", "h", "resize", "fit")]
+			query.append(("w", str(width)))
+			return urlunsplit(parts._replace(query=urlencode(query)))
+	return url
+
+def pick_image_sources(soup, max_width, max_height, convert=True):
+	"""
+	Point each <img> at the smallest rendition its srcset, sizes and
+	enclosing <picture> offer that still covers max_width x max_height (or
+	its displayed size), and shrink known resizable CDN URLs to match.
+	<source> elements and srcset/sizes are removed, so every browser gets
+	the same image. Returns how many images were changed.
+	"""
+	types = DECODABLE_TYPES if convert else PASSTHROUGH_TYPES
+	changed = 0
+	for img in soup.find_all("img"):
+		candidates = []
+		sizes = img.get("sizes")
+		picture = img.parent if img.parent is not None and img.parent.name == "picture" else None
+		if picture is not None:
+			for source in picture.find_all("source", recursive=False):
+				source_type = source.get("type", "").split(";")[0].strip().lower()
+				if source_type and source_type not in types:
+					continue
+				if not media_matches(source.get("media"), max_width):
+					continue
+				# The first matching <source> is the one a browser would use
+				candidates = parse_srcset(source.get("srcset", ""))
+				sizes = source.get("sizes", sizes)
+				break
+		if not candidates:
+			candidates = parse_srcset(img.get("srcset", ""))
+
+		target = target_width(img, max_width, max_height, sizes)
+		src = img.get("src")
+		chosen = choose_candidate(candidates, target)
+		if chosen is None and not src and candidates:
+			# Nothing big enough and no src to fall back on: take the largest
+			chosen = max(candidates, key=lambda candidate: candidate[1][1])[0]
+		elif chosen is None:
+			chosen = src
+		if chosen:
+			chosen = resize_cdn_url(chosen, target)
+
+		if chosen and chosen != src:
+			img["src"] = chosen
+			changed += 1
+		for attribute in ("srcset", "sizes"):
+			if attribute in img.attrs:
+				del img[attribute]
+		if picture is not None:
+			for source in picture.find_all("source", recursive=False):
+				source.decompose()
+	return changed
@@ -0,0 +1,83 @@
+# Standard library imports
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party imports
+from flask import request
+
+# First-party imports
+import config
+
+
+class ClientState:
+	"""
+	Attribute bag holding one client's state for one namespace (usually an
+	extension). Hold `lock` while mutating shared structures such as lists.
+	"""
+	def __init__(self, defaults):
+		self.__dict__.update(copy.deepcopy(defaults))
+		self.lock = threading.RLock()
+
+	def reset(self, defaults):
+		with self.lock:
+			for key, value in copy.deepcopy(defaults).items():
+				setattr(self, key, value)
+
+
+class ClientStateStore:
+	"""
+	Per-client state, keyed by client id and namespace. Holds at most
+	max_clients clients, dropping the least recently seen first, and forgets
+	clients that have been idle for longer than idle_timeout seconds.
+	"""
+	def __init__(self, max_clients=256, idle_timeout=3600):
+		self.max_clients = max_clients
+		self.idle_timeout = idle_timeout
+		self._clients = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, client_id, namespace, defaults):
+		now = time.time()
+		with self._lock:
+			self._expire(now)
+			entry = self._clients.pop(client_id, None)
+			namespaces = entry[1] if entry else {}
+			self._clients[client_id] = (now, namespaces)
+			while len(self._clients) > self.max_clients:
+				self._clients.popitem(last=False)
+			if namespace not in namespaces:
+				namespaces[namespace] = ClientState(defaults)
+			return namespaces[namespace]
+
+	def _expire(self, now):
+		while self._clients:
+			client_id, (last_seen, _) = next(iter(self._clients.items()))
+			if now - last_seen < self.idle_timeout:
+				break
+			del self._clients[client_id]
+
+	def __len__(self):
+		with self._lock:
+			return len(self._clients)
+
+
+client_states = ClientStateStore(
+	max_clients=getattr(config, 'CLIENT_STATE_MAX_CLIENTS', 256),
+	idle_timeout=getattr(config, 'CLIENT_STATE_IDLE_TIMEOUT', 3600),
+)
+
+def get_client_id():
+	"""
+	Identify the client making the current request by its IP address, the
+	one thing a browser sends the proxy unchanged for every site it visits.
+	"""
+	return f"ip:{request.remote_addr}"
+
+def get_client_state(namespace, **defaults):
+	"""
+	Return the state for the current client in `namespace`, creating it from
+	`defaults` (deep-copied) the first time this client is seen.
+	"""
+	return client_states.get(get_client_id(), namespace, defaults)
@@ -1,12 +1,18 @@
 # Standard Library imports
+import functools
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
+# Every module that needs the config calls this; the preset is only read and applied once
+@functools.lru_cache(maxsize=None)
 def load_preset():
 	# Try to import config.py first
 	try:
 		import config
 	except ModuleNotFoundError:
-		print("config.py not found, exiting.")
+		logger.critical("config.py not found, exiting.")
 		quit()
 
 	"""
@@ -20,13 +26,13 @@ def load_preset():
 	preset_file = os.path.join(preset_dir, f"{preset_name}.py")
 
 	if not os.path.exists(preset_dir):
-		print(f"Error: Preset directory not found: {preset_dir}")
-		print(f"Make sure the preset '{preset_name}' exists in the presets directory")
+		logger.critical("Preset directory not found: %s", preset_dir)
+		logger.critical("Make sure the preset '%s' exists in the presets directory", preset_name)
 		quit()
 
 	if not os.path.exists(preset_file):
-		print(f"Error: Preset file not found: {preset_file}")
-		print(f"Make sure {preset_name}.py exists in the {preset_name} directory")
+		logger.critical("Preset file not found: %s", preset_file)
+		logger.critical("Make sure %s.py exists in the %s directory", preset_name, preset_name)
 		quit()
 
 	try:
@@ -49,6 +55,9 @@ def load_preset():
 			'CONVERT_IMAGES',
 			'CONVERT_IMAGES_TO_FILETYPE',
 			'DITHERING_ALGORITHM',
+			'IMAGE_COLOR_DEPTH',
+			'PAGE_SPLIT_BYTES',
+			'MAX_IMAGES_PER_PAGE',
 			'WEB_SIMULATOR_PROMPT_ADDENDUM',
 			'CONVERT_CHARACTERS',
 			'CONVERSION_TABLE'
@@ -75,20 +84,20 @@ def load_preset():
 					if old_value is None:
 						val = str(format_value(preset_value)).replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
 						truncated = val[:100] + ('...' if len(val) > 100 else '')
-						print(f"Preset '{preset_name}' set {var} to {truncated}")
+						logger.info("Preset '%s' set %s to %s", preset_name, var, truncated)
 					else:
 						old_val = str(format_value(old_value)).replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
 						new_val = str(format_value(preset_value)).replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
 						old_truncated = old_val[:100] + ('...' if len(old_val) > 100 else '')
 						new_truncated = new_val[:100] + ('...' if len(new_val) > 100 else '')
-						print(f"Preset '{preset_name}' changed {var} from {old_truncated} to {new_truncated}")
+						logger.info("Preset '%s' changed %s from %s to %s", preset_name, var, old_truncated, new_truncated)
 		if changes_made:
-			print(f"Successfully loaded preset: {preset_name}")
+			logger.info("Successfully loaded preset: %s", preset_name)
 		else:
-			print(f"Loaded preset '{preset_name}' (no changes were necessary)")
+			logger.debug("Loaded preset '%s' (no changes were necessary)", preset_name)
 
 		return config
 
 	except Exception as e:
-		print(f"Error loading preset '{preset_name}': {str(e)}")
+		logger.critical("Error loading preset '%s': %s", preset_name, e)
 		quit()